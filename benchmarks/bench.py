@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the pairtree hot paths.
+
+Each benchmark times a run of operations and reports their throughput (and
+bytes a second, where that makes sense) and the 50th, 95th and 99th percentile
+latency of a single operation. The results can be written out as JSON, and
+compared against a JSON file saved from an earlier run:
+
+    python benchmarks/bench.py -o baseline.json
+    ... change things ...
+    python benchmarks/bench.py -b baseline.json
+
+exits with status 1 if any benchmark's throughput has dropped by more than the
+--threshold.
+
+The stores for the list_ids benchmarks are generated in the work directory,
+which is removed afterwards unless it was given with --workdir - then they are
+kept and reused by later runs, which saves a long wait for the larger sizes:
+
+    python benchmarks/bench.py --only list_ids -n 10000,1000000,10000000 --workdir /scratch/bench
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pairtree import PairtreeStorageFactory, PairtreeReverseLookup
+from pairtree import pairtree_path as ppath
+
+USAGE = """%prog [options]
+
+Benchmarks: """
+
+# Identifier generators - each takes a count and a random.Random, and returns a list of ids
+
+def ascii_ids(n, rng):
+    """Plain alphanumeric ids, like database keys"""
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(6, 16))) for _ in range(n)]
+
+def ark_ids(n, rng):
+    """ARKs - full of the ':' and '/' characters that need encoding"""
+    return ["ark:/%05d/%s%08x" % (rng.randint(10000, 99999), rng.choice("bcdfghjkmnpqrstvwxz"),
+                                  rng.getrandbits(32)) for _ in range(n)]
+
+def urn_ids(n, rng):
+    """URNs - UUIDs and ISBNs"""
+    ids = []
+    for i in range(n):
+        if i % 2:
+            ids.append("urn:uuid:%08x-%04x-%04x-%04x-%012x" % (rng.getrandbits(32), rng.getrandbits(16),
+                       rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(48)))
+        else:
+            ids.append("urn:isbn:978-%d-%03d-%05d-%d" % (rng.randint(0, 9), rng.randint(0, 999),
+                       rng.randint(0, 99999), rng.randint(0, 9)))
+    return ids
+
+def unicode_ids(n, rng):
+    """Ids that are mostly non-ASCII, so almost every character is hex encoded"""
+    ranges = [(0x00c0, 0x017f), (0x0391, 0x03c9), (0x0410, 0x044f), (0x4e00, 0x9fff)]
+    ids = []
+    for _ in range(n):
+        low, high = rng.choice(ranges)
+        ids.append("".join(chr(rng.randint(low, high)) for _ in range(rng.randint(4, 12))))
+    return ids
+
+GENERATORS = {"ascii":ascii_ids, "ark":ark_ids, "urn":urn_ids, "unicode":unicode_ids}
+
+def parse_size(text):
+    """'4K' -> 4096 and so on"""
+    text = text.strip().upper()
+    for suffix, factor in (("K", 1024), ("M", 1024 ** 2), ("G", 1024 ** 3)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure(func, args, nbytes=None):
+    """
+    Time C{func(arg)} for each of C{args}
+
+    @returns: L{dict} of the run's statistics
+    """
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for arg in args:
+        t = clock()
+        func(arg)
+        latencies.append(clock() - t)
+    seconds = clock() - start
+    return summarise(len(latencies), seconds, latencies, nbytes)
+
+def summarise(ops, seconds, latencies, nbytes=None):
+    latencies = sorted(latencies)
+    result = {"ops":ops,
+              "seconds":round(seconds, 6),
+              "ops_per_sec":round(ops / seconds, 2) if seconds else None,
+              "p50_ms":round(percentile(latencies, 0.50) * 1000, 4),
+              "p95_ms":round(percentile(latencies, 0.95) * 1000, 4),
+              "p99_ms":round(percentile(latencies, 0.99) * 1000, 4)}
+    if nbytes is not None and seconds:
+        result["mb_per_sec"] = round(nbytes / seconds / (1024 * 1024), 2)
+    return result
+
+class Bench(object):
+    def __init__(self, options, workdir):
+        self.options = options
+        self.workdir = workdir
+        self.results = {}
+
+    def record(self, name, result):
+        self.results[name] = result
+        sys.stderr.write("%-40s %12s ops/s  p50 %8.4f ms  p99 %8.4f ms%s\n" % (
+                         name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"],
+                         "  %.2f MB/s" % result["mb_per_sec"] if "mb_per_sec" in result else ""))
+
+    def ids(self, generator, n):
+        return GENERATORS[generator](n, random.Random("%s-%s-%s" % (self.options.seed, generator, n)))
+
+    def new_store(self, name, **kwargs):
+        store_dir = os.path.join(self.workdir, name)
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        return PairtreeStorageFactory().get_store(store_dir=store_dir, uri_base="info:bench/", **kwargs)
+
+    def bench_encode(self):
+        for generator in self.options.generators:
+            ids = self.ids(generator, self.options.ops)
+            encoded = [ppath.id_encode(id) for id in ids]
+            self.record("id_encode.%s" % generator, measure(ppath.id_encode, ids))
+            self.record("id_decode.%s" % generator, measure(ppath.id_decode, encoded))
+
+    def bench_dirpath(self):
+        for generator in self.options.generators:
+            ids = self.ids(generator, self.options.ops)
+            store = self.new_store("dirpath", cache_size=0)
+            self.record("id_to_dirpath.%s" % generator, measure(store._id_to_dirpath, ids))
+            store = self.new_store("dirpath", cache_size=len(ids))
+            for id in ids:
+                store._id_to_dirpath(id)
+            self.record("id_to_dirpath.cached.%s" % generator, measure(store._id_to_dirpath, ids))
+
+    def populated_store(self, generator, n):
+        """A store of C{n} objects, each with one small part - kept in the workdir for reuse"""
+        store_dir = os.path.join(self.workdir, "list_ids-%s-%d" % (generator, n))
+        marker = os.path.join(store_dir, "bench_complete")
+        if not os.path.exists(marker):
+            if os.path.exists(store_dir):
+                shutil.rmtree(store_dir)
+            store = PairtreeStorageFactory().get_store(store_dir=store_dir, uri_base="info:bench/")
+            sys.stderr.write("generating a store of %d %s objects...\n" % (n, generator))
+            for id in self.ids(generator, n):
+                dirpath = store._id_to_dirpath(id)
+                os.makedirs(dirpath, exist_ok=True)
+                with open(os.path.join(dirpath, "part.txt"), "wb") as f:
+                    f.write(b"x")
+            open(marker, "w").close()
+        return PairtreeStorageFactory().get_store(store_dir=store_dir, cache_size=0)
+
+    def bench_list_ids(self):
+        for n in self.options.objects:
+            for generator in self.options.generators:
+                store = self.populated_store(generator, n)
+                for threads in (None, self.options.threads):
+                    latencies = []
+                    clock = time.perf_counter
+                    start = last = clock()
+                    for _ in store.list_ids(threads=threads):
+                        now = clock()
+                        latencies.append(now - last)
+                        last = now
+                    name = "list_ids.%s.%d" % (generator, n)
+                    if threads:
+                        name += ".threads%d" % threads
+                    self.record(name, summarise(len(latencies), clock() - start, latencies))
+
+    def bench_streams(self):
+        store = self.new_store("streams", hashing_type=self.options.hash)
+        ids = self.ids("ascii", 16)
+        for id in ids:
+            store.create_object(id)
+        for size in self.options.sizes:
+            count = max(4, min(self.options.ops, self.options.volume // size))
+            data = os.urandom(size)
+            jobs = [(ids[i % len(ids)], "part-%d-%d" % (size, i)) for i in range(count)]
+            self.record("put_stream.%d" % size,
+                        measure(lambda job: store.put_stream(job[0], None, job[1], data), jobs, size * count))
+            self.record("get_stream.%d" % size,
+                        measure(lambda job: store.get_stream(job[0], None, job[1]), jobs, size * count))
+            def stream(job):
+                with store.get_stream(job[0], None, job[1], streamable=True) as f:
+                    while f.read(65536):
+                        pass
+            self.record("get_stream.streamable.%d" % size, measure(stream, jobs, size * count))
+
+    def bench_delete(self):
+        count = min(self.options.ops, 1000)
+        for fast in (False, True):
+            store = self.new_store("delete", fast_delete=fast)
+            ids = self.ids("ark", count)
+            for id in ids:
+                object = store.create_object(id)
+                for i in range(self.options.parts):
+                    object.add_bytestream_by_path("data/%d.txt" % i, b"x")
+            name = "delete_object.fast" if fast else "delete_object"
+            self.record(name, measure(store.delete_object, ids))
+            store.empty_trash()
+
+    def bench_revlookup(self):
+        for backend in ("file", "sqlite"):
+            storage_dir = os.path.join(self.workdir, "revlookup-%s" % backend)
+            if os.path.exists(storage_dir):
+                shutil.rmtree(storage_dir)
+            rl = PairtreeReverseLookup(storage_dir, backend=backend)
+            keys = self.ids("urn", self.options.ops)
+            ids = self.ids("ark", self.options.ops)
+            pairs = list(zip(keys, ids))
+            def append(pair):
+                rl[pair[0]] = pair[1]
+            self.record("revlookup.%s.append" % backend, measure(append, pairs))
+            self.record("revlookup.%s.lookup" % backend, measure(lambda key: list(rl[key]), keys))
+            self.record("revlookup.%s.contains" % backend, measure(lambda pair: pair[1] in rl[pair[0]], pairs))
+            start = time.perf_counter()
+            found = rl.get_many(keys)
+            seconds = time.perf_counter() - start
+            self.record("revlookup.%s.get_many" % backend, summarise(len(found), seconds, [seconds]))
+            rl.close()
+
+BENCHMARKS = [("encode", "bench_encode"),
+              ("dirpath", "bench_dirpath"),
+              ("list_ids", "bench_list_ids"),
+              ("streams", "bench_streams"),
+              ("delete", "bench_delete"),
+              ("revlookup", "bench_revlookup")]
+
+def compare(results, baseline, threshold):
+    """
+    Print each benchmark's throughput against the baseline's
+
+    @returns: the names of the benchmarks that got slower by more than C{threshold}
+    """
+    regressions = []
+    sys.stdout.write("%-40s %14s %14s %8s\n" % ("benchmark", "baseline", "now", "change"))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name].get("ops_per_sec")
+        after = results[name].get("ops_per_sec")
+        if not before or not after:
+            continue
+        change = after / before - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  SLOWER"
+        sys.stdout.write("%-40s %14.2f %14.2f %+7.1f%%%s\n" % (name, before, after, change * 100, flag))
+    return regressions
+
+def _option_parser():
+    parser = optparse.OptionParser(usage=USAGE + ", ".join(name for name, _ in BENCHMARKS))
+    parser.add_option("--only", dest="only",
+                  help="Comma separated benchmarks to run (Default: all of them)",
+                  default=None)
+    parser.add_option("-g", "--generators", dest="generators",
+                  help="Comma separated id generators to use, from: %s" % ", ".join(sorted(GENERATORS)),
+                  default="ascii,ark,urn,unicode")
+    parser.add_option("-n", "--objects", dest="objects",
+                  help="Comma separated sizes of store to run list_ids on",
+                  default="10000")
+    parser.add_option("--ops", dest="ops", type="int",
+                  help="Number of operations to time in each of the other benchmarks",
+                  default=10000)
+    parser.add_option("-s", "--sizes", dest="sizes",
+                  help="Comma separated part sizes for put_stream and get_stream (eg 1K,1M,64M)",
+                  default="1K,64K,1M,16M")
+    parser.add_option("--volume", dest="volume",
+                  help="Most bytes to write for each part size",
+                  default="256M")
+    parser.add_option("--parts", dest="parts", type="int",
+                  help="Number of parts in each object deleted",
+                  default=20)
+    parser.add_option("--threads", dest="threads", type="int",
+                  help="Threads to run list_ids with, alongside the single threaded run",
+                  default=8)
+    parser.add_option("-H", "--hash", dest="hash",
+                  help="hashing_type for the put_stream store (Default: none)",
+                  default=None)
+    parser.add_option("--seed", dest="seed",
+                  help="Random seed for the id generators",
+                  default="pairtree")
+    parser.add_option("-w", "--workdir", dest="workdir",
+                  help="Directory to generate stores in, kept for later runs",
+                  default=None)
+    parser.add_option("-o", "--output", dest="output",
+                  help="Write the results to this JSON file",
+                  default=None)
+    parser.add_option("-b", "--baseline", dest="baseline",
+                  help="Compare the results with this JSON file from an earlier run",
+                  default=None)
+    parser.add_option("-t", "--threshold", dest="threshold", type="float",
+                  help="Fraction of throughput a benchmark may lose before it counts as slower",
+                  default=0.10)
+    return parser
+
+if __name__ == '__main__':
+    o = _option_parser()
+    options, args = o.parse_args()
+    options.generators = [x for x in options.generators.split(",") if x]
+    for generator in options.generators:
+        if generator not in GENERATORS:
+            o.error("unknown id generator %r" % generator)
+    options.objects = [int(parse_size(x)) for x in options.objects.split(",") if x]
+    options.sizes = [parse_size(x) for x in options.sizes.split(",") if x]
+    options.volume = parse_size(options.volume)
+    names = [name for name, _ in BENCHMARKS]
+    only = names
+    if options.only:
+        only = options.only.split(",")
+        for name in only:
+            if name not in names:
+                o.error("unknown benchmark %r" % name)
+
+    workdir = options.workdir
+    if workdir:
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix="pairtree-bench-")
+    bench = Bench(options, workdir)
+    try:
+        for name, method in BENCHMARKS:
+            if name in only:
+                getattr(bench, method)()
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"meta":{"time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      "python":platform.python_version(),
+                      "platform":platform.platform(),
+                      "argv":sys.argv[1:]},
+              "results":bench.results}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    elif not options.baseline:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(bench.results, baseline, options.threshold):
+            sys.exit(1)
@@ -34,6 +34,38 @@ C{ppath toid} examples::
 
     data/subjects/pairtree_root/HA/SS/ET/ROOT$ ppath toid `pwd`
     HASSET/ROOT
+
+Passing '-' instead of an id or path converts every line read from stdin::
+
+    $ find . -name '*.xml' | ppath toid -
+
+The results are written in the same order, one per line, with an empty line (and a
+message on stderr) for anything that can't be converted. Add -0 to read and write NUL
+terminated records instead, as find -print0 and xargs -0 do, -p N to spread a large
+input over N processes, and -s N for a store whose shorties aren't 2 characters long::
+
+    $ find . -name '*.xml' -print0 | ppath -0 -p 4 toid - | xargs -0 -n 1000 echo
+
+The pairtree script
+===================
+
+C{pairtree ingest} bulk loads parts into a store, copying them in parallel. It reads
+tab separated 'id, path, source' lines from stdin and reports on each one::
+
+    $ find scans -name '*.tif' | awk -F/ '{print $2"\\t"$3"\\t"$0}' | pairtree ingest -w 16 -H md5 mystore
+
+Stores opened with fixity=True record the checksum of every part written. C{pairtree audit}
+checks the parts against them, hashing in parallel, and reports any that are missing,
+changed or unrecorded::
+
+    $ pairtree audit -H md5 -w 8 --rate 200 mystore
+
+C{pairtree stats} counts the objects, parts and bytes in a store, with histograms of
+the objects' sizes and depths. On a big store, --sample walks only a fraction of the
+tree and estimates the rest, and --incremental only lists again the directories that
+have changed since its last run::
+
+    $ pairtree stats -w 16 --incremental --json mystore
     
 Quick Start:
 ============
@@ -148,6 +180,19 @@ Removing the first copy of that file, which was added to the wrong place:
 ['Firefox_wallpaper.png']
 >>> 
 
+To go through every part of an object, however deeply nested, walk it instead - each
+part comes with its os.stat, and the walk adds up the parts and bytes it has seen:
+
+>>> walk = bar.walk()
+>>> for part, st in walk:
+...   print(part, st.st_size)
+... 
+foo.txt 28
+magic/path/inside/object/Firefox_wallpaper.png 168923
+>>> walk.parts, walk.size
+(2, 168951)
+>>> 
+
 There are also some convenience methods:
 
     -  add_bytestream_by_path(self, filepath, bytestream, buffer_size=None):
@@ -190,24 +235,78 @@ can be any sequence of bytes
 
 __version__ = '0.8'
 
-from pairtree.pairtree_client import *
-from pairtree.pairtree_store import *
-from pairtree.pairtree_object import *
-from pairtree.pairtree_revlookup import PairtreeReverseLookup
-from pairtree import pairtree_path as ppath
-from pairtree.pairtree_path import id_encode, id_decode
+# The submodules are imported when one of their names is first used, so that
+# "import pairtree" - or the ppath script, which only needs the id codec - doesn't
+# pay for sqlite3, asyncio and the rest of the storage client up front.
+
+import importlib
+
 from pairtree.storage_exceptions import *
 
+# name -> the submodule it comes from
+_LAZY = {"PairtreeStorageClient":"pairtree_client",
+         "FSYNC_POLICIES":"pairtree_client",
+         "TEMP_PREFIX":"pairtree_client",
+         "PairtreeStorageFactory":"pairtree_store",
+         "PairtreeStorageObject":"pairtree_object",
+         "PairtreeReverseLookup":"pairtree_revlookup",
+         "PairtreeIndex":"pairtree_index",
+         "PAIRTREE_INDEX":"pairtree_index",
+         "IngestResult":"pairtree_ingest",
+         "FixityDB":"pairtree_fixity",
+         "FixityAudit":"pairtree_fixity",
+         "FixityProblem":"pairtree_fixity",
+         "ChecksumCache":"pairtree_fixity",
+         "PAIRTREE_FIXITY":"pairtree_fixity",
+         "PAIRTREE_CHECKSUMS":"pairtree_fixity",
+         "ObjectManifest":"pairtree_manifest",
+         "ObjectWalk":"pairtree_manifest",
+         "Reaper":"pairtree_trash",
+         "PAIRTREE_TRASH":"pairtree_trash",
+         "Observer":"pairtree_metrics",
+         "MetricsCollector":"pairtree_metrics",
+         "PrometheusExporter":"pairtree_metrics",
+         "StoreStats":"pairtree_stats",
+         "PAIRTREE_STATS":"pairtree_stats",
+         "AsyncPairtreeStorageClient":"pairtree_async",
+         "AsyncPairtreeStorageObject":"pairtree_async",
+         "id_encode":"pairtree_path",
+         "id_decode":"pairtree_path"}
+
+__all__ = sorted(_LAZY) + ["ppath", "id2path", "path2id",
+                           "ObjectNotFoundException", "FileNotFoundException",
+                           "PartNotFoundException", "StoreNotFoundException",
+                           "ObjectAlreadyExistsException", "StoreAlreadyExistsException",
+                           "PathIsNotEmptyException", "NotAPairtreeStoreException",
+                           "NotAValidStoreName"]
+
+def __getattr__(name):
+    if name == "ppath":
+        name, attr = "pairtree_path", None
+    elif name in _LAZY:
+        name, attr = _LAZY[name], name
+    else:
+        raise AttributeError("module 'pairtree' has no attribute %r" % name)
+    module = importlib.import_module("pairtree." + name)
+    value = module if attr is None else getattr(module, attr)
+    globals()["ppath" if attr is None else attr] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
 def id2path(id):
     """
     pass in a pairtree id and get back a path
     """
-    path = ppath.id_to_dirpath(id)
+    from pairtree.pairtree_path import id_to_dirpath
+    path = id_to_dirpath(id)
     return path
 
 def path2id(path):
     """
     pass in a pairtree path and get back an id
     """
-    return ppath.get_id_from_dirpath(path)
+    from pairtree.pairtree_path import get_id_from_dirpath
+    return get_id_from_dirpath(path)
 
@@ -1,5 +1,49 @@
 import os
+import atexit
+import hashlib
+import logging
+import queue
 import shutil
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from stat import S_ISREG
+
+# Buffered copies start at DEFAULT_BUFFER_SIZE and, as long as the source keeps
+# filling the buffer, double up to MAX_BUFFER_SIZE
+DEFAULT_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Largest single request made to copy_file_range/sendfile
+ZERO_COPY_CHUNK = 1024 * 1024 * 1024
+
+# Prefix of the temporary files used by atomic writes, which are not parts
+TEMP_PREFIX = ".pairtree-"
+
+# A directory or file modified this close to (or after) the moment it was looked
+# at may change again within the same mtime tick, unnoticed - anything cached on
+# the strength of its mtime is not trusted. Generous, as some filesystems keep
+# whole seconds.
+RACY_WINDOW_NS = 2 * 10**9
+
+logger = logging.getLogger('pairtreeutils')
+
+def make_temp_file(dirpath, prefix=TEMP_PREFIX, suffix=".tmp"):
+    """
+    Create a new, empty, temporary file in C{dirpath} for writing. Unlike
+    C{tempfile.mkstemp}, the file gets the permissions a plain C{open()} would
+    give it (0666, less the umask), so it can be renamed into place as a part.
+
+    @returns: C{(fd, path)}
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        path = os.path.join(dirpath, prefix + os.urandom(8).hex() + suffix)
+        try:
+            return os.open(path, flags, 0o666), path
+        except FileExistsError:
+            continue
 
 def copytree(src, dst):
     for f in os.listdir(src):
@@ -10,3 +54,452 @@ def copytree(src, dst):
             dst_path = os.path.join(dst, f)
             shutil.copytree(src_path, dst_path)
     return
+
+class LRUCache(object):
+    """
+    A small, thread-safe, bounded mapping which discards the least recently
+    used entries once it holds more than C{maxsize} of them. Hits and misses
+    are counted so that callers can see whether the cache is earning its keep.
+
+    A C{maxsize} of 0 disables the cache - nothing is ever stored.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        """
+        @returns: L{dict} of C{hits}, C{misses}, C{size} and C{maxsize}
+        """
+        return {"hits":self.hits, "misses":self.misses, "size":len(self._data), "maxsize":self.maxsize}
+
+def regular_fileno(stream):
+    """
+    The file descriptor behind C{stream}, if it has one and it is a regular file
+    (so not a pipe, socket or terminal), otherwise None.
+    """
+    try:
+        fd = stream.fileno()
+        if S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except (AttributeError, ValueError, OSError):
+        pass
+    return None
+
+def copy_fd(src_fd, dst_fd, offset=0):
+    """
+    Copy everything from C{offset} onwards in the regular file C{src_fd} to the
+    current position of C{dst_fd} without passing the data through userspace.
+
+    Tries C{os.copy_file_range} first - on filesystems which support it (eg btrfs,
+    XFS, NFS 4.2) this shares extents or copies server side - then C{os.sendfile}.
+    If neither can be used, fewer bytes than expected (possibly none) will have
+    been copied; the caller should finish off with an ordinary copy from
+    C{offset + copied}.
+
+    @returns: Number of bytes copied
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                n = os.copy_file_range(src_fd, dst_fd, ZERO_COPY_CHUNK, offset + copied)
+                if not n:
+                    return copied
+                copied += n
+        except OSError:
+            pass
+    if hasattr(os, 'sendfile'):
+        try:
+            while True:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, ZERO_COPY_CHUNK)
+                if not n:
+                    return copied
+                copied += n
+        except OSError:
+            pass
+    return copied
+
+def copy_stream(src, dst, buffer_size=None, hashers=()):
+    """
+    Copy the rest of the file-like object C{src} into the binary file C{dst},
+    feeding every byte through each of C{hashers} (eg C{hashlib} objects) on the
+    way.
+
+    If no hashing is needed and C{src} is a regular file, the copy is done in the
+    kernel with L{copy_fd}. Otherwise the data is read with C{readinto} into a
+    reusable buffer - of C{buffer_size} bytes if given, or one which grows from
+    L{DEFAULT_BUFFER_SIZE} to L{MAX_BUFFER_SIZE} while the reads keep filling it.
+    Sources without C{readinto} are C{read()} from in the same sized chunks.
+
+    @returns: Number of bytes copied
+    """
+    copied = 0
+    if not hashers:
+        src_fd = regular_fileno(src)
+        if src_fd is not None:
+            dst.flush()
+            offset = src.tell()
+            copied = copy_fd(src_fd, dst.fileno(), offset)
+            src.seek(offset + copied)
+    adaptive = not buffer_size
+    size = buffer_size or DEFAULT_BUFFER_SIZE
+    readinto = getattr(src, 'readinto', None)
+    view = memoryview(bytearray(size))
+    while True:
+        if readinto is not None:
+            n = readinto(view)
+            chunk = view[:n]
+        else:
+            chunk = src.read(size)
+            n = len(chunk)
+        if not n:
+            return copied
+        dst.write(chunk)
+        for hasher in hashers:
+            hasher.update(chunk)
+        copied += n
+        if adaptive and n == size and size < MAX_BUFFER_SIZE:
+            size *= 2
+            view = memoryview(bytearray(size))
+
+def hashing_types(hashing_type):
+    """
+    Normalise a C{hashing_type} option - None, the name of one C{hashlib}
+    algorithm, or a list of them - into a tuple of names.
+    """
+    if not hashing_type:
+        return ()
+    if isinstance(hashing_type, str):
+        return (hashing_type,)
+    return tuple(hashing_type)
+
+def check_hashing_types(hashing_type):
+    """
+    Raise a ValueError unless every algorithm named by C{hashing_type} is
+    available from C{hashlib} here, with a fixed length digest (so not shake_*).
+    """
+    for name in hashing_types(hashing_type):
+        if name not in hashlib.algorithms_available or hashlib.new(name).digest_size == 0:
+            raise ValueError("hashing type %r is not supported - use one of: %s"
+                             % (name, ", ".join(sorted(x for x in hashlib.algorithms_guaranteed
+                                                       if not x.startswith("shake_")))))
+
+def checksums(names, hashers):
+    """
+    The result of hashing a part with the algorithms C{names}: the first digest
+    as C{checksum} and C{type} (the form C{put_stream} has always returned), and
+    every digest in C{checksums}, keyed by algorithm.
+    """
+    digests = dict((name, hasher.hexdigest()) for name, hasher in zip(names, hashers))
+    return {"checksum":digests[names[0]], "type":names[0], "checksums":digests}
+
+class HashingThread(object):
+    """
+    Stands in for a hash object in L{copy_stream}, handing each chunk on to
+    C{hashers} running on helper threads (one per hasher), so that the hashing
+    overlaps the copy's reads and writes, and several algorithms run side by
+    side. C{hashlib} releases the GIL while it hashes large buffers.
+
+    Call L{close} once the data is all in, before reading the digests.
+    """
+    def __init__(self, hashers, depth=4):
+        self._queues = []
+        self._threads = []
+        for hasher in hashers:
+            q = queue.Queue(depth)
+            t = threading.Thread(target=self._run, args=(hasher, q))
+            t.daemon = True
+            t.start()
+            self._queues.append(q)
+            self._threads.append(t)
+
+    def _run(self, hasher, q):
+        while True:
+            chunk = q.get()
+            if chunk is None:
+                return
+            hasher.update(chunk)
+
+    def update(self, chunk):
+        # copied, as the caller reuses its buffer
+        chunk = bytes(chunk)
+        for q in self._queues:
+            q.put(chunk)
+
+    def close(self):
+        if not self._threads:
+            return
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+def fsync_dir(dirpath):
+    """
+    fsync a directory, so that renames and new entries in it are durable. A
+    no-op where directories can't be opened (eg Windows).
+    """
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class PartWriter(object):
+    """
+    Writes a single part: straight over C{dirpath/name}, or for an atomic write
+    into a temporary file next to it, hashing it with each of C{hashing_types} on
+    the way. Data can be written a piece at a time with L{write}, or copied from
+    a file-like object with L{copy}, and then L{flush}ed and L{finish}ed - or
+    L{abort}ed, which removes the temporary file of an atomic write.
+
+    With C{fsync='always'}, the file is fsync'd by L{flush} and its directory by
+    L{finish}. With C{fsync='batch'}, L{finish} leaves the file at C{write_path},
+    to be handed to a L{FsyncBatcher}.
+    """
+    def __init__(self, dirpath, name, hashing_types=(), atomic=False, fsync=None, hash_thread=False):
+        self.dirpath = dirpath
+        self.file_path = os.path.join(dirpath, name)
+        self.atomic = atomic
+        self.fsync = fsync
+        try:
+            self.old_size = os.stat(self.file_path).st_size
+        except OSError:
+            self.old_size = 0
+        if atomic:
+            fd, self.write_path = make_temp_file(dirpath)
+            self._file = os.fdopen(fd, "wb")
+        else:
+            self.write_path = self.file_path
+            self._file = open(self.file_path, "wb")
+        self.hashing_types = tuple(hashing_types)
+        self._hashers = [hashlib.new(name) for name in self.hashing_types]
+        self._feeders = self._hashers
+        if self._hashers and hash_thread:
+            self._feeders = [HashingThread(self._hashers)]
+        # os.stat_result of the finished file
+        self.stat = None
+
+    def write(self, data):
+        self._file.write(data)
+        for feeder in self._feeders:
+            feeder.update(data)
+
+    def copy(self, src, buffer_size=None):
+        """
+        Copy the rest of the file-like object C{src} in - see L{copy_stream}
+
+        @returns: Number of bytes copied
+        """
+        return copy_stream(src, self._file, buffer_size, self._feeders)
+
+    def flush(self):
+        self._file.flush()
+        if self.fsync == 'always':
+            os.fsync(self._file.fileno())
+
+    def finish(self):
+        """
+        Close the file and, unless its fsync is batched, move it into place
+
+        @returns: The checksums, as from L{checksums}, or None if there is no hashing
+        """
+        try:
+            self.stat = os.fstat(self._file.fileno())
+        finally:
+            self._close()
+        if self.fsync != 'batch':
+            if self.atomic:
+                os.replace(self.write_path, self.file_path)
+            if self.fsync == 'always':
+                fsync_dir(self.dirpath)
+        if not self._hashers:
+            return None
+        return checksums(self.hashing_types, self._hashers)
+
+    def abort(self):
+        """
+        Close the file, and remove it if it was a temporary one
+        """
+        self._close()
+        if self.atomic:
+            try:
+                os.remove(self.write_path)
+            except OSError:
+                pass
+
+    def _close(self):
+        if self._feeders is not self._hashers:
+            self._feeders[0].close()
+        self._file.close()
+
+class FsyncBatcher(object):
+    """
+    Groups durability barriers for many writes into one.
+
+    Each write is handed over as a finished (closed) temporary file and the path
+    it should end up at. Once C{max_files} writes are pending, or the oldest has
+    waited C{max_delay} seconds, the whole batch is committed: every temporary
+    file is fsync'd, renamed into place, and then each directory involved is
+    fsync'd once. A crash before the commit loses the batch, but never leaves a
+    part half written.
+
+    Writes only become visible when their batch is committed. A timer commits
+    a batch C{max_delay} seconds after its first write even if nothing else is
+    written; call L{flush} to commit early, eg at the end of an ingest run. Any
+    batch still pending when the interpreter exits is committed then.
+    """
+    def __init__(self, max_files=100, max_delay=1.0):
+        self.max_files = max_files
+        self.max_delay = max_delay
+        self._pending = []
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.Lock()
+        _batchers.add(self)
+
+    def add(self, write_path, final_path):
+        """
+        Queue a written file for the next commit.
+
+        @param write_path: The file as written (eg a temporary file)
+        @param final_path: Where the file should end up. If this is the same as
+        C{write_path}, it is just fsync'd.
+        """
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.time()
+                if self.max_delay:
+                    self._timer = threading.Timer(self.max_delay, self._expire)
+                    self._timer.daemon = True
+                    self._timer.start()
+            self._pending.append((write_path, final_path))
+            if len(self._pending) < self.max_files and time.time() - self._oldest < self.max_delay:
+                return
+            pending = self._take()
+        self._commit(pending)
+
+    def flush(self):
+        """
+        Commit any pending writes now.
+        """
+        with self._lock:
+            pending = self._take()
+        self._commit(pending)
+
+    close = flush
+
+    def _take(self):
+        """
+        Internal - hand over the pending writes, and stop the batch's timer. Called
+        with the lock held.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        return pending
+
+    def _expire(self):
+        try:
+            self.flush()
+        except OSError as e:
+            logger.warning("could not commit a batch of writes: %s" % e)
+
+    def _commit(self, pending):
+        dirs = set()
+        for write_path, final_path in pending:
+            fd = os.open(write_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for write_path, final_path in pending:
+            if write_path != final_path:
+                os.replace(write_path, final_path)
+            dirs.add(os.path.dirname(final_path))
+        for dirpath in dirs:
+            fsync_dir(dirpath)
+
+    def __len__(self):
+        return len(self._pending)
+
+# every FsyncBatcher still in use, to be flushed at exit
+_batchers = weakref.WeakSet()
+
+@atexit.register
+def _flush_batchers():
+    for batcher in list(_batchers):
+        try:
+            batcher.flush()
+        except OSError as e:
+            logger.warning("could not commit a batch of writes: %s" % e)
+
+class Throttle(object):
+    """
+    A token bucket, used to cap the rate at which a long running job (such as a
+    fixity audit) reads from the disc. Callers report what they have read with
+    L{consume}, which sleeps just long enough to keep the average at C{rate}
+    bytes a second, allowing bursts of up to C{burst} bytes.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self._allowance = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.burst, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= n
+            wait = -self._allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
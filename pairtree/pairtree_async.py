@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - asyncio client
+====================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+Filesystem calls block, so every method of L{PairtreeStorageClient} would hold
+up an asyncio event loop. L{AsyncPairtreeStorageClient} wraps a client and runs
+its calls on a bounded thread pool, with a per-store limit on how many can be in
+flight at once, so that a single process can keep thousands of reads and writes
+going without stalling the loop.
+
+Usage
+=====
+
+>>> from pairtree import AsyncPairtreeStorageClient
+>>> async with AsyncPairtreeStorageClient('http://example.org/', 'data') as store:
+...     bar = await store.get_object('bar')
+...     await bar.add_bytestream('foo.txt', b'can be any sequence of bytes')
+...     async for chunk in bar.iter_bytestream('foo.txt'):
+...         send(chunk)
+...     async for id in store.list_ids():
+...         print(id)
+
+Parts can also be written from an async iterable of bytes (eg an HTTP request
+body) - the chunks are pulled through as the part is written, so the whole part
+is never held in memory. The iterable is read on the event loop, and a call is
+only in flight (counting against C{max_concurrency}) while a chunk that has
+already arrived is being written, so the source can itself be a store - eg
+L{AsyncPairtreeStorageClient.iter_stream} - without the two waiting on each other:
+
+>>> await store.put_stream('bar', None, 'upload.bin', request.content.iter_chunked(65536))
+"""
+
+import asyncio
+
+import functools
+
+import itertools
+
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pairtree.pairtree_client import PairtreeStorageClient
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger('pairtreeasync')
+
+def _take(iterator, n):
+    """
+    Internal - the next C{n} items from C{iterator}, as a list
+    """
+    return list(itertools.islice(iterator, n))
+
+class AsyncPairtreeStorageClient(object):
+    """
+    An asyncio front end to L{PairtreeStorageClient}.
+
+    Calls are run on a thread pool of C{max_workers} threads, and at most
+    C{max_concurrency} of them (by default, the same number) are in flight for
+    this store at any time - the rest wait their turn without blocking the loop.
+    """
+    def __init__(self, uri_base=None, store_dir=None, shorty_length=2, hashing_type=None,
+                 client=None, max_workers=32, max_concurrency=None, executor=None, **kwargs):
+        """
+        Constructor - either pass the same arguments as for L{PairtreeStorageClient},
+        or an existing C{client} to wrap.
+
+        @param client: (Optional) An existing L{PairtreeStorageClient} to wrap
+        @type client: L{PairtreeStorageClient}
+        @param max_workers: (Optional) Size of the thread pool (if one is made)
+        @type max_workers: integer
+        @param max_concurrency: (Optional) Most calls in flight at once for this store
+        @type max_concurrency: integer
+        @param executor: (Optional) An executor to run calls on, instead of a new thread pool.
+        It is not shut down by L{close}.
+        @type executor: L{concurrent.futures.Executor}
+        """
+        if client is None:
+            client = PairtreeStorageClient(uri_base, store_dir, shorty_length, hashing_type, **kwargs)
+        self.fs = client
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self._executor = executor
+        self.max_concurrency = max_concurrency or max_workers
+        # made on first use, so that it belongs to the running loop
+        self._semaphore = None
+
+    @property
+    def uri_base(self):
+        return self.fs.uri_base
+
+    async def _run(self, func, *args, **kwargs):
+        """
+        Internal - run a blocking call on the executor, within the concurrency limit
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        """
+        Commit any batched writes and shut down the thread pool (if this client made it)
+        """
+        await self._run(self.fs.sync)
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def exists(self, id, path=None):
+        """
+        As L{PairtreeStorageClient.exists}
+        """
+        return await self._run(self.fs.exists, id, path)
+
+    async def isfile(self, id, filepath):
+        """
+        As L{PairtreeStorageClient.isfile}
+        """
+        return await self._run(self.fs.isfile, id, filepath)
+
+    async def isdir(self, id, filepath):
+        """
+        As L{PairtreeStorageClient.isdir}
+        """
+        return await self._run(self.fs.isdir, id, filepath)
+
+    async def stat(self, id, filepath):
+        """
+        As L{PairtreeStorageClient.stat}
+        """
+        return await self._run(self.fs.stat, id, filepath)
+
+    async def list_parts(self, id, path=None):
+        """
+        As L{PairtreeStorageClient.list_parts}
+        """
+        return await self._run(self.fs.list_parts, id, path)
+
+    async def list_ids(self, batch_size=1000, **kwargs):
+        """
+        As L{PairtreeStorageClient.list_ids}, but an async iterator. The walk is
+        advanced on the thread pool, C{batch_size} ids at a time.
+
+        >>> async for id in store.list_ids(prefix='ark:/13030/'):
+        ...     print(id)
+        """
+        ids = self.fs.list_ids(**kwargs)
+        while True:
+            batch = await self._run(_take, ids, batch_size)
+            if not batch:
+                return
+            for id in batch:
+                yield id
+
+    async def put_stream(self, id, path, stream_name, bytestream, buffer_size=None, atomic=None):
+        """
+        As L{PairtreeStorageClient.put_stream}. As well as a string of bytes or a
+        file-like object, C{bytestream} can be an async iterable of bytes.
+        """
+        if hasattr(bytestream, '__aiter__'):
+            return await self._put_chunks(id, path, stream_name, bytestream, buffer_size, atomic)
+        return await self._run(self.fs.put_stream, id, path, stream_name, bytestream, buffer_size, atomic)
+
+    async def _put_chunks(self, id, path, stream_name, chunks, buffer_size=None, atomic=None):
+        """
+        Internal - L{put_stream} from an async iterable. Chunks are gathered on the
+        loop, up to C{buffer_size} bytes at a time, and each lot is written on the
+        executor - no thread or concurrency slot is held while waiting for the
+        next chunk.
+        """
+        buffer_size = buffer_size or DEFAULT_CHUNK_SIZE
+        writer = await self._run(self.fs._open_part, id, path, stream_name, atomic)
+        failed = False
+        try:
+            buffered = []
+            size = 0
+            async for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    await self._run(writer.write, b"".join(buffered))
+                    buffered = []
+                    size = 0
+            if buffered:
+                await self._run(writer.write, b"".join(buffered))
+            await self._run(writer.flush)
+        except BaseException as e:
+            # as for PairtreeStorageClient.put_stream
+            if writer.atomic:
+                writer.abort()
+                raise
+            if not isinstance(e, Exception):
+                # cancelled - record what was written, without waiting on the executor
+                self.fs._close_part(id, path, stream_name, writer, True)
+                raise
+            logger.info("put_stream failed: %s" % e)
+            failed = True
+        return await self._run(self.fs._close_part, id, path, stream_name, writer, failed)
+
+    async def get_stream(self, id, path, stream_name):
+        """
+        As L{PairtreeStorageClient.get_stream}, reading the whole part in. Use
+        L{iter_stream} for large parts.
+        """
+        return await self._run(self.fs.get_stream, id, path, stream_name)
+
+    async def get_range(self, id, path, stream_name, offset, length=None):
+        """
+        As L{PairtreeStorageClient.get_range}
+        """
+        return await self._run(self.fs.get_range, id, path, stream_name, offset, length)
+
+    async def iter_stream(self, id, path, stream_name, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Read a part as an async iterator of chunks of up to C{chunk_size} bytes.
+
+        >>> async for chunk in store.iter_stream('foobar:1', 'data/images', 'image001.tif'):
+        ...     await response.write(chunk)
+        """
+        f = await self._run(self.fs.get_stream, id, path, stream_name, True)
+        try:
+            while True:
+                chunk = await self._run(f.read, chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            f.close()
+
+    async def del_stream(self, id, stream_name, path=None):
+        """
+        As L{PairtreeStorageClient.del_stream}
+        """
+        return await self._run(self.fs.del_stream, id, stream_name, path)
+
+    async def del_path(self, id, path, recursive=False):
+        """
+        As L{PairtreeStorageClient.del_path}
+        """
+        return await self._run(self.fs.del_path, id, path, recursive)
+
+    async def delete_object(self, id, fast=None):
+        """
+        As L{PairtreeStorageClient.delete_object}
+        """
+        return await self._run(self.fs.delete_object, id, fast)
+
+    async def get_object(self, id=None, create_if_doesnt_exist=True):
+        """
+        As L{PairtreeStorageClient.get_object}
+        @returns: L{AsyncPairtreeStorageObject}
+        """
+        obj = await self._run(self.fs.get_object, id, create_if_doesnt_exist)
+        return AsyncPairtreeStorageObject(obj, self)
+
+    async def create_object(self, id):
+        """
+        As L{PairtreeStorageClient.create_object}
+        @returns: L{AsyncPairtreeStorageObject}
+        """
+        obj = await self._run(self.fs.create_object, id)
+        return AsyncPairtreeStorageObject(obj, self)
+
+class AsyncPairtreeStorageObject(object):
+    """
+    The asyncio counterpart of L{PairtreeStorageObject}, as returned by
+    L{AsyncPairtreeStorageClient.get_object}. It shouldn't be instanciated directly.
+    """
+    def __init__(self, obj, async_store):
+        """
+        @param obj: The L{PairtreeStorageObject} to wrap
+        @param async_store: The L{AsyncPairtreeStorageClient} it came from
+        """
+        self.obj = obj
+        self.store = async_store
+        self.id = obj.id
+        self.uri = obj.uri
+        self.location = obj.location
+
+    async def add_bytestream(self, filename, bytestream, path=None, buffer_size=None):
+        """
+        As L{PairtreeStorageObject.add_bytestream}; C{bytestream} may also be an
+        async iterable of bytes.
+        """
+        return await self.store.put_stream(self.id, path, filename, bytestream, buffer_size)
+
+    async def add_file(self, from_file_location, path=None, new_filename=None, buffer_size=None):
+        """
+        As L{PairtreeStorageObject.add_file}
+        """
+        return await self.store._run(self.obj.add_file, from_file_location, path, new_filename, buffer_size)
+
+    async def get_bytestream(self, filename, path=None):
+        """
+        As L{PairtreeStorageObject.get_bytestream}, reading the whole part in
+        """
+        return await self.store.get_stream(self.id, path, filename)
+
+    async def get_range(self, filename, offset, length=None, path=None):
+        """
+        As L{PairtreeStorageObject.get_range}
+        """
+        return await self.store.get_range(self.id, path, filename, offset, length)
+
+    def iter_bytestream(self, filename, path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Read a part as an async iterator of chunks - see L{AsyncPairtreeStorageClient.iter_stream}
+        """
+        return self.store.iter_stream(self.id, path, filename, chunk_size)
+
+    async def del_file(self, filename, path=None):
+        """
+        As L{PairtreeStorageObject.del_file}
+        """
+        return await self.store.del_stream(self.id, filename, path)
+
+    async def del_path(self, subpath, recursive=False):
+        """
+        As L{PairtreeStorageObject.del_path}
+        """
+        return await self.store.del_path(self.id, subpath, recursive)
+
+    async def list_parts(self, path=None):
+        """
+        As L{PairtreeStorageObject.list_parts}
+        """
+        return await self.store.list_parts(self.id, path)
+
+    async def isfile(self, filepath):
+        """
+        As L{PairtreeStorageObject.isfile}
+        """
+        return await self.store.isfile(self.id, filepath)
+
+    async def isdir(self, filepath):
+        """
+        As L{PairtreeStorageObject.isdir}
+        """
+        return await self.store.isdir(self.id, filepath)
+
+    async def stat(self, filepath):
+        """
+        As L{PairtreeStorageObject.stat}
+        """
+        return await self.store.stat(self.id, filepath)
@@ -23,8 +23,20 @@ I{http://example.org/ark:/123}
 
 import os, shutil
 
+from stat import S_ISREG
+
+from mmap import mmap as MemoryMap, ACCESS_READ
+
 import random
 
+import queue
+
+import threading
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
 import re
 
 from pairtree.storage_exceptions import *
@@ -33,14 +45,65 @@ from pairtree.pairtree_object import PairtreeStorageObject
 
 from pairtree import pairtree_path as ppath
 
-import hashlib
+from pairtree import myutils
 
-import logging
+from pairtree.pairtree_index import PairtreeIndex, PAIRTREE_INDEX
 
-logging.basicConfig(level=logging.INFO)
+from pairtree.pairtree_fixity import FixityDB, FixityAudit, PAIRTREE_FIXITY
+
+from pairtree.pairtree_fixity import ChecksumCache, PAIRTREE_CHECKSUMS, hash_file
+
+from pairtree.pairtree_manifest import ObjectManifest, ObjectWalk, is_object_path
+
+from pairtree.pairtree_trash import Reaper, PAIRTREE_TRASH, remove_tree
+
+from pairtree.pairtree_metrics import instrument, CLIENT_OPERATIONS
+
+import logging
 
 logger = logging.getLogger('pairtreeclient')
 
+FSYNC_POLICIES = (None, 'always', 'batch')
+
+TEMP_PREFIX = myutils.TEMP_PREFIX
+
+class _AppendableStream(object):
+    """
+    Internal - the file returned by L{PairtreeStorageClient.get_appendable_stream}.
+    It behaves as the file it wraps, but when it is closed, the object's cached
+    manifest is dropped and its size in the index adjusted, as the appends may
+    have changed both.
+    """
+    def __init__(self, f, store, id):
+        self._file = f
+        self._store = store
+        self._id = id
+        self._size = os.fstat(f.fileno()).st_size
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._file.flush()
+            size = os.fstat(self._file.fileno()).st_size
+        finally:
+            self._file.close()
+            self._store._manifests.pop(self._id)
+        if self._store.index is not None:
+            self._store.index.add_size(self._id, size - self._size)
+
 class PairtreeStorageClient(object):
     """A client that oversees the implementation of the Pairtree FS specification
     version 0.1.
@@ -69,7 +132,10 @@ class PairtreeStorageClient(object):
     Also, if you try to create a store over a directory that already exists, but which isn't
     a pairtree store that it can recognise, it will raise a L{NotAPairtreeStoreException}.
     """
-    def __init__(self, uri_base, store_dir, shorty_length=2, hashing_type=None):
+    def __init__(self, uri_base, store_dir, shorty_length=2, hashing_type=None, cache_size=1024, index=False,
+                 atomic_writes=False, fsync=None, fsync_batch_size=100, fsync_batch_delay=1.0, fixity=False,
+                 checksum_cache=0, hash_thread=False, manifest_cache=0, fast_delete=False, reaper_threads=2,
+                 observer=None):
         """
         Constructor
         @param store_dir: The file directory where the pairtree store is
@@ -78,9 +144,52 @@ class PairtreeStorageClient(object):
         @type uri_base: A URI fragment, like "http://example.org/"
         @param shorty_length: The size of the shorties in the pairtree implementation (Default: 2)
         @type shorty_length: integer
-        @param hashing_type: The name of the algorithm to use when hashing files, if left as None, this is disabled.
-        @type hashing_type: Any supported by C{hashlib}
+        @param hashing_type: The name of the algorithm to use when hashing files, or a list
+        of them to compute in a single pass. If left as None, this is disabled.
+        @type hashing_type: Any supported by C{hashlib}, or a list of them
+        @param cache_size: (Optional) How many id to directory path resolutions to keep
+        in memory (and the same again for the reverse mapping). 0 disables the cache.
+        @type cache_size: integer
+        @param index: (Optional) If True, keep a L{PairtreeIndex} of the objects in the store
+        next to the pairtree_prefix file, and use it to answer L{list_ids} and L{count_objects}
+        @type index: bool
+        @param atomic_writes: (Optional) If True, L{put_stream} writes each part to a temporary
+        file next to it and renames it into place, so readers never see a part half written.
+        @type atomic_writes: bool
+        @param fsync: (Optional) Durability policy for writes - None leaves it to the OS,
+        'always' fsyncs every part (and its directory) before returning, 'batch' groups
+        them - see L{myutils.FsyncBatcher} and L{sync}.
+        @type fsync: None|'always'|'batch'
+        @param fsync_batch_size: (Optional) With fsync='batch', most writes to group together
+        @type fsync_batch_size: integer
+        @param fsync_batch_delay: (Optional) With fsync='batch', longest a write waits (seconds)
+        @type fsync_batch_delay: float
+        @param fixity: (Optional) If True, record the checksum of every part written in a
+        L{FixityDB} next to the pairtree_prefix file, so that the store can be L{audit}ed.
+        Needs a C{hashing_type}.
+        @type fixity: bool
+        @param checksum_cache: (Optional) Keep up to this many part checksums in a persistent
+        L{ChecksumCache}, so that L{checksum} only rehashes parts that have changed. 0 disables it.
+        @type checksum_cache: integer
+        @param hash_thread: (Optional) Hash on helper threads, overlapping the hashing with the writes
+        @type hash_thread: bool
+        @param manifest_cache: (Optional) Keep an L{ObjectManifest} of up to this many objects in
+        memory, and answer L{list_parts}, L{isfile}, L{isdir} and L{stat} from them. 0 disables it.
+        @type manifest_cache: integer
+        @param fast_delete: (Optional) If True, L{delete_object} renames objects into the store's
+        trash directory and a L{Reaper} removes them in the background. Anything left in the
+        trash by an earlier process is removed too.
+        @type fast_delete: bool
+        @param reaper_threads: (Optional) Number of threads to empty the trash with
+        @type reaper_threads: integer
+        @param observer: (Optional) Report the time taken by each operation, and the bytes and
+        system calls it used, to this L{Observer} - see L{pairtree_metrics}
+        @type observer: L{Observer}
         """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s" % (FSYNC_POLICIES,))
+        if fixity and not hashing_type:
+            raise ValueError("fixity needs a hashing_type to record checksums with")
         self.store_dir = store_dir
         self.pairtree_root = os.path.join(self.store_dir, 'pairtree_root')
         self.uri_base = None
@@ -88,11 +197,40 @@ class PairtreeStorageClient(object):
             self.uri_base = uri_base
         self.shorty_length = shorty_length
         self.hashing_type = hashing_type
+        self.hashing_types = myutils.hashing_types(hashing_type)
+        self.hash_thread = hash_thread
+        self.atomic_writes = atomic_writes
+        self.fsync = fsync
+        self._fsync_batch = myutils.FsyncBatcher(fsync_batch_size, fsync_batch_delay)
         # regexes
         self._encode = re.compile(r"[\"*+,<=>?\\^|]|[^\x21-\x7e]", re.U)
         self._decode = re.compile(r"\^(..)", re.U)
-        
+        # id -> (shorty list, dirpath) and dirpath -> id
+        self._dirpath_cache = myutils.LRUCache(cache_size)
+        self._id_cache = myutils.LRUCache(cache_size)
+        # id -> ObjectManifest
+        self._manifests = myutils.LRUCache(manifest_cache)
+
         self._init_store()
+        self.index = None
+        if index:
+            self.index = PairtreeIndex(os.path.join(self.store_dir, PAIRTREE_INDEX))
+        self.fixity = None
+        if fixity:
+            self.fixity = FixityDB(os.path.join(self.store_dir, PAIRTREE_FIXITY))
+        self.checksums = None
+        if checksum_cache:
+            self.checksums = ChecksumCache(os.path.join(self.store_dir, PAIRTREE_CHECKSUMS), checksum_cache)
+        self.fast_delete = fast_delete
+        self.reaper_threads = reaper_threads
+        self.trash_dir = os.path.join(self.store_dir, PAIRTREE_TRASH)
+        self._reaper = None
+        self._reaper_lock = threading.Lock()
+        if fast_delete and os.path.isdir(self.trash_dir):
+            self._get_reaper().reap_all()
+        self.observer = observer
+        if observer is not None:
+            instrument(self, observer, CLIENT_OPERATIONS)
 
     def __char2hex(self, m):
         return ppath.char2hex(m)
@@ -171,7 +309,11 @@ class PairtreeStorageClient(object):
         """
         #path = self._get_path_from_dirpath(dirpath)
         #return self.id_decode("".join(path))
-        return ppath.get_id_from_dirpath(dirpath, self.pairtree_root)
+        id = self._id_cache.get(dirpath)
+        if id is None:
+            id = ppath.get_id_from_dirpath(dirpath, self.pairtree_root)
+            self._id_cache[dirpath] = id
+        return id
 
     def _get_path_from_dirpath(self, dirpath):
         """
@@ -203,7 +345,7 @@ class PairtreeStorageClient(object):
         @returns: A directory path to the object's root directory
         """
 #        return os.sep.join(self._id_to_dir_list(id))
-        return ppath.id_to_dirpath(id, self.pairtree_root, self.shorty_length)
+        return self._resolve(id)[1]
 
     def _id_to_dir_list(self, id):
         """
@@ -222,7 +364,70 @@ class PairtreeStorageClient(object):
 #            dirpath.append(enc_id[:self.shorty_length])
 #            enc_id = enc_id[self.shorty_length:]
 #        return dirpath
-        return ppath.id_to_dir_list(id, self.pairtree_root, self.shorty_length)
+        return list(self._resolve(id)[0])
+
+    def _resolve(self, id):
+        """
+        Internal - the memoised form of L{_id_to_dir_list} and L{_id_to_dirpath}.
+
+        @param id: Identifer for a pairtree object
+        @type id: identifier
+        @returns: tuple C{(shorties, dirpath)}
+        """
+        entry = self._dirpath_cache.get(id)
+        if entry is None:
+            shorties = tuple(ppath.id_to_dir_list(id, self.pairtree_root, self.shorty_length))
+            entry = (shorties, os.sep.join(shorties))
+            self._dirpath_cache[id] = entry
+            self._id_cache[entry[1]] = id
+        return entry
+
+    def _forget(self, id):
+        """
+        Internal - drop an identifier from the id <-> dirpath caches.
+
+        @param id: Identifer for a pairtree object
+        @type id: identifier
+        """
+        entry = self._dirpath_cache.pop(id)
+        if entry is not None:
+            self._id_cache.pop(entry[1])
+        self._manifests.pop(id)
+
+    def _manifest(self, id):
+        """
+        Internal - the L{ObjectManifest} of an object, from the manifest cache if it
+        is still current, otherwise freshly taken (and cached).
+
+        @param id: Identifer for a pairtree object
+        @type id: identifier
+        @returns: L{ObjectManifest}, or None if the cache is disabled or the object doesn't exist
+        """
+        if not self._manifests.maxsize:
+            return None
+        manifest = self._manifests.get(id)
+        if manifest is not None and manifest.is_current():
+            return manifest
+        try:
+            manifest = ObjectManifest(self._id_to_dirpath(id), self.shorty_length)
+        except OSError:
+            self._manifests.pop(id)
+            return None
+        self._manifests[id] = manifest
+        return manifest
+
+    def cache_info(self):
+        """
+        Hit and miss counters for the id -> dirpath and dirpath -> id caches,
+        and the manifest cache.
+
+        >>> store.cache_info()
+        {'dirpath': {'hits': 41, 'misses': 2, 'size': 2, 'maxsize': 1024}, 'id': {...}, 'manifest': {...}}
+
+        @returns: L{dict}
+        """
+        return {"dirpath":self._dirpath_cache.info(), "id":self._id_cache.info(),
+                "manifest":self._manifests.info()}
         
     def _init_store(self):
         """
@@ -264,7 +469,7 @@ class PairtreeStorageClient(object):
         if not os.path.isdir(self.store_dir):
             raise NotAPairtreeStoreException
 
-    def list_ids(self):
+    def list_ids(self, threads=None, shard=None, num_shards=None, prefix=None, start=None, stop=None):
         """
         Walk the store, and build a list of pairtree conformational objects in the
         store. This will return objects in 'split-ends' and will function correctly
@@ -289,26 +494,385 @@ class PairtreeStorageClient(object):
         
         Returns a generator, not a plain list since version 0.4.12
 
+        If C{threads} is set, the top level shorty directories are walked concurrently
+        by that many threads, and ids are yielded as they are found (in no particular
+        order).
+
+        If the store keeps an index, the ids are read from that instead (in order)
+        unless C{threads} or C{num_shards} are given. Either way, an object is only
+        listed once it has a part - one created with L{create_object} and left empty
+        isn't, as nothing in the tree tells it apart from a shorty directory.
+
+        To share an enumeration out between several processes or hosts, each can
+        be given its own C{shard} (counting from 0) of C{num_shards} - see
+        L{partitions}. Every object appears in exactly one shard:
+
+        >>> ids = store.list_ids(shard=2, num_shards=8)
+
+        C{shard} and C{num_shards} must be given together, with C{0 <= shard < num_shards},
+        or a ValueError is raised.
+
+        Giving a C{prefix}, or a C{start} and/or C{stop}, restricts the ids to those
+        starting with C{prefix}, and those from C{start} up to (but not including)
+        C{stop}. Only the matching parts of the tree are walked - the prefix is
+        encoded and the walk goes straight to its shorty directory. Results come
+        in lexicographic order of their encoded form, which is the order of the
+        tree itself (and of the index); ranges are compared in the same form.
+
+        >>> list(store.list_ids(prefix="ark:/13030/xt"))
+        ['ark:/13030/xt12t3', 'ark:/13030/xt12t4']
+
+        @param threads: (Optional) Number of threads to walk the store with
+        @type threads: integer
+        @param shard: (Optional) Which shard of the store to walk
+        @type shard: integer
+        @param num_shards: (Optional) How many shards the store is split into
+        @type num_shards: integer
+        @param prefix: (Optional) Only list ids starting with C{prefix}
+        @type prefix: identifier
+        @param start: (Optional) Only list ids from C{start} onwards
+        @type start: identifier
+        @param stop: (Optional) Only list ids before C{stop}
+        @type stop: identifier
         @returns: L{generator}
         """
+        ranged = prefix is not None or start is not None or stop is not None
+        if ranged and (threads or num_shards):
+            raise ValueError("prefix and range queries cannot be combined with threads or shards")
+        if shard is not None or num_shards is not None:
+            if shard is None or not num_shards or not 0 <= shard < num_shards:
+                raise ValueError("shard must be given with num_shards, and be from 0 to num_shards - 1")
+        if self.index is not None and not threads and not num_shards:
+            for id in self.index.ids(prefix, start, stop):
+                yield id
+            return
+        if ranged:
+            for encoded, _ in self._walk_range(prefix, start, stop):
+                yield ppath.id_decode(encoded)
+            return
+        if num_shards:
+            units = self.partitions(num_shards)[shard]
+        else:
+            units = [(x, True) for x in self._list_shorties(self.pairtree_root)]
+        if threads:
+            walk = self._walk_units_threaded(units, threads)
+        else:
+            walk = (found for unit in units for found in self._walk_unit(unit))
+        for encoded, _ in walk:
+            yield ppath.id_decode(encoded)
 
-        objects = set()
-        paths = [os.path.join(self.pairtree_root, x) for x in os.listdir(self.pairtree_root) if os.path.isdir(os.path.join(self.pairtree_root, x))]
-        d = None
-        if paths:
-            d = paths.pop()
-        while d:
-            for t in os.listdir(d):
-                if len(t)>self.shorty_length:
-                    if self._get_id_from_dirpath(d) not in objects:
-                        objects.add(self._get_id_from_dirpath(d))
-                        yield self._get_id_from_dirpath(d)
-                elif os.path.isdir(os.path.join(d, t)):
-                    paths.append(os.path.join(d, t))
-            if paths:
-                d = paths.pop()
-            else:
-                d =False
+    def _walk_range(self, prefix=None, start=None, stop=None):
+        """
+        Internal - ordered walk of the ids starting with C{prefix} and in the range
+        C{[start, stop)}, descending directly to the prefix's shorty directory.
+
+        @returns: L{generator} of C{(encoded_id, dirpath)} tuples
+        """
+        if start is not None:
+            start = ppath.id_encode(start)
+        if stop is not None:
+            stop = ppath.id_encode(stop)
+        shorties = []
+        if prefix:
+            shorties = ppath.id_to_dir_list(prefix, "", self.shorty_length)
+        partial = ""
+        if shorties and len(shorties[-1]) < self.shorty_length:
+            partial = shorties.pop()
+        dirpath = os.path.join(self.pairtree_root, *shorties)
+        encoded = "".join(shorties)
+        if not partial:
+            if stop is not None and encoded and encoded >= stop:
+                # everything below sorts at or after the prefix
+                return iter(())
+            return self._walk_ids(dirpath, encoded, sort=True, start=start, stop=stop)
+        # the prefix ends part way through a shorty - walk each matching child
+        children = [x for x in self._list_shorties(dirpath) if x.startswith(partial)
+                    and (stop is None or encoded + x < stop)
+                    and (start is None or encoded + x >= start[:len(encoded + x)])]
+        return (found for child in children
+                for found in self._walk_ids(os.path.join(dirpath, child), encoded + child,
+                                            sort=True, start=start, stop=stop))
+
+    def count_objects(self):
+        """
+        The number of objects in the store - from the index, if there is one,
+        otherwise by walking the store.
+
+        @returns: L{int}
+        """
+        if self.index is not None:
+            return self.index.count()
+        return sum(1 for _ in self._walk_ids(self.pairtree_root, ""))
+
+    def rebuild_index(self):
+        """
+        Rebuild the object index from a walk of the tree, eg after a crash. The
+        creation time of each object is taken from its directory's ctime.
+
+        If this client wasn't keeping an index, it starts to.
+        """
+        if self.index is None:
+            self.index = PairtreeIndex(os.path.join(self.store_dir, PAIRTREE_INDEX))
+        def entries():
+            for encoded, dirpath in self._walk_ids(self.pairtree_root, ""):
+                yield (ppath.id_decode(encoded), os.stat(dirpath).st_ctime, self._object_size(dirpath))
+        self.index.rebuild(entries())
+
+    def audit(self, algo=None, processes=None, full=False, resume=False, max_rate=None, record_extra=False):
+        """
+        Check the parts in the store against their recorded checksums (see the
+        C{fixity} option). Iterate over the result to run the audit:
+
+        >>> for problem in store.audit(processes=8, max_rate=100 * 1024 * 1024):
+        ...     print(problem.kind, problem.id, problem.part, problem.expected, problem.actual)
+
+        Parts whose size and modification time haven't changed since they were last
+        verified are not hashed again, unless C{full} is set. See L{FixityAudit}.
+
+        @param algo: (Optional) Algorithm to check (Default: the store's first C{hashing_type})
+        @param processes: (Optional) Number of processes to hash with
+        @type processes: integer
+        @param full: (Optional) Hash every part, even those that look unchanged
+        @type full: bool
+        @param resume: (Optional) Carry on from where an interrupted audit stopped
+        @type resume: bool
+        @param max_rate: (Optional) Most bytes a second to read from the disc
+        @type max_rate: integer
+        @param record_extra: (Optional) Record checksums for parts that have none
+        @type record_extra: bool
+        @returns: L{FixityAudit}
+        """
+        return FixityAudit(self, algo, processes, full, resume, max_rate, record_extra)
+
+    def _has_parts(self, dirpath):
+        """
+        Internal - whether the object directory C{dirpath} holds anything of its own,
+        which is what makes L{_walk_ids} count it as an object
+
+        @returns: L{bool}
+        """
+        try:
+            with os.scandir(dirpath) as entries:
+                return any(len(entry.name) > self.shorty_length and not entry.name.startswith(TEMP_PREFIX)
+                           for entry in entries)
+        except OSError:
+            return False
+
+    def _object_size(self, dirpath):
+        """
+        Internal - total size in bytes of the parts of the object at C{dirpath},
+        not counting any shorty directories belonging to other objects.
+
+        @param dirpath: The object's root directory
+        @type dirpath: Directory path
+        @returns: L{int}
+        """
+        return ObjectWalk(dirpath, self.shorty_length).total()
+
+    def partitions(self, n, sample_depth=2, granularity=4):
+        """
+        Split the store into C{n} disjoint sets of work units, of roughly equal size,
+        which can be walked independently (see C{list_ids(shard=i, num_shards=n)}).
+
+        A work unit is a tuple C{(shorty_path, recursive)}: the directory C{shorty_path},
+        relative to the pairtree_root, and if C{recursive} is True, everything below it.
+        The sizes of the subtrees are estimated by counting the shorty directories
+        in their top C{sample_depth} levels. The heaviest subtrees are split into
+        their children until there are about C{n * granularity} units, which are
+        then dealt out, largest first, to whichever partition is lightest.
+
+        The result only depends on the state of the tree, so every worker that
+        calls this on the same store gets the same answer. If objects are being
+        added or removed while the workers start up, they may disagree.
+
+        >>> store.partitions(2)
+        [[('ab', True), ('cd', False), ('cd/ef', True)], [('cd/gh', True), ('xy', True)]]
+
+        @param n: Number of partitions
+        @type n: integer
+        @param sample_depth: (Optional) Levels of each subtree to sample when sizing it
+        @type sample_depth: integer
+        @param granularity: (Optional) Target number of work units per partition
+        @type granularity: integer
+        @returns: L{list} of C{n} lists of work units
+        """
+        units = [(x, True) for x in self._list_shorties(self.pairtree_root)]
+        weights = dict((unit, self._sample_weight(unit[0], sample_depth)) for unit in units)
+        while len(units) < n * granularity:
+            splittable = [x for x in units if x[1] and weights[x] > 1]
+            if not splittable:
+                break
+            heaviest = max(splittable, key=lambda x: (weights[x], x))
+            units.remove(heaviest)
+            node = (heaviest[0], False)
+            units.append(node)
+            weights[node] = 1
+            for child in self._list_shorties(os.path.join(self.pairtree_root, heaviest[0])):
+                unit = (os.path.join(heaviest[0], child), True)
+                units.append(unit)
+                weights[unit] = self._sample_weight(unit[0], sample_depth)
+        partitions = [[] for _ in range(n)]
+        loads = [0] * n
+        for unit in sorted(units, key=lambda x: (-weights[x], x)):
+            lightest = loads.index(min(loads))
+            partitions[lightest].append(unit)
+            loads[lightest] += weights[unit]
+        for partition in partitions:
+            partition.sort()
+        return partitions
+
+    def _list_shorties(self, dirpath):
+        """
+        Internal - sorted names of the shorty directories directly inside C{dirpath}
+
+        @param dirpath: Directory to look in
+        @type dirpath: Directory path
+        @returns: L{list}
+        """
+        try:
+            with os.scandir(dirpath) as entries:
+                return sorted(x.name for x in entries if len(x.name) <= self.shorty_length and x.is_dir())
+        except OSError:
+            return []
+
+    def _sample_weight(self, shorty_path, depth):
+        """
+        Internal - estimate the size of the subtree at C{shorty_path} (relative to the
+        pairtree_root) as the number of shorty directories in its top C{depth} levels.
+
+        @returns: L{int}, at least 1
+        """
+        weight = 1
+        level = [os.path.join(self.pairtree_root, shorty_path)]
+        for _ in range(depth):
+            level = [os.path.join(d, x) for d in level for x in self._list_shorties(d)]
+            weight += len(level)
+        return weight
+
+    def _walk_unit(self, unit):
+        """
+        Internal - L{_walk_ids} over a single work unit from L{partitions}
+
+        @param unit: C{(shorty_path, recursive)}
+        @type unit: tuple
+        @returns: L{generator} of C{(encoded_id, dirpath)} tuples
+        """
+        shorty_path, recursive = unit
+        return self._walk_ids(os.path.join(self.pairtree_root, shorty_path),
+                              shorty_path.replace(os.sep, ""), recursive=recursive)
+
+    def _walk_ids(self, dirpath, encoded, sort=False, recursive=True, start=None, stop=None):
+        """
+        Internal - depth first walk of the shorty directories below C{dirpath},
+        which holds the (possibly partial) encoded id C{encoded}. The encoded id
+        of each directory is built up from the shorties on the way down rather
+        than recovered from the path afterwards.
+
+        Uses C{os.scandir}, so on most filesystems telling shorty directories apart
+        from files needs no extra C{stat} calls.
+
+        @param dirpath: Directory to start from
+        @type dirpath: Directory path
+        @param encoded: The encoded id that C{dirpath} corresponds to
+        @type encoded: string
+        @param sort: If True, yield in order of encoded id
+        @type sort: bool
+        @param recursive: If False, only C{dirpath} itself is looked at
+        @type recursive: bool
+        @param start: (Optional) Only yield encoded ids C{>= start}
+        @type start: string
+        @param stop: (Optional) Only yield encoded ids C{< stop}
+        @type stop: string
+        @returns: L{generator} of C{(encoded_id, dirpath)} tuples
+        """
+        stack = [(dirpath, encoded)]
+        while stack:
+            dirpath, encoded = stack.pop()
+            is_object = False
+            children = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if len(entry.name) > self.shorty_length:
+                            # a pending atomic or batched write isn't a part yet
+                            if not entry.name.startswith(TEMP_PREFIX):
+                                is_object = True
+                        elif recursive and entry.is_dir():
+                            child = encoded + entry.name
+                            # skip subtrees lying wholly outside [start, stop)
+                            if start is not None and child < start[:len(child)]:
+                                continue
+                            if stop is not None and child >= stop:
+                                continue
+                            children.append((entry.path, child))
+            except OSError:
+                # removed while we were walking
+                continue
+            if (is_object and encoded and (start is None or encoded >= start)
+                    and (stop is None or encoded < stop)):
+                yield encoded, dirpath
+            if sort:
+                # popped off the end, so reversed to come out in order
+                children.sort(key=lambda x: x[1], reverse=True)
+            stack.extend(children)
+
+    def _walk_units_threaded(self, units, threads, batch_size=1000):
+        """
+        Internal - L{_walk_unit} over each work unit, run on a pool of C{threads}
+        threads. Found ids are passed back through a bounded queue in batches, so
+        a slow consumer holds up the walkers rather than letting results pile up
+        in memory.
+
+        @param units: Work units, as from L{partitions}
+        @type units: list
+        @param threads: Number of walker threads
+        @type threads: integer
+        @returns: L{generator} of C{(encoded_id, dirpath)} tuples
+        """
+        results = queue.Queue(threads * 4)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walk(unit):
+            try:
+                batch = []
+                for found in self._walk_unit(unit):
+                    batch.append(found)
+                    if len(batch) >= batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                put(batch)
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        executor = ThreadPoolExecutor(threads)
+        try:
+            for unit in units:
+                executor.submit(walk, unit)
+            remaining = len(units)
+            while remaining:
+                batch = results.get()
+                if batch is None:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    for found in batch:
+                        yield found
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
 
     def _create(self, id):
         """
@@ -319,11 +883,13 @@ class PairtreeStorageClient(object):
         @type id: identifier
         @returns: L{PairtreeStorageObject}
         """
-        dirpath = os.path.join(self._id_to_dirpath(id))
+        dirpath = self._id_to_dirpath(id)
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
         else:
             raise ObjectAlreadyExistsException
+        # not indexed until it has a part - until then, a walk of the tree can't see it either
+        self._manifests.pop(id)
         return PairtreeStorageObject(id, self, dirpath)
 
     def list_parts(self, id, path=None):
@@ -335,6 +901,9 @@ class PairtreeStorageClient(object):
 
         If the subpath doesn't exist, a L{ObjectNotFoundException} will be raised.
 
+        With the C{manifest_cache} option, the listing comes from the object's
+        L{ObjectManifest}.
+
         >>> store.list_parts('foobar:1', 'data/images')
         [ 'image001.tif', 'image....    ]
 
@@ -344,12 +913,47 @@ class PairtreeStorageClient(object):
         @type path: Directory path
         @returns: L{list}
         """
-        dirpath = os.path.join(self._id_to_dirpath(id))
+        manifest = self._manifest(id)
+        if manifest is not None:
+            names = manifest.listdir(path)
+            if names is not None:
+                if path:
+                    names = [x for x in names if len(x)>self.shorty_length]
+                return names
+        dirpath = self._id_to_dirpath(id)
         if path:
-            dirpath = os.path.join(self._id_to_dirpath(id), path)
+            dirpath = os.path.join(dirpath, path)
         if not os.path.exists(dirpath):
             raise ObjectNotFoundException
-        return [x for x in os.listdir(dirpath) if len(x)>self.shorty_length]
+        return [x for x in os.listdir(dirpath) if len(x)>self.shorty_length and not x.startswith(TEMP_PREFIX)]
+
+    def walk_parts(self, id, path=None):
+        """
+        Walk every part of an object, in any subdirectory, with one C{scandir}
+        per directory (skipping shortie directories belonging to other objects).
+
+        >>> walk = store.walk_parts('foobar:1')
+        >>> for part, st in walk:
+        ...     print(part, st.st_size)
+        data/images/image001.tif 1048576
+        ...
+        >>> walk.parts, walk.size
+        (1200, 1310720000)
+
+        @param id: Identifier for pairtree object
+        @type id: identifier
+        @param path: (Optional) Only walk the parts in C{path}'s subdirectory. The
+        part paths are still relative to the object's root. A path into the shorty
+        directory of another object raises L{ObjectNotFoundException}.
+        @type path: Directory path
+        @returns: L{ObjectWalk} of C{(part path, os.stat_result)}
+        """
+        dirpath = self._id_to_dirpath(id)
+        if path and not is_object_path(os.path.normpath(path), self.shorty_length):
+            raise ObjectNotFoundException
+        if not os.path.isdir(os.path.join(dirpath, path) if path else dirpath):
+            raise ObjectNotFoundException
+        return ObjectWalk(dirpath, self.shorty_length, path)
 
     def isfile(self, id, filepath):
         """
@@ -361,6 +965,9 @@ class PairtreeStorageClient(object):
         @type filepath: Directory path
         @returns: L{bool}
         """
+        manifest = self._manifest(id)
+        if manifest is not None and manifest.covers(filepath):
+            return manifest.isfile(filepath)
         dirpath = os.path.join(self._id_to_dirpath(id), filepath)
         try:
             return os.path.isfile(dirpath)
@@ -377,6 +984,9 @@ class PairtreeStorageClient(object):
         @type filepath: Directory path
         @returns: L{bool}
         """
+        manifest = self._manifest(id)
+        if manifest is not None and manifest.covers(filepath):
+            return manifest.isdir(filepath)
         dirpath = os.path.join(self._id_to_dirpath(id), filepath)
         try:
             return os.path.isdir(dirpath)
@@ -393,18 +1003,93 @@ class PairtreeStorageClient(object):
         @type filepath: Directory path
         @returns L{posix.stat_result} or False
         """
-        if self.isfile(id, filepath):
-            return os.stat(os.path.join(self._id_to_dirpath(id), filepath))
-        else:
+        manifest = self._manifest(id)
+        if manifest is not None and manifest.covers(filepath):
+            st = manifest.get(filepath)
+            if st is not None and S_ISREG(st.st_mode):
+                return st
+            return False
+        return self._stat(id, filepath)
+
+    def _stat(self, id, filepath):
+        """
+        Internal - L{stat}, always from the filesystem
+        """
+        try:
+            st = os.stat(os.path.join(self._id_to_dirpath(id), filepath))
+        except OSError:
             return False
+        if S_ISREG(st.st_mode):
+            return st
+        return False
 
-    def put_stream(self, id, path, stream_name, bytestream, buffer_size = 1024 * 8):
+    def checksum(self, id, filepath, algo=None):
+        """
+        The checksum of a part. If the store keeps a L{ChecksumCache} (see the
+        C{checksum_cache} option) and the part's inode, size and modification time
+        are the same as when it was last hashed (or written), the cached checksum
+        is returned without reading the part. Parts modified within
+        C{RACY_WINDOW_NS} of being hashed aren't cached.
+
+        >>> store.checksum('foobar:1', 'data/images/image001.tif', 'sha256')
+        '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+
+        @param id: id of the object
+        @type id: string
+        @param filepath: Path of the part within the object
+        @type filepath: Directory path
+        @param algo: (Optional) Hashing algorithm (Default: the store's first C{hashing_type})
+        @type algo: Any supported by C{hashlib}
+        @returns: hex digest
+        """
+        if not algo and self.hashing_types:
+            algo = self.hashing_types[0]
+        if not algo:
+            raise ValueError("no hashing algorithm given, and the store has no hashing_type")
+        st = self._stat(id, filepath)
+        if not st:
+            raise PartNotFoundException(id=id, path=filepath)
+        if self.checksums is not None:
+            checksum = self.checksums.get(st, algo)
+            if checksum is not None:
+                return checksum
+        file_path = os.path.join(self._id_to_dirpath(id), filepath)
+        started_ns = time.time_ns()
+        checksum = hash_file(file_path, algo)
+        if self.checksums is not None:
+            after = os.stat(file_path)
+            # only cache it if the part didn't change while it was being read, and
+            # couldn't still change without its mtime moving on
+            if (after.st_ino, after.st_size, after.st_mtime_ns) == (st.st_ino, st.st_size, st.st_mtime_ns) \
+                    and st.st_mtime_ns < started_ns - myutils.RACY_WINDOW_NS:
+                self.checksums.put(st, algo, checksum)
+        return checksum
+
+    def put_stream(self, id, path, stream_name, bytestream, buffer_size=None, atomic=None):
         """
         Store a stream of bytes into a file within a pairtree object.
 
         Can be either a string of bytes, or a filelike object which supports
         bytestream.read(buffer_size) - useful for very large files.
 
+        All of the store's hashing types are computed in the same pass over the
+        data - on helper threads, alongside the write, if C{hash_thread} is set.
+
+        If the filelike object is a real file on disc and hashing is disabled, the
+        bytes are copied by the kernel (C{copy_file_range} or C{sendfile}) without
+        passing through python at all. Otherwise they are read into a reusable
+        buffer, which grows with the stream unless C{buffer_size} is set.
+
+        With atomic writes (see the C{atomic_writes} option), the part is streamed
+        into a temporary file in the same directory, which then replaces the part
+        with C{os.replace} - concurrent readers see either the old part or the new
+        one, never a truncated one. If the write fails the temporary file is
+        removed, the old part is left as it was, and the error is raised. (Without
+        atomic writes, failures are only logged, as they always have been.)
+
+        With fsync='batch', the rename is deferred until the batch is committed, so
+        the new part isn't visible until then - see L{sync}.
+
         @param id: Identifier for the pairtree object to write to
         @type id: identifier
         @param path: (Optional) subdirectory path to store file in
@@ -413,19 +1098,17 @@ class PairtreeStorageClient(object):
         @type stream_name: filename
         @param bytestream: Either a string or a file-like object to read from
         @type bytestream: string|file
-        @param buffer_size: (Optional) Used for streaming filelike objects - defines the size of the buffer
+        @param buffer_size: (Optional) Used for streaming filelike objects - fixes the size of the buffer
         to read in each cycle.
         @type buffer_size: integer
-        @returns: tuple C{(hashing_algorithm, hash)} or None if hashing is disabled
+        @param atomic: (Optional) Override the store's C{atomic_writes} setting for this write
+        @type atomic: bool
+        @returns: L{dict} C{{"checksum":hash, "type":algorithm, "checksums":{algorithm:hash, ...}}}
+        or None if hashing is disabled. C{checksum} and C{type} are for the first of the
+        store's hashing types; C{checksums} holds them all.
         """
-        dirpath = os.path.join(self._id_to_dirpath(id))
-        if path:
-            dirpath = os.path.join(self._id_to_dirpath(id), path)
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
-        f = open(os.path.join(dirpath, stream_name), "wb")
-        if self.hashing_type != None:
-            hash_gen = getattr(hashlib, self.hashing_type)()
+        writer = self._open_part(id, path, stream_name, atomic)
+        failed = False
         try:
             # Stream file-like objects in with buffered reads
             if hasattr(bytestream, 'read'):
@@ -434,23 +1117,152 @@ class PairtreeStorageClient(object):
                     bytestream.seek(0)
                 except:
                     pass
-                if not buffer_size:
-                    buffer_size = 1024 * 8
-                chunk = bytestream.read(buffer_size)
-                while chunk:
-                    f.write(chunk)
-                    if self.hashing_type != None:
-                        hash_gen.update(chunk)
-                    chunk = bytestream.read(buffer_size)
+                writer.copy(bytestream, buffer_size)
             else:
-                f.write(bytestream)
-                if self.hashing_type != None:
-                    hash_gen.update(bytestream)
+                writer.write(bytestream)
+            writer.flush()
         except Exception as e:
+            if writer.atomic:
+                writer.abort()
+                raise
             logger.info("put_stream failed: %s" % e)
-        f.close()
-        if self.hashing_type != None:
-            return {"checksum":hash_gen.hexdigest(), "type":self.hashing_type}
+            failed = True
+        return self._close_part(id, path, stream_name, writer, failed)
+
+    def _open_part(self, id, path, stream_name, atomic=None):
+        """
+        Internal - start writing a part, making its directory if need be. The data
+        is written to the L{myutils.PartWriter} returned, which is then handed to
+        L{_close_part} (or aborted).
+
+        @returns: L{myutils.PartWriter}
+        """
+        dirpath = self._id_to_dirpath(id)
+        if path:
+            dirpath = os.path.join(dirpath, path)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        if atomic is None:
+            atomic = self.atomic_writes
+        return myutils.PartWriter(dirpath, stream_name, self.hashing_types, atomic, self.fsync, self.hash_thread)
+
+    def _close_part(self, id, path, stream_name, writer, failed=False):
+        """
+        Internal - finish a part started with L{_open_part}, and record it. The
+        checksums of a C{failed} write are returned, but not recorded.
+
+        @returns: The checksums, as for L{put_stream}
+        """
+        result = writer.finish()
+        part = os.path.join(path, stream_name) if path else stream_name
+        self._record_part(id, part, writer.write_path, writer.file_path, writer.stat, writer.old_size,
+                          None if failed else result)
+        return result
+
+    def _record_part(self, id, part, write_path, file_path, st, old_size, result=None):
+        """
+        Internal - bring the store up to date with a part just written to C{write_path}:
+        queue it for the next fsync batch, if there is one, and update the manifest
+        cache, the index and (if C{result} is given) the recorded checksums.
+
+        @param st: C{os.stat_result} of the written file
+        @param old_size: Size of the part it replaced, or 0
+        """
+        if self.fsync == 'batch':
+            self._fsync_batch.add(write_path, file_path)
+        self._manifests.pop(id)
+        if self.index is not None:
+            self.index.add_size(id, st.st_size - old_size)
+        if result is not None:
+            self._record_checksums(id, part, st, result)
+
+    def _record_checksums(self, id, part, st, result):
+        """
+        Internal - keep the checksums of a newly written part in the fixity database
+        and checksum cache, if the store has them
+
+        @param st: The part's C{os.stat} result
+        @param result: The checksums, as returned by L{put_stream}
+        """
+        if self.fixity is not None:
+            self.fixity.record_many([(id, part, algo, checksum, st.st_size, st.st_mtime_ns, None)
+                                     for algo, checksum in result["checksums"].items()])
+        # a part written just now could be rewritten within the same mtime tick,
+        # so it is left for checksum() to cache once it has aged
+        if self.checksums is not None and st.st_mtime_ns < time.time_ns() - myutils.RACY_WINDOW_NS:
+            for algo, checksum in result["checksums"].items():
+                self.checksums.put(st, algo, checksum)
+
+    def sync(self):
+        """
+        Commit any writes held back by the 'batch' fsync policy - they are fsync'd
+        and renamed into place. Call this at the end of a run of writes.
+        """
+        self._fsync_batch.flush()
+
+    def close(self):
+        """
+        Commit any batched writes, wait for the trash to be emptied, and close the
+        index and fixity databases. The client can't be used afterwards.
+        """
+        self._fsync_batch.close()
+        if self._reaper is not None:
+            self._reaper.close()
+        for db in (self.index, self.fixity, self.checksums):
+            if db is not None:
+                db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ingest(self, items, workers=None, processes=False, batch_size=1000, atomic=None, buffer_size=None):
+        """
+        Bulk load parts into the store. The directories needed are made a batch at a
+        time, and the parts are copied (and hashed, if C{hashing_type} is set) by a
+        pool of C{workers} threads, or processes if C{processes} is True.
+
+        >>> for result in store.ingest([('foobar:1', 'data/images/image001.tif', '/scans/001.tif')]):
+        ...     print(result.id, result.path, result.size, result.checksum, result.error)
+
+        See L{pairtree_ingest.ingest} for the details.
+
+        @param items: iterable of C{(id, path, source)} tuples, where C{path} is the
+        part path within the object and C{source} is a file path or a string of bytes
+        @type items: iterable
+        @returns: L{generator} of L{IngestResult}, one per item, in order
+        """
+        from pairtree.pairtree_ingest import ingest
+        return ingest(self, items, workers, processes, batch_size, atomic, buffer_size)
+
+    def stats(self, threads=None, sample=None, incremental=False, top=10, seed=None):
+        """
+        Count the objects, parts and bytes in the store, in one pass over the tree.
+
+        >>> report = store.stats(threads=16, sample=0.05)
+        >>> report.objects, report.bytes, report.largest[:1]
+        (1204332, 88210038211072, [('foobar:1', 1104041010)])
+
+        See L{pairtree_stats} for the details.
+
+        @param threads: (Optional) Number of threads to scan the tree with. If it
+        is None (the default), the tree is scanned serially, in this thread.
+        @type threads: integer
+        @param sample: (Optional) Fraction of the tree's subtrees to walk, scaling the
+        counts up to estimates for the whole store
+        @type sample: float
+        @param incremental: (Optional) Keep what each directory held, and don't list
+        it again on the next run if it hasn't changed
+        @type incremental: bool
+        @param top: (Optional) Number of largest objects to report
+        @type top: integer
+        @param seed: (Optional) Random seed for choosing the sample
+        @returns: L{StoreStats}
+        """
+        from pairtree.pairtree_stats import StatsScan
+        return StatsScan(self, threads, sample, incremental, top, seed=seed).run()
 
     def get_appendable_stream(self, id, path, stream_name):
         """
@@ -461,7 +1273,9 @@ class PairtreeStorageClient(object):
                 # Do something with the C{stream} handle
                 pass
 
-        stream is closed at the end of a C{with} block
+        stream is closed at the end of a C{with} block. The object's cached
+        manifest and its size in the index are brought up to date when the
+        stream is closed, so close it once the appends are done.
 
         @param id: Identifier for the pairtree object to read from
         @type id: identifier
@@ -471,13 +1285,18 @@ class PairtreeStorageClient(object):
         @type stream_name: filename
         @returns: L{file}
         """
-        file_path = os.path.join(self._id_to_dirpath(id), stream_name)
+        dirpath = self._id_to_dirpath(id)
+        file_path = os.path.join(dirpath, stream_name)
         if path:
-            file_path = os.path.join(self._id_to_dirpath(id), path, stream_name)
+            file_path = os.path.join(dirpath, path, stream_name)
         f = open(file_path, "ab+")
-        return f
+        self._manifests.pop(id)
+        if self.index is not None:
+            # make sure the object is indexed, now that it has a part
+            self.index.add_size(id, 0)
+        return _AppendableStream(f, self, id)
 
-    def get_stream(self, id, path, stream_name, streamable=False):
+    def get_stream(self, id, path, stream_name, streamable=False, mmap=False):
         """
         Reads a file from a pairtree object - If streamable is set to True,
         this returns the filehandle for that file, which must be C{close()}'d
@@ -489,6 +1308,13 @@ class PairtreeStorageClient(object):
 
         stream is closed at the end of a C{with} block
 
+        If mmap is set to True, the file is memory mapped instead, and a read-only
+        C{memoryview} of it is returned. Nothing is read until it is used, and
+        slicing it does not copy, so large parts can be served a range at a time:
+
+        >>> with store.get_stream('foobar:1','data/images', 'image001.tif', mmap=True) as view:
+                tile = bytes(view[4096:8192])
+
         @param id: Identifier for the pairtree object to read from
         @type id: identifier
         @param path: (Optional) subdirectory path to retrieve file from
@@ -499,14 +1325,23 @@ class PairtreeStorageClient(object):
         I{remember to C{close()} the file!} If False, reads in the file into a
         bytestring and return that instead.
         @type streamable: True|False
-        @returns: Either L{file} or L{str}
+        @param mmap: If True, return a read-only C{memoryview} of a memory map of the file
+        @type mmap: True|False
+        @returns: Either L{file}, L{str} or L{memoryview}
         """
-        file_path = os.path.join(self._id_to_dirpath(id), stream_name)
+        dirpath = self._id_to_dirpath(id)
+        file_path = os.path.join(dirpath, stream_name)
         if path:
-            file_path = os.path.join(self._id_to_dirpath(id), path, stream_name)
+            file_path = os.path.join(dirpath, path, stream_name)
         if not os.path.exists(file_path):
             raise PartNotFoundException(id=id, path=path, stream_name=stream_name,file_path=file_path)
         f = open(file_path, "rb")
+        if mmap:
+            with f:
+                if not os.fstat(f.fileno()).st_size:
+                    # empty files can't be mapped
+                    return memoryview(b"")
+                return memoryview(MemoryMap(f.fileno(), 0, access=ACCESS_READ))
         if streamable:
             return f
         else:
@@ -514,6 +1349,49 @@ class PairtreeStorageClient(object):
             f.close()
             return bytestream
 
+    def get_range(self, id, path, stream_name, offset, length=None):
+        """
+        Reads C{length} bytes, starting at C{offset}, from a file within a pairtree
+        object - or to the end of the file if C{length} is None. Fewer bytes are
+        returned if the file ends first.
+
+        >>> header = store.get_range('foobar:1', 'data/images', 'image001.tif', 0, 8)
+
+        @param id: Identifier for the pairtree object to read from
+        @type id: identifier
+        @param path: (Optional) subdirectory path to retrieve file from
+        @type path: Directory path
+        @param stream_name: Name of the file to read from
+        @type stream_name: filename
+        @param offset: Position in the file to start reading from
+        @type offset: integer
+        @param length: (Optional) Number of bytes to read
+        @type length: integer
+        @returns: L{bytes}
+        """
+        dirpath = self._id_to_dirpath(id)
+        file_path = os.path.join(dirpath, stream_name)
+        if path:
+            file_path = os.path.join(dirpath, path, stream_name)
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            raise PartNotFoundException(id=id, path=path, stream_name=stream_name,file_path=file_path)
+        try:
+            if length is None:
+                length = max(0, os.fstat(fd).st_size - offset)
+            chunks = []
+            while length > 0:
+                chunk = os.pread(fd, length, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+            return b"".join(chunks)
+        finally:
+            os.close(fd)
+
     def del_stream(self, id, stream_name, path=None):
         """
         Delete a file from a pairtree object. Leaves no trace, be careful.
@@ -524,16 +1402,25 @@ class PairtreeStorageClient(object):
         @param stream_name: Name of the file to delete
         @type stream_name: filename
         """
-        file_path = os.path.join(self._id_to_dirpath(id), stream_name)
+        dirpath = self._id_to_dirpath(id)
+        file_path = os.path.join(dirpath, stream_name)
         if path:
-            file_path = os.path.join(self._id_to_dirpath(id), path, stream_name)
+            file_path = os.path.join(dirpath, path, stream_name)
         if not os.path.exists(file_path):
             raise PartNotFoundException(id=id, path=path, stream_name=stream_name,file_path=file_path)
         if os.path.isdir(file_path):
             os.rmdir(file_path)
             isdir = True
         else:
+            size = os.path.getsize(file_path)
             os.remove(file_path)
+            if self.index is not None:
+                self.index.add_size(id, -size)
+            if self.fixity is not None:
+                self.fixity.remove(id, os.path.join(path, stream_name) if path else stream_name)
+        self._manifests.pop(id)
+        if self.index is not None and not self._has_parts(dirpath):
+            self.index.remove(id)
              
     def del_path(self, id, path, recursive=False):
         """
@@ -547,6 +1434,21 @@ class PairtreeStorageClient(object):
         @param recursive: Whether the delete is recursive (think rm -r)
         @type recursive: bool
         """
+        self._del_path(id, path, recursive)
+        self._manifests.pop(id)
+        if self.index is not None:
+            dirpath = self._id_to_dirpath(id)
+            if self._has_parts(dirpath):
+                self.index.set_size(id, self._object_size(dirpath))
+            else:
+                self.index.remove(id)
+        if self.fixity is not None:
+            self.fixity.remove(id, path)
+
+    def _del_path(self, id, path, recursive=False):
+        """
+        Internal - L{del_path}, without updating the index
+        """
         dirpath = os.path.join(self._id_to_dirpath(id), path)
         if not os.path.exists(dirpath):
             raise PartNotFoundException
@@ -572,26 +1474,100 @@ class PairtreeStorageClient(object):
             else:
                 raise PathIsNotEmptyException
 
-    def delete_object(self, id):
+    def delete_object(self, id, fast=None):
         """
         Delete's an object from the pairtree store, including any parts and subpaths
         There is no undo...
+
+        With a fast delete, the object's directory is renamed into the store's
+        trash and removed in the background (see L{pairtree_trash}), so the
+        object is gone as soon as this returns, however big it was. Otherwise
+        its parts are removed before this returns.
+
+        Either way, shorty directories left empty are then pruned, from the
+        object's up to the pairtree root.
+
         @param id: Identifier of the object to delete
         @type id: identifier
+        @param fast: (Optional) Override the store's C{fast_delete} setting for this delete
+        @type fast: bool
         """
         dirs = self._id_to_dir_list(id)
-        dirpath = os.path.join(os.sep.join(dirs))
+        dirpath = self._id_to_dirpath(id)
         if not os.path.exists(dirpath):
             raise ObjectNotFoundException
-        for item in self.list_parts(id):
-            self.del_path(id,item, recursive=True)
-        if not os.listdir(dirpath):
-            os.rmdir(dirpath)
-        # recursively delete up, if the directory is empty
-        leaf = dirs.pop()
-        while (not os.listdir(os.sep.join(dirs)) and os.sep.join(dirs) != self.pairtree_root):
-            os.rmdir(os.sep.join(dirs))
+        if fast is None:
+            fast = self.fast_delete
+        if fast:
+            self._trash(dirpath)
+        else:
+            for item in os.listdir(dirpath):
+                if len(item)>self.shorty_length:
+                    remove_tree(os.path.join(dirpath, item))
+        # recursively delete up, for as long as the directories are empty
+        while len(dirs) > 1:
+            try:
+                os.rmdir(os.sep.join(dirs))
+            except FileNotFoundError:
+                # already renamed into the trash
+                pass
+            except OSError:
+                break
             dirs.pop()
+        self._forget(id)
+        if self.index is not None:
+            self.index.remove(id)
+        if self.fixity is not None:
+            self.fixity.remove(id)
+
+    def _get_reaper(self):
+        """
+        Internal - the store's L{Reaper}, started on first use
+        """
+        with self._reaper_lock:
+            if self._reaper is None:
+                self._reaper = Reaper(self.trash_dir, self.reaper_threads)
+            return self._reaper
+
+    def _trash(self, dirpath):
+        """
+        Internal - move the object at C{dirpath} into the trash, and have it reaped.
+        If shorty directories belonging to other objects are inside it, only the
+        object's own parts are moved.
+        """
+        reaper = self._get_reaper()
+        trash = reaper.bin()
+        names = os.listdir(dirpath)
+        try:
+            if any(len(x)<=self.shorty_length for x in names):
+                for name in names:
+                    if len(name)>self.shorty_length:
+                        os.rename(os.path.join(dirpath, name), os.path.join(trash, name))
+            else:
+                trashed = os.path.join(trash, "object")
+                os.rename(dirpath, trashed)
+                # an object created under this one since the listing is put back
+                for name in os.listdir(trashed):
+                    if len(name)<=self.shorty_length:
+                        os.makedirs(dirpath, exist_ok=True)
+                        os.rename(os.path.join(trashed, name), os.path.join(dirpath, name))
+        finally:
+            reaper.reap(trash)
+
+    def empty_trash(self, wait=True):
+        """
+        Remove everything in the store's trash (see the C{fast_delete} option),
+        including anything left there by an earlier process.
+
+        @param wait: (Optional) Block until the trash is empty
+        @type wait: bool
+        """
+        if self._reaper is None and not os.path.isdir(self.trash_dir):
+            return
+        reaper = self._get_reaper()
+        reaper.reap_all()
+        if wait:
+            reaper.wait()
 
     def exists(self, id, path=None):
         """
@@ -603,9 +1579,9 @@ class PairtreeStorageClient(object):
         @type path: Directory path
         @returns: L{bool}
         """
-        dirpath = os.path.join(self._id_to_dirpath(id))
+        dirpath = self._id_to_dirpath(id)
         if path:
-            dirpath = os.path.join(self._id_to_dirpath(id), path)
+            dirpath = os.path.join(dirpath, path)
         return os.path.exists(dirpath)
 
     def _get_new_id(self):
@@ -0,0 +1,498 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Fixity
+============================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+A store opened with C{fixity=True} (and a C{hashing_type}) records the checksum
+of every part it writes in a SQLite database kept next to the pairtree_prefix
+file, along with the part's size and modification time. Those checksums can
+later be checked against what is on the disc with an audit:
+
+>>> store = PairtreeStorageFactory().get_store(store_dir='data', hashing_type='sha256', fixity=True)
+>>> audit = store.audit(processes=8, max_rate=200 * 1024 * 1024)
+>>> for problem in audit:
+...     print(problem.kind, problem.id, problem.part)
+mismatch ark:/13030/xt12t3 images/001.tif
+missing ark:/13030/xt12t3 images/002.tif
+extra ark:/13030/xt12t3 notes.txt
+>>> audit.hashed, audit.skipped, audit.bytes_hashed
+(1041, 93, 5523104611)
+
+Parts whose size and modification time are unchanged since they were last
+verified are skipped, unless the audit is C{full}. The objects are hashed by a
+pool of processes, with the total read rate capped at C{max_rate} bytes a
+second. The audit saves its position as it goes, so an interrupted run can
+carry on where it left off with C{resume=True}. The ids it finds are noted in
+the database too, so that objects with recorded checksums which have vanished
+from the store altogether can be picked out at the end without another pass
+over the tree.
+
+As with the object index, the database only holds derivative data: a store
+that was written without it can be brought under fixity control by an audit
+with C{record_extra=True}, which records the parts it finds.
+
+Checksum cache
+==============
+
+Separately, a store opened with C{checksum_cache=N} keeps up to N checksums in a
+L{ChecksumCache}, keyed by the file's device, inode, size and modification time,
+so that L{PairtreeStorageClient.checksum} only reads a part when it has changed:
+
+>>> store.checksum('ark:/13030/xt12t3', 'images/001.tif', 'sha256')
+'9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+"""
+
+import functools
+
+import hashlib
+
+import os
+
+import sqlite3
+
+import threading
+
+import time
+
+from collections import namedtuple
+
+from pairtree import myutils
+
+from pairtree import pairtree_path as ppath
+
+from pairtree.pairtree_index import prefix_upper_bound
+
+from pairtree.pairtree_manifest import ObjectWalk
+
+PAIRTREE_FIXITY = "pairtree_fixity.db"
+
+PAIRTREE_CHECKSUMS = "pairtree_checksums.db"
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+FixityProblem = namedtuple("FixityProblem", "id part kind expected actual")
+FixityProblem.__doc__ = """
+A part that failed an audit. C{kind} is one of:
+
+    - 'mismatch' - the part's checksum is not the one recorded
+    - 'missing' - a part (or its whole object) with a recorded checksum is gone
+    - 'extra' - a part with no recorded checksum
+
+C{expected} and C{actual} are the recorded and current checksums, where known.
+"""
+
+def hash_file(path, algo, throttle=None, buffer_size=HASH_BUFFER_SIZE):
+    """
+    Hash the file at C{path}, reading it into a single reusable buffer.
+
+    @param path: File to hash
+    @param algo: Name of the C{hashlib} algorithm to use
+    @param throttle: (Optional) L{myutils.Throttle} to report the bytes read to
+    @returns: hex digest
+    """
+    hasher = hashlib.new(algo)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            if throttle is not None:
+                throttle.consume(n)
+    return hasher.hexdigest()
+
+# one read throttle per rate, per process
+_throttles = {}
+
+def _audit_object(job, algo, full, shorty_length, rate, record_extra):
+    """
+    Internal - audit a single object, in a worker process.
+
+    @param job: tuple C{(id, dirpath, recorded)}, where C{recorded} maps each part
+    to its recorded C{(checksum, size, mtime_ns)}
+    @returns: tuple C{(id, problems, verified, hashed, skipped, bytes_hashed)},
+    where C{verified} is a list of C{(part, checksum, size, mtime_ns)} to record
+    """
+    id, dirpath, recorded = job
+    throttle = None
+    if rate:
+        throttle = _throttles.get(rate)
+        if throttle is None:
+            throttle = _throttles[rate] = myutils.Throttle(rate)
+    problems = []
+    verified = []
+    hashed = skipped = bytes_hashed = 0
+    seen = set()
+    for part, st in ObjectWalk(dirpath, shorty_length):
+        entry = recorded.get(part)
+        if entry is not None:
+            seen.add(part)
+            checksum, size, mtime_ns = entry
+            if not full and st.st_size == size and st.st_mtime_ns == mtime_ns:
+                skipped += 1
+                continue
+        elif not record_extra:
+            problems.append(FixityProblem(id, part, 'extra', None, None))
+            continue
+        try:
+            actual = hash_file(os.path.join(dirpath, part), algo, throttle)
+        except OSError:
+            # gone since the walk found it
+            continue
+        hashed += 1
+        bytes_hashed += st.st_size
+        if entry is None:
+            problems.append(FixityProblem(id, part, 'extra', None, actual))
+            verified.append((part, actual, st.st_size, st.st_mtime_ns))
+        elif actual != checksum:
+            problems.append(FixityProblem(id, part, 'mismatch', checksum, actual))
+        else:
+            verified.append((part, actual, st.st_size, st.st_mtime_ns))
+    for part in recorded:
+        if part not in seen:
+            problems.append(FixityProblem(id, part, 'missing', recorded[part][0], None))
+    return id, problems, verified, hashed, skipped, bytes_hashed
+
+class FixityDB(object):
+    """
+    A SQLite database of part checksums, keyed by C{(id, part, algorithm)}. Like
+    L{PairtreeIndex}, it is opened in WAL mode and shared between threads.
+    """
+    def __init__(self, db_path):
+        """
+        @param db_path: Path to the SQLite database file, created if need be
+        @type db_path: file path
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS fixity (
+                              id TEXT NOT NULL,
+                              part TEXT NOT NULL,
+                              algo TEXT NOT NULL,
+                              checksum TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              verified REAL NOT NULL,
+                              PRIMARY KEY (id, part, algo)
+                            ) WITHOUT ROWID""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS audit_state (
+                              name TEXT PRIMARY KEY,
+                              position TEXT NOT NULL,
+                              updated REAL NOT NULL
+                            )""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS audit_seen (
+                              name TEXT NOT NULL,
+                              id TEXT NOT NULL,
+                              PRIMARY KEY (name, id)
+                            ) WITHOUT ROWID""")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def record(self, id, part, algo, checksum, size, mtime_ns, verified=None):
+        """
+        Record (or replace) the checksum of a part
+
+        @param id: Identifier of the object
+        @param part: Path of the part within the object, eg 'images/001.tif'
+        @param algo: Name of the hashing algorithm
+        @param checksum: Hex digest of the part
+        @param size: Size of the part, in bytes
+        @param mtime_ns: Modification time of the part, in nanoseconds
+        @param verified: (Optional) When the checksum was taken (Default: now)
+        """
+        self.record_many([(id, part, algo, checksum, size, mtime_ns, verified)])
+
+    def record_many(self, rows):
+        """
+        Record a number of checksums in one transaction
+
+        @param rows: iterable of C{(id, part, algo, checksum, size, mtime_ns, verified)}
+        tuples, as for L{record}
+        """
+        now = time.time()
+        rows = [row[:6] + (row[6] or now,) for row in rows]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("""INSERT OR REPLACE INTO fixity (id, part, algo, checksum, size, mtime_ns, verified)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def get(self, id, part, algo):
+        """
+        @returns: L{dict} of C{checksum}, C{size}, C{mtime_ns} and C{verified}, or None
+        """
+        rows = self._execute("SELECT checksum, size, mtime_ns, verified FROM fixity WHERE id = ? AND part = ? AND algo = ?",
+                             (id, part, algo))
+        if rows:
+            return dict(zip(("checksum", "size", "mtime_ns", "verified"), rows[0]))
+        return None
+
+    def parts(self, id, algo):
+        """
+        @returns: L{dict} mapping each recorded part of the object to its
+        C{(checksum, size, mtime_ns)}
+        """
+        rows = self._execute("SELECT part, checksum, size, mtime_ns FROM fixity WHERE id = ? AND algo = ?", (id, algo))
+        return dict((row[0], row[1:]) for row in rows)
+
+    def remove(self, id, path=None):
+        """
+        Forget the checksums of an object, or of the part (or the subdirectory of
+        parts) at C{path} within it.
+        """
+        if path is None:
+            self._execute("DELETE FROM fixity WHERE id = ?", (id,))
+            return
+        path = path.rstrip(os.sep)
+        below = path + os.sep
+        self._execute("DELETE FROM fixity WHERE id = ? AND (part = ? OR (part >= ? AND part < ?))",
+                      (id, path, below, prefix_upper_bound(below)))
+
+    def ids(self, batch_size=1000):
+        """
+        Yield every id with a recorded checksum, a batch at a time
+        """
+        last = ""
+        while True:
+            rows = self._execute("SELECT DISTINCT id FROM fixity WHERE id > ? ORDER BY id LIMIT ?", (last, batch_size))
+            for row in rows:
+                yield row[0]
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def checkpoint(self, name):
+        """
+        @returns: The last id an audit called C{name} got through, or None
+        """
+        rows = self._execute("SELECT position FROM audit_state WHERE name = ?", (name,))
+        if rows:
+            return rows[0][0]
+        return None
+
+    def set_checkpoint(self, name, position):
+        self._execute("INSERT OR REPLACE INTO audit_state (name, position, updated) VALUES (?, ?, ?)",
+                      (name, position, time.time()))
+
+    def clear_checkpoint(self, name):
+        self._execute("DELETE FROM audit_state WHERE name = ?", (name,))
+        self._execute("DELETE FROM audit_seen WHERE name = ?", (name,))
+
+    def mark_seen(self, name, ids):
+        """
+        Note that an audit called C{name} has found the objects C{ids} in the store
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR IGNORE INTO audit_seen (name, id) VALUES (?, ?)",
+                                     ((name, id) for id in ids))
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def unseen(self, name, batch_size=1000):
+        """
+        Yield every id with a recorded checksum which the audit called C{name}
+        hasn't found (see L{mark_seen}), a batch at a time
+        """
+        last = ""
+        while True:
+            rows = self._execute("""SELECT DISTINCT id FROM fixity WHERE id > ? AND id NOT IN
+                                    (SELECT id FROM audit_seen WHERE name = ?) ORDER BY id LIMIT ?""",
+                                 (last, name, batch_size))
+            for row in rows:
+                yield row[0]
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class FixityAudit(object):
+    """
+    An audit of the whole store against its recorded checksums - see the module
+    docs. Iterate over it to run it; it yields a L{FixityProblem} for each part
+    that fails, and keeps count of its progress in C{objects}, C{hashed},
+    C{skipped} and C{bytes_hashed}.
+    """
+    def __init__(self, store, algo=None, processes=None, full=False, resume=False, max_rate=None,
+                 record_extra=False, name="audit", checkpoint_every=1000):
+        """
+        @param store: The store to audit (opened with C{fixity=True})
+        @type store: L{PairtreeStorageClient}
+        @param algo: (Optional) Algorithm to check (Default: the store's first C{hashing_type})
+        @param processes: (Optional) Number of processes to hash with (Default: hash in this process)
+        @type processes: integer
+        @param full: (Optional) Hash every part, even those that look unchanged
+        @type full: bool
+        @param resume: (Optional) Carry on from where the last, unfinished, audit called C{name} stopped
+        @type resume: bool
+        @param max_rate: (Optional) Most bytes a second to read, across all the processes
+        @type max_rate: integer
+        @param record_extra: (Optional) Record the checksums of parts which have none
+        @type record_extra: bool
+        @param name: (Optional) Name to save the audit's position under
+        @param checkpoint_every: (Optional) How many objects to audit between saves of the position
+        """
+        if store.fixity is None:
+            raise ValueError("the store is not keeping fixity information")
+        self.store = store
+        self.algo = algo or store.hashing_types[0]
+        self.processes = processes
+        self.full = full
+        self.resume = resume
+        self.max_rate = max_rate
+        self.record_extra = record_extra
+        self.name = name
+        self.checkpoint_every = checkpoint_every
+        self.objects = self.hashed = self.skipped = self.bytes_hashed = 0
+
+    def __iter__(self):
+        store = self.store
+        fixity = store.fixity
+        start = None
+        if self.resume:
+            start = fixity.checkpoint(self.name)
+        else:
+            fixity.clear_checkpoint(self.name)
+        rate = self.max_rate
+        if rate and self.processes:
+            rate = float(rate) / self.processes
+        audit = functools.partial(_audit_object, algo=self.algo, full=self.full, shorty_length=store.shorty_length,
+                                  rate=rate, record_extra=self.record_extra)
+        # an ordered walk, so that the position can be saved and resumed
+        ids = store.list_ids(start=start if start is not None else "")
+        jobs = ((id, store._id_to_dirpath(id), fixity.parts(id, self.algo)) for id in ids if id != start)
+        # the ids found, noted a batch at a time, and always before the position is saved
+        seen = []
+        for id, problems, verified, hashed, skipped, bytes_hashed in ppath._map_many(audit, jobs, self.processes, 4):
+            seen.append(id)
+            self.objects += 1
+            self.hashed += hashed
+            self.skipped += skipped
+            self.bytes_hashed += bytes_hashed
+            if verified:
+                fixity.record_many([(id, part, self.algo, checksum, size, mtime_ns, None)
+                                    for part, checksum, size, mtime_ns in verified])
+            for problem in problems:
+                yield problem
+            if self.objects % self.checkpoint_every == 0:
+                fixity.mark_seen(self.name, seen)
+                seen = []
+                fixity.set_checkpoint(self.name, id)
+        fixity.mark_seen(self.name, seen)
+        # objects with recorded checksums which the walk (this one, or the one it
+        # carries on from) didn't find at all
+        for id in fixity.unseen(self.name):
+            for part, (checksum, size, mtime_ns) in sorted(fixity.parts(id, self.algo).items()):
+                yield FixityProblem(id, part, 'missing', checksum, None)
+        fixity.clear_checkpoint(self.name)
+
+class ChecksumCache(object):
+    """
+    A persistent, bounded cache of file checksums in a SQLite database. Entries
+    are keyed by C{(st_dev, st_ino, algorithm)} and are only valid while the
+    file's size and C{st_mtime_ns} are unchanged - a rewritten file gets a new
+    modification time (and usually a new inode), so its old checksum is never
+    returned. A file modified within C{RACY_WINDOW_NS} of being hashed isn't
+    cached at all, as it could be rewritten within the same mtime tick - it is
+    hashed again until it has aged.
+
+    Once the cache holds more than C{maxsize} entries, the least recently used
+    tenth are evicted.
+    """
+    def __init__(self, db_path, maxsize=100000):
+        """
+        @param db_path: Path to the SQLite database file, created if need be
+        @type db_path: file path
+        @param maxsize: Most checksums to keep
+        @type maxsize: integer
+        """
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                              dev INTEGER NOT NULL,
+                              ino INTEGER NOT NULL,
+                              algo TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              checksum TEXT NOT NULL,
+                              used REAL NOT NULL,
+                              PRIMARY KEY (dev, ino, algo)
+                            ) WITHOUT ROWID""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS checksums_used ON checksums (used)")
+        self._size = self._db.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+
+    def get(self, st, algo):
+        """
+        @param st: The file's current C{os.stat} result
+        @param algo: Name of the hashing algorithm
+        @returns: The cached hex digest, or None if there isn't a valid one
+        """
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, checksum FROM checksums WHERE dev = ? AND ino = ? AND algo = ?",
+                                   (st.st_dev, st.st_ino, algo)).fetchone()
+            if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE checksums SET used = ? WHERE dev = ? AND ino = ? AND algo = ?",
+                             (time.time(), st.st_dev, st.st_ino, algo))
+            self.hits += 1
+            return row[2]
+
+    def put(self, st, algo, checksum):
+        """
+        Cache the checksum of the file whose C{os.stat} result is C{st}
+        """
+        with self._lock:
+            self._db.execute("""INSERT OR REPLACE INTO checksums (dev, ino, algo, size, mtime_ns, checksum, used)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                             (st.st_dev, st.st_ino, algo, st.st_size, st.st_mtime_ns, checksum, time.time()))
+            self._size += 1
+            if self._size > self.maxsize:
+                self._size = self._db.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+                if self._size > self.maxsize:
+                    evict = self._size - self.maxsize + self.maxsize // 10
+                    self._db.execute("""DELETE FROM checksums WHERE (dev, ino, algo) IN
+                                        (SELECT dev, ino, algo FROM checksums ORDER BY used LIMIT ?)""", (evict,))
+                    self._size -= evict
+
+    def __len__(self):
+        return self._size
+
+    def info(self):
+        """
+        @returns: L{dict} of C{hits}, C{misses}, C{size} and C{maxsize}, as for L{myutils.LRUCache}
+        """
+        return {"hits":self.hits, "misses":self.misses, "size":self._size, "maxsize":self.maxsize}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
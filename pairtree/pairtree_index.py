@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Object index
+==================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+The pairtree spec allows for "fast indexes stored outside" the tree, as long as
+they only hold derivative data. This is one: a SQLite database kept next to the
+pairtree_prefix file, recording every object id in the store along with when it
+was created and how many bytes its parts take up.
+
+It lets a L{PairtreeStorageClient} answer C{list_ids}, object counts and prefix
+queries without walking the filesystem. Ids are kept in the same order as a walk
+of the tree would find them - that is, ordered by their encoded form. If it is ever lost or gets out of step
+(eg after a crash), it can be rebuilt from the tree with
+L{PairtreeStorageClient.rebuild_index}.
+
+Usage
+=====
+
+>>> from pairtree import PairtreeStorageFactory
+>>> store = PairtreeStorageFactory().get_store(store_dir='data', uri_base='http://example.org/', index=True)
+>>> store.create_object('foo').add_bytestream('foo.txt', b'foo')
+>>> store.count_objects()
+1
+>>> store.index.get('foo')
+{'id': 'foo', 'created': 1262304000.0, 'size': 3}
+
+Objects are indexed once they have a part, as that is when a walk of the tree
+first finds them, and dropped again when their last part is deleted.
+"""
+
+import sqlite3
+
+import threading
+
+import time
+
+from pairtree.pairtree_path import id_encode
+
+PAIRTREE_INDEX = "pairtree_index.db"
+
+# kept in the database's user_version, and bumped whenever the tables change
+SCHEMA_VERSION = 1
+
+def prefix_upper_bound(prefix):
+    """
+    The smallest string that sorts after every string starting with C{prefix},
+    or None if there isn't one. Used to turn a prefix query into a range query.
+
+    @param prefix: String prefix
+    @type prefix: string
+    @returns: string or None
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last == 0xd7ff:
+            # skip over the surrogates, which can't be stored
+            return prefix[:-1] + u'\ue000'
+        if last < 0x10ffff:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+class PairtreeIndex(object):
+    """
+    A SQLite backed index of the objects in a pairtree store.
+
+    The database is opened in WAL mode, so readers in other processes are not
+    held up by a writer. A single connection is shared between threads, guarded
+    by a lock.
+    """
+    def __init__(self, db_path):
+        """
+        @param db_path: Path to the SQLite database file, created if need be
+        @type db_path: file path
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._db.execute("""CREATE TABLE IF NOT EXISTS objects (
+                              id TEXT PRIMARY KEY,
+                              encoded TEXT NOT NULL,
+                              created REAL NOT NULL,
+                              size INTEGER NOT NULL DEFAULT 0
+                            ) WITHOUT ROWID""")
+        self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS objects_encoded ON objects (encoded)")
+        self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def _migrate(self):
+        """
+        Internal - bring an index written by an earlier version up to date. Version 0
+        had no C{encoded} column, so it is added and filled in from the ids.
+        """
+        if self._db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(objects)")]
+        if not columns or "encoded" in columns:
+            return
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("ALTER TABLE objects ADD COLUMN encoded TEXT NOT NULL DEFAULT ''")
+            ids = [row[0] for row in self._db.execute("SELECT id FROM objects")]
+            self._db.executemany("UPDATE objects SET encoded = ? WHERE id = ?",
+                                 ((id_encode(id), id) for id in ids))
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def add(self, id, created=None, size=0):
+        """
+        Record a new object (or reset an existing entry)
+
+        @param id: Identifier of the object
+        @type id: identifier
+        @param created: (Optional) Creation time, in seconds since the epoch. Defaults to now.
+        @type created: float
+        @param size: (Optional) Total size of the object's parts in bytes
+        @type size: integer
+        """
+        if created is None:
+            created = time.time()
+        self._execute("INSERT OR REPLACE INTO objects (id, encoded, created, size) VALUES (?, ?, ?, ?)",
+                      (id, id_encode(id), created, size))
+
+    def remove(self, id):
+        """
+        Forget an object
+
+        @param id: Identifier of the object
+        @type id: identifier
+        """
+        self._execute("DELETE FROM objects WHERE id = ?", (id,))
+
+    def add_size(self, id, delta):
+        """
+        Adjust the recorded size of an object by C{delta} bytes. Objects that are
+        not yet in the index (eg ones created implicitly by writing a part to them)
+        are added.
+
+        @param id: Identifier of the object
+        @type id: identifier
+        @param delta: Change in size, in bytes
+        @type delta: integer
+        """
+        self._execute("""INSERT INTO objects (id, encoded, created, size) VALUES (?, ?, ?, ?)
+                         ON CONFLICT(id) DO UPDATE SET size = MAX(0, size + excluded.size)""",
+                      (id, id_encode(id), time.time(), delta))
+
+    def set_size(self, id, size):
+        """
+        Set the recorded size of an object, adding it to the index if need be.
+
+        @param id: Identifier of the object
+        @type id: identifier
+        @param size: Total size of the object's parts, in bytes
+        @type size: integer
+        """
+        self._execute("""INSERT INTO objects (id, encoded, created, size) VALUES (?, ?, ?, ?)
+                         ON CONFLICT(id) DO UPDATE SET size = excluded.size""",
+                      (id, id_encode(id), time.time(), size))
+
+    def get(self, id):
+        """
+        @param id: Identifier of the object
+        @type id: identifier
+        @returns: L{dict} with C{id}, C{created} and C{size}, or None if the object is not indexed
+        """
+        rows = self._execute("SELECT id, created, size FROM objects WHERE id = ?", (id,))
+        if rows:
+            return dict(zip(("id", "created", "size"), rows[0]))
+        return None
+
+    def __contains__(self, id):
+        return bool(self._execute("SELECT 1 FROM objects WHERE id = ?", (id,)))
+
+    def _where(self, prefix=None, start=None, stop=None):
+        """
+        Internal - SQL WHERE clause and parameters for a prefix and/or [start, stop)
+        range of ids, compared in their encoded form
+        """
+        clauses = []
+        params = []
+        if prefix:
+            prefix = id_encode(prefix)
+            clauses.append("encoded >= ?")
+            params.append(prefix)
+            upper = prefix_upper_bound(prefix)
+            if upper is not None:
+                clauses.append("encoded < ?")
+                params.append(upper)
+        if start is not None:
+            clauses.append("encoded >= ?")
+            params.append(id_encode(start))
+        if stop is not None:
+            clauses.append("encoded < ?")
+            params.append(id_encode(stop))
+        if clauses:
+            return " WHERE " + " AND ".join(clauses), params
+        return "", params
+
+    def ids(self, prefix=None, start=None, stop=None, batch_size=1000):
+        """
+        Yield the indexed ids in order of their encoded form, optionally restricted
+        to those starting with C{prefix} and/or whose encoded form falls in the range
+        C{id_encode(start) <= encoded < id_encode(stop)}. The ids are fetched a batch
+        at a time, so the whole index is never held in memory.
+
+        @returns: L{generator}
+        """
+        where, params = self._where(prefix, start, stop)
+        last = None
+        while True:
+            sql = "SELECT id, encoded FROM objects" + where
+            page_params = list(params)
+            if last is not None:
+                sql += (" AND" if where else " WHERE") + " encoded > ?"
+                page_params.append(last)
+            rows = self._execute(sql + " ORDER BY encoded LIMIT ?", page_params + [batch_size])
+            for row in rows:
+                yield row[0]
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][1]
+
+    def count(self, prefix=None, start=None, stop=None):
+        """
+        @returns: Number of indexed objects, optionally restricted as for L{ids}
+        """
+        where, params = self._where(prefix, start, stop)
+        return self._execute("SELECT COUNT(*) FROM objects" + where, params)[0][0]
+
+    def total_size(self):
+        """
+        @returns: Sum of the sizes of all the indexed objects, in bytes
+        """
+        return self._execute("SELECT COALESCE(SUM(size), 0) FROM objects")[0][0]
+
+    def rebuild(self, entries):
+        """
+        Replace the whole contents of the index in a single transaction - readers
+        see either the old index or the new one, never a half built one.
+
+        @param entries: iterable of C{(id, created, size)} tuples
+        @type entries: iterable
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM objects")
+                self._db.executemany("INSERT OR REPLACE INTO objects (id, encoded, created, size) VALUES (?, ?, ?, ?)",
+                                     ((id, id_encode(id), created, size) for id, created, size in entries))
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
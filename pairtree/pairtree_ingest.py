@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Bulk ingest
+=================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+Loading many objects one C{create_object}/C{add_file} call at a time spends most
+of its time in per-call python overhead rather than on the disc. L{ingest} takes
+an iterable of C{(id, path, source)} items and:
+
+    1. creates the directories they need a batch at a time, each one only once,
+    2. copies the parts in on a pool of threads (or processes), hashing them in
+       the same pass if the store has a C{hashing_type},
+    3. streams an L{IngestResult} back for every item, in the order given - a
+       failed item carries its exception rather than stopping the run.
+
+Usage
+=====
+
+>>> items = [('ark:/13030/xt12t3', 'images/001.tif', '/scans/xt12t3/001.tif'),
+...          ('ark:/13030/xt12t3', 'images/002.tif', '/scans/xt12t3/002.tif')]
+>>> for result in store.ingest(items, workers=8):
+...     if result.error:
+...         print(result.id, result.path, result.error)
+
+The same is available from the command line as C{pairtree ingest}, which reads
+tab separated C{id, path, source} lines from stdin.
+"""
+
+import os
+
+import itertools
+
+from collections import deque, namedtuple
+
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+from pairtree import myutils
+
+IngestResult = namedtuple("IngestResult", "id path size checksum error")
+IngestResult.__doc__ = """
+The outcome of ingesting one item: the C{id} and part C{path} it was written to,
+its C{size} in bytes, its C{checksum} (as returned by C{put_stream}, or None if
+hashing is disabled) and the C{error} raised, if any (in which case C{size} and
+C{checksum} are None).
+"""
+
+def _write_part(dirpath, name, source, hashing_type=None, atomic=False, fsync=None, buffer_size=None,
+                hash_thread=False):
+    """
+    Internal - copy C{source} (a file path or a string of bytes) into
+    C{dirpath/name}, which must already exist, with a L{myutils.PartWriter} as
+    C{put_stream} does. Run in the worker threads or processes, so it takes
+    nothing that can't be pickled; the part is recorded with the store by
+    L{_finish}.
+
+    @returns: tuple C{(write_path, file_path, stat, old_size, checksum)} - C{write_path}
+    is the temporary file still to be renamed into place if C{fsync} is 'batch'
+    """
+    # open the source first, so that a missing one leaves nothing behind
+    src = None
+    if not isinstance(source, bytes):
+        src = open(source, "rb")
+    try:
+        writer = myutils.PartWriter(dirpath, name, myutils.hashing_types(hashing_type), atomic, fsync, hash_thread)
+        try:
+            if src is None:
+                writer.write(source)
+            else:
+                writer.copy(src, buffer_size)
+            writer.flush()
+        except:
+            writer.abort()
+            raise
+    finally:
+        if src is not None:
+            src.close()
+    checksum = writer.finish()
+    return writer.write_path, writer.file_path, writer.stat, writer.old_size, checksum
+
+def ingest(store, items, workers=None, processes=False, batch_size=1000, atomic=None, buffer_size=None):
+    """
+    Copy a stream of items into C{store} in parallel - see the module docs.
+
+    Each item is a tuple C{(id, path, source)}: C{path} is where the part goes
+    within the object (eg 'images/001.tif'; if it is empty or ends with a '/',
+    the source's own filename is used) and C{source} is either the path of a
+    file to copy or a string of bytes.
+
+    An item that isn't such a tuple, or has no source, gets an L{IngestResult}
+    carrying a ValueError (or TypeError) in its place.
+
+    Items are read C{batch_size} at a time, and at most a few batches are in
+    flight at once, so any number of items can be streamed through.
+
+    @param store: The store to load into
+    @type store: L{PairtreeStorageClient}
+    @param items: iterable of C{(id, path, source)} tuples
+    @type items: iterable
+    @param workers: (Optional) Number of threads or processes to copy with (Default: number of cpus)
+    @type workers: integer
+    @param processes: (Optional) If True, copy in a process pool rather than a thread pool
+    @type processes: bool
+    @param batch_size: (Optional) How many items to create directories for at once
+    @type batch_size: integer
+    @param atomic: (Optional) Override the store's C{atomic_writes} setting
+    @type atomic: bool
+    @param buffer_size: (Optional) Fixed buffer size to copy with
+    @type buffer_size: integer
+    @returns: L{generator} of L{IngestResult}, in the same order as C{items}
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if atomic is None:
+        atomic = store.atomic_writes
+    if processes:
+        executor = ProcessPoolExecutor(workers)
+    else:
+        executor = ThreadPoolExecutor(workers)
+    # directories known to exist - bounded, as a run may touch millions of objects
+    made = myutils.LRUCache(max(batch_size * 16, 65536))
+    pending = deque()
+    items = iter(items)
+    try:
+        for batch in iter(lambda: list(itertools.islice(items, batch_size)), []):
+            jobs = []
+            for item in batch:
+                try:
+                    id, path, source = item
+                    if source is None or source == "":
+                        raise ValueError("no source to copy from")
+                except (TypeError, ValueError) as e:
+                    # reported in its place, without stopping the run
+                    id, path = _item_fields(item)
+                    jobs.append((id, path, None, None, e))
+                    continue
+                subpath, name = os.path.split(path or "")
+                if not name:
+                    name = os.path.basename(source)
+                dirpath = store._id_to_dirpath(id)
+                if subpath:
+                    dirpath = os.path.join(dirpath, subpath)
+                jobs.append((id, os.path.join(subpath, name), dirpath, name, source))
+            for dirpath in sorted(set(job[2] for job in jobs if job[2] is not None)):
+                if dirpath not in made:
+                    try:
+                        os.makedirs(dirpath, exist_ok=True)
+                        made[dirpath] = True
+                    except OSError:
+                        # reported against each of its items when their copies fail
+                        pass
+            for id, path, dirpath, name, source in jobs:
+                if dirpath is None:
+                    future = Future()
+                    future.set_exception(source)
+                else:
+                    future = executor.submit(_write_part, dirpath, name, source, store.hashing_type,
+                                             atomic, store.fsync, buffer_size, store.hash_thread)
+                pending.append((id, path, dirpath, name, future))
+            while len(pending) > batch_size * 2:
+                yield _finish(store, *pending.popleft())
+        while pending:
+            yield _finish(store, *pending.popleft())
+    finally:
+        for job in pending:
+            job[-1].cancel()
+        executor.shutdown(wait=True)
+
+def _item_fields(item):
+    """
+    Internal - the id and path of a malformed item, as far as they can be made out
+    """
+    fields = list(item) if isinstance(item, (tuple, list)) else []
+    fields += [None, None]
+    return fields[0], fields[1]
+
+def _finish(store, id, path, dirpath, name, future):
+    """
+    Internal - wait for one item's copy, and record it with the store
+    """
+    try:
+        write_path, file_path, st, old_size, checksum = future.result()
+    except Exception as e:
+        return IngestResult(id, path, None, None, e)
+    store._record_part(id, path, write_path, file_path, st, old_size, checksum)
+    return IngestResult(id, path, st.st_size, checksum, None)
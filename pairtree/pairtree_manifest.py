@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Object manifests
+======================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+Answering C{list_parts}, C{isfile}, C{isdir} and C{stat} for an object costs a
+system call or two each, every time. An L{ObjectManifest} records the whole part
+tree of an object - the type, size and modification time of every part and
+subdirectory - from a single C{scandir} recursion, and can then answer all of
+them from memory.
+
+A store opened with C{manifest_cache=N} keeps the manifests of the N most
+recently used objects. A manifest is dropped whenever the same client writes to
+or deletes from its object, and before it is used it is checked against the
+modification times of the object's directories - one C{stat} for an object
+without subdirectories - so that parts added, renamed or removed by other
+processes are noticed. A directory modified within C{RACY_WINDOW_NS} of the
+walk isn't trusted - a change made straight after it was listed could leave its
+modification time as it was - so the manifest of an object changed that recently
+is rebuilt the next time it is used. (Rewriting an existing file in place does
+not change its directory, so a part changed that way by another process may be
+reported with its old size until the manifest is next rebuilt.)
+"""
+
+import os
+
+import time
+
+from stat import S_ISDIR, S_ISREG
+
+from pairtree import myutils
+
+def is_object_path(relpath, shorty_length=2):
+    """
+    Whether the normalised path C{relpath}, relative to an object's root, lies
+    within the object - rather than in the shorty directory of another object
+    (a first component no longer than C{shorty_length}) or outside it altogether.
+    """
+    first = relpath.split(os.sep, 1)[0]
+    return len(first) > shorty_length and first != os.pardir and not os.path.isabs(relpath)
+
+def walk_object(dirpath, shorty_length=2, dirs=False, path=None):
+    """
+    Walk the contents of the object whose root directory is C{dirpath}, skipping
+    the shorty directories of other objects (entries at the root no longer than
+    C{shorty_length}) and temporary files left by atomic writes.
+
+    Subdirectories are yielded (if C{dirs} is set) before their contents.
+    Symbolic links to directories are yielded, but not followed.
+
+    @param dirpath: The object's root directory
+    @param shorty_length: The store's shorty length
+    @param dirs: (Optional) Yield subdirectories as well as files
+    @param path: (Optional) Only walk this subdirectory of the object. The paths
+    yielded are still relative to the object's root. If it lies in another
+    object's shorty directory (or outside the object), nothing is yielded.
+    @returns: L{generator} of C{(relative_path, os.DirEntry)}
+    """
+    relpath = os.path.normpath(path) if path else ""
+    if relpath == os.curdir:
+        relpath = ""
+    if relpath and not is_object_path(relpath, shorty_length):
+        return
+    stack = [(relpath, os.path.join(dirpath, relpath) if relpath else dirpath)]
+    while stack:
+        relpath, current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                found = list(entries)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in found:
+            if not relpath and len(entry.name) <= shorty_length:
+                continue
+            if entry.name.startswith(myutils.TEMP_PREFIX):
+                continue
+            part = os.path.join(relpath, entry.name) if relpath else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if dirs:
+                    yield part, entry
+                subdirs.append((part, entry.path))
+            else:
+                yield part, entry
+        # reversed, so that subdirectories come off the stack in listing order
+        stack.extend(reversed(subdirs))
+
+class ObjectWalk(object):
+    """
+    A walk over every part of an object - see L{walk_object}. Iterate over it to
+    get C{(relative_path, os.stat_result)} for each part; it keeps count of the
+    parts seen so far in C{parts}, and of their total size in bytes in C{size}.
+
+    Symbolic links are not followed, so a link is reported with its own C{lstat}.
+    """
+    def __init__(self, dirpath, shorty_length=2, path=None):
+        """
+        @param dirpath: The object's root directory
+        @param shorty_length: The store's shorty length
+        @param path: (Optional) Only walk this subdirectory of the object
+        """
+        self.dirpath = dirpath
+        self.shorty_length = shorty_length
+        self.path = path
+        self.parts = self.size = 0
+
+    def __iter__(self):
+        for part, entry in walk_object(self.dirpath, self.shorty_length, path=self.path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # gone since the listing
+                continue
+            self.parts += 1
+            self.size += st.st_size
+            yield part, st
+
+    def total(self):
+        """
+        Walk whatever is left of the object, and return its total size
+
+        @returns: L{int}
+        """
+        for _ in self:
+            pass
+        return self.size
+
+class ObjectManifest(object):
+    """
+    A snapshot of an object's part tree, taken with L{walk_object}. A directory
+    modified within C{RACY_WINDOW_NS} of the walk is recorded as changed, so that
+    L{is_current} is False until the manifest is taken again.
+    """
+    def __init__(self, dirpath, shorty_length=2):
+        """
+        @param dirpath: The object's root directory
+        @param shorty_length: The store's shorty length
+        @raise OSError: If the object's directory can't be read
+        """
+        self.dirpath = dirpath
+        self.shorty_length = shorty_length
+        # relative path -> os.stat_result, for every part and subdirectory
+        self.entries = {}
+        # relative path of each directory -> names of what is in it
+        self.children = {"": []}
+        # relative path of each directory -> its st_mtime_ns when it was listed,
+        # or -1 if that was too recent to be trusted
+        started_ns = time.time_ns()
+        self.dir_mtimes = {"": self._trusted(os.stat(dirpath).st_mtime_ns, started_ns)}
+        for relpath, entry in walk_object(dirpath, shorty_length, dirs=True):
+            try:
+                st = entry.stat()
+            except OSError:
+                # a dangling symlink, or gone since the listing
+                continue
+            self.entries[relpath] = st
+            parent, name = os.path.split(relpath)
+            self.children[parent].append(name)
+            if entry.is_dir(follow_symlinks=False):
+                self.children[relpath] = []
+                self.dir_mtimes[relpath] = self._trusted(st.st_mtime_ns, started_ns)
+
+    @staticmethod
+    def _trusted(mtime_ns, started_ns):
+        """
+        Internal - C{mtime_ns}, or -1 if it is within C{RACY_WINDOW_NS} of C{started_ns}
+        """
+        if mtime_ns >= started_ns - myutils.RACY_WINDOW_NS:
+            return -1
+        return mtime_ns
+
+    def is_current(self):
+        """
+        @returns: False if any of the object's directories has changed since the
+        manifest was taken
+        """
+        for relpath, mtime_ns in self.dir_mtimes.items():
+            try:
+                if os.stat(os.path.join(self.dirpath, relpath)).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _key(self, path):
+        """
+        Internal - the key for C{path} in L{entries}, or None if the manifest
+        can't say anything about it (it falls outside the walk)
+        """
+        path = os.path.normpath(path or "")
+        if path == ".":
+            return ""
+        if path.startswith(os.pardir) or os.path.isabs(path):
+            return None
+        first = path.split(os.sep, 1)[0]
+        if len(first) <= self.shorty_length or first.startswith(myutils.TEMP_PREFIX):
+            return None
+        return path
+
+    def covers(self, path):
+        """
+        @returns: True if the manifest can answer questions about C{path}
+        """
+        return self._key(path) is not None
+
+    def get(self, path):
+        """
+        @returns: The C{os.stat_result} of the part or subdirectory at C{path}, or None
+        """
+        key = self._key(path)
+        if key == "":
+            return None
+        return self.entries.get(key)
+
+    def isfile(self, path):
+        st = self.get(path)
+        return st is not None and S_ISREG(st.st_mode)
+
+    def isdir(self, path):
+        st = self.get(path)
+        return st is not None and S_ISDIR(st.st_mode)
+
+    def listdir(self, path=None):
+        """
+        @returns: The names in the directory at C{path} (the object's root if None),
+        or None if it isn't a directory the manifest has listed
+        """
+        key = self._key(path) if path else ""
+        if key is None:
+            return None
+        names = self.children.get(key)
+        if names is None:
+            return None
+        return list(names)
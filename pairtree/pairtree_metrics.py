@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Instrumentation
+=====================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+Give a store an C{observer} and every call to one of its operations (see
+L{CLIENT_OPERATIONS}) is timed and reported to it - along with the bytes it read
+or wrote and, where the kernel keeps per-thread I/O accounting, the read and write
+system calls it made. Objects from the store report their own operations too
+(named C{object.add_bytestream} and so on), as does a L{PairtreeReverseLookup}
+given an observer (C{revlookup.get}, C{revlookup.add}, ...).
+
+>>> metrics = MetricsCollector()
+>>> store = PairtreeStorageFactory().get_store(store_dir="data", observer=metrics)
+>>> ...
+>>> metrics.snapshot()["put_stream"]
+{'count': 120, 'errors': 0, 'seconds': 0.93, 'bytes_read': 0, 'bytes_written': 125829120, ...}
+
+The timing is done by wrapping the methods of the instance being observed, so
+a store without an observer runs exactly the code it always has.
+
+Any object with an C{observe} method can be an observer (see L{Observer}); it is
+called on whichever thread ran the operation. L{MetricsCollector} keeps counts
+and latency histograms in memory, and L{PrometheusExporter} writes them out in
+the Prometheus text format - for example, for node_exporter's textfile collector:
+
+>>> exporter = PrometheusExporter(metrics, "/var/lib/node_exporter/pairtree.prom", interval=15)
+>>> exporter.start()
+"""
+
+import os
+
+import tempfile
+
+import threading
+
+import time
+
+import functools
+
+import types
+
+from pairtree import myutils
+
+# seconds - the upper bounds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+IO_COUNTERS = "/proc/thread-self/io"
+
+# counts, per thread, the reads of IO_COUNTERS, so that they can be left out of the syscalls reported
+_local = threading.local()
+
+def _size(value):
+    """
+    Internal - the number of bytes in C{value} if it is a string of bytes, or how
+    far a stream has been read if it is a file-like object, otherwise 0
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if hasattr(value, "tell"):
+        try:
+            return value.tell()
+        except (OSError, ValueError):
+            return 0
+    if isinstance(value, str):
+        return len(value)
+    return 0
+
+def _argument(position, name):
+    """
+    Internal - an extractor for the size of the data passed as argument C{name},
+    at C{position}
+    """
+    def written(args, kwargs, result):
+        if name in kwargs:
+            return 0, _size(kwargs[name])
+        if len(args) > position:
+            return 0, _size(args[position])
+        return 0, 0
+    return written
+
+def _result(args, kwargs, result):
+    """
+    Internal - an extractor for the size of the data returned (a stream handed
+    back to be read later counts as nothing)
+    """
+    if isinstance(result, (bytes, bytearray, memoryview, str)):
+        return len(result), 0
+    return 0, 0
+
+# operation -> None, or a function of (args, kwargs, result) returning (bytes read, bytes written)
+CLIENT_OPERATIONS = {"list_ids":None, "count_objects":None, "list_parts":None, "walk_parts":None,
+                     "isfile":None, "isdir":None, "stat":None, "exists":None, "checksum":None,
+                     "put_stream":_argument(3, "bytestream"), "get_stream":_result,
+                     "get_range":_result, "get_appendable_stream":None, "del_stream":None,
+                     "del_path":None, "delete_object":None, "get_object":None,
+                     "create_object":None, "ingest":None, "sync":None}
+
+OBJECT_OPERATIONS = {"add_bytestream":_argument(1, "bytestream"),
+                     "add_bytestream_by_path":_argument(1, "bytestream"),
+                     "get_bytestream":_result, "get_bytestream_by_path":_result,
+                     "get_range":_result, "add_file":None, "add_directory":None,
+                     "del_file":None, "del_file_by_path":None, "del_path":None,
+                     "list_parts":None, "isfile":None, "isdir":None, "stat":None,
+                     "checksum":None}
+
+REVLOOKUP_OPERATIONS = {"get":None, "add":None, "add_many":None, "get_many":None,
+                        "contains":None, "count":None, "delete":None}
+
+class Observer(object):
+    """
+    The interface an observer implements. This one ignores everything.
+    """
+    def observe(self, operation, seconds, bytes_read=0, bytes_written=0, syscalls=None, error=None):
+        """
+        Called once each time an observed operation finishes.
+
+        @param operation: Name of the operation, eg C{'put_stream'} or C{'object.list_parts'}
+        @param seconds: How long it took
+        @param bytes_read: Bytes of part data it returned
+        @param bytes_written: Bytes of part data it stored
+        @param syscalls: C{(reads, writes)} - the read and write system calls made by the
+        thread during the operation, or None if they aren't being counted
+        @param error: The exception it raised, if it failed
+        """
+        pass
+
+def read_io_counters():
+    """
+    The calling thread's I/O accounting from C{/proc/thread-self/io} (Linux only)
+
+    @returns: L{dict} of C{syscr}, C{syscw}, C{rchar}, ..., or None if it isn't available
+    """
+    # a single read, so that the cost of the reading is known (see _timed)
+    try:
+        fd = os.open(IO_COUNTERS, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        data = os.read(fd, 4096)
+    finally:
+        os.close(fd)
+    _local.reads = getattr(_local, "reads", 0) + 1
+    counters = {}
+    for line in data.decode("ascii").splitlines():
+        name, _, value = line.partition(":")
+        counters[name] = int(value)
+    return counters
+
+def _timed(method, operation, observer, extract, io_counters):
+    """
+    Internal - wrap a bound method so that each call is reported to C{observer}.
+    Generators are timed from the call until they are exhausted or closed.
+    """
+    clock = time.perf_counter
+    observe = observer.observe
+
+    def finish(start, before, args, kwargs, result, error):
+        seconds = clock() - start
+        syscalls = None
+        if before is not None:
+            reads = _local.reads
+            after = read_io_counters()
+            if after is not None:
+                # less the reads of the counters themselves - the one before this
+                # operation, and any by operations nested inside it
+                syscalls = (after["syscr"] - before["syscr"] - (reads - before["reads"] + 1),
+                            after["syscw"] - before["syscw"])
+        read = written = 0
+        if extract is not None and error is None:
+            read, written = extract(args, kwargs, result)
+        observe(operation, seconds, read, written, syscalls, error)
+
+    def iterate(generator, start, args, kwargs):
+        # the consumer's system calls (on whatever thread) would be counted too, so
+        # generators report none
+        error = None
+        try:
+            for item in generator:
+                yield item
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            finish(start, None, args, kwargs, None, error)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        before = read_io_counters() if io_counters else None
+        if before is not None:
+            before["reads"] = _local.reads
+        start = clock()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            finish(start, before, args, kwargs, None, e)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return iterate(result, start, args, kwargs)
+        finish(start, before, args, kwargs, result, None)
+        return result
+    return wrapper
+
+def instrument(target, observer, operations, prefix="", io_counters=None):
+    """
+    Report calls to C{target}'s C{operations} to C{observer}, by replacing its
+    methods (on that instance only) with timed wrappers.
+
+    @param target: The instance to observe - a store, object or reverse lookup backend
+    @param observer: L{Observer}
+    @param operations: L{dict} of method name -> bytes extractor, eg L{CLIENT_OPERATIONS}
+    @param prefix: (Optional) Put in front of the method names to name the operations
+    @param io_counters: (Optional) Count system calls. By default they are counted if
+    C{/proc/thread-self/io} is readable - it costs a few microseconds an operation.
+    """
+    if io_counters is None:
+        io_counters = os.path.exists(IO_COUNTERS)
+    for name, extract in operations.items():
+        method = getattr(target, name, None)
+        if method is None:
+            continue
+        setattr(target, name, _timed(method, prefix + name, observer, extract, io_counters))
+    return target
+
+class _Stats(object):
+    __slots__ = ("count", "errors", "seconds", "bytes_read", "bytes_written",
+                 "syscalls_read", "syscalls_write", "buckets")
+
+    def __init__(self, nbuckets):
+        self.count = self.errors = 0
+        self.seconds = 0.0
+        self.bytes_read = self.bytes_written = 0
+        self.syscalls_read = self.syscalls_write = 0
+        self.buckets = [0] * nbuckets
+
+class MetricsCollector(Observer):
+    """
+    An observer which keeps, for each operation, its count, errors, total time, a
+    latency histogram, the bytes read and written, and the system calls made. It
+    is thread-safe.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        @param buckets: (Optional) Upper bounds, in seconds, of the latency histogram buckets
+        @type buckets: sorted sequence of floats
+        """
+        self.buckets = tuple(buckets)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation, seconds, bytes_read=0, bytes_written=0, syscalls=None, error=None):
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                stats = self._stats[operation] = _Stats(len(self.buckets))
+            stats.count += 1
+            if error is not None:
+                stats.errors += 1
+            stats.seconds += seconds
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+            if syscalls is not None:
+                stats.syscalls_read += syscalls[0]
+                stats.syscalls_write += syscalls[1]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+                    break
+
+    def snapshot(self):
+        """
+        @returns: L{dict} of operation -> L{dict} of C{count}, C{errors}, C{seconds},
+        C{bytes_read}, C{bytes_written}, C{syscalls_read}, C{syscalls_write} and
+        C{buckets} - a list of C{(upper bound, cumulative count)}, ending with
+        C{(float("inf"), count)}
+        """
+        with self._lock:
+            result = {}
+            for operation, stats in self._stats.items():
+                cumulative = []
+                total = 0
+                for bound, n in zip(self.buckets, stats.buckets):
+                    total += n
+                    cumulative.append((bound, total))
+                cumulative.append((float("inf"), stats.count))
+                result[operation] = {"count":stats.count, "errors":stats.errors,
+                                     "seconds":stats.seconds, "bytes_read":stats.bytes_read,
+                                     "bytes_written":stats.bytes_written,
+                                     "syscalls_read":stats.syscalls_read,
+                                     "syscalls_write":stats.syscalls_write,
+                                     "buckets":cumulative}
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class PrometheusExporter(object):
+    """
+    Writes the contents of a L{MetricsCollector} to a file in the Prometheus text
+    exposition format - now with L{write}, or every C{interval} seconds on a
+    background thread once L{start}ed. The file is replaced atomically, so a
+    scraper never reads half of it.
+    """
+    def __init__(self, collector, path, prefix="pairtree", interval=None):
+        """
+        @param collector: The L{MetricsCollector} to export
+        @param path: The file to write
+        @param prefix: (Optional) Put in front of the metric names
+        @param interval: (Optional) Seconds between writes, once started
+        """
+        self.collector = collector
+        self.path = path
+        self.prefix = prefix
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def render(self):
+        """
+        @returns: The metrics, as Prometheus text
+        """
+        p = self.prefix
+        snapshot = self.collector.snapshot()
+        operations = sorted(snapshot)
+        lines = ["# HELP %s_operation_seconds Time taken by pairtree operations" % p,
+                 "# TYPE %s_operation_seconds histogram" % p]
+        for operation in operations:
+            stats = snapshot[operation]
+            label = 'operation="%s"' % _label(operation)
+            for bound, count in stats["buckets"]:
+                lines.append('%s_operation_seconds_bucket{%s,le="%s"} %d' % (p, label, _number(bound), count))
+            lines.append("%s_operation_seconds_sum{%s} %s" % (p, label, _number(stats["seconds"])))
+            lines.append("%s_operation_seconds_count{%s} %d" % (p, label, stats["count"]))
+        for name, key, help in (("operation_errors_total", "errors", "Pairtree operations which raised an error"),
+                                ("bytes_read_total", "bytes_read", "Bytes of part data read"),
+                                ("bytes_written_total", "bytes_written", "Bytes of part data written")):
+            lines.append("# HELP %s_%s %s" % (p, name, help))
+            lines.append("# TYPE %s_%s counter" % (p, name))
+            for operation in operations:
+                lines.append('%s_%s{operation="%s"} %d' % (p, name, _label(operation), snapshot[operation][key]))
+        lines.append("# HELP %s_syscalls_total Read and write system calls made by pairtree operations" % p)
+        lines.append("# TYPE %s_syscalls_total counter" % p)
+        for operation in operations:
+            for kind in ("read", "write"):
+                lines.append('%s_syscalls_total{operation="%s",kind="%s"} %d'
+                             % (p, _label(operation), kind, snapshot[operation]["syscalls_" + kind]))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Write the metrics to the file now
+        """
+        dirpath = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=myutils.TEMP_PREFIX, dir=dirpath)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        """
+        Write the metrics every C{interval} seconds on a background thread
+        """
+        if not self.interval:
+            raise ValueError("the exporter needs an interval to write on")
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, and write the metrics one last time
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
@@ -13,6 +13,7 @@ As such, it shouldn't be instanciated directly.
 import os
 from pairtree.storage_exceptions import *
 from pairtree import myutils
+from pairtree.pairtree_metrics import instrument, OBJECT_OPERATIONS
 
 
 class PairtreeStorageObject(object):
@@ -115,6 +116,9 @@ class PairtreeStorageObject(object):
         self.id = id
         self.uri = "%s%s" % (self.fs.uri_base, id)
         self.location = location
+        observer = getattr(fs_store_client, "observer", None)
+        if observer is not None:
+            instrument(self, observer, OBJECT_OPERATIONS, "object.")
 
     def add_bytestream(self, filename, bytestream, path=None, buffer_size=None):
         """
@@ -131,9 +135,7 @@ class PairtreeStorageObject(object):
         to read in each cycle.
         @type buffer_size: L{int}
         """
-        if buffer_size:
-            return self.fs.put_stream(self.id, path, filename, bytestream, buffer_size)
-        return self.fs.put_stream(self.id, path, filename, bytestream)
+        return self.fs.put_stream(self.id, path, filename, bytestream, buffer_size)
 
     def add_bytestream_by_path(self, filepath, bytestream, buffer_size=None):
         """
@@ -158,7 +160,7 @@ class PairtreeStorageObject(object):
             return self.add_bytestream(filename, bytestream, path, buffer_size)
         return self.add_bytestream(filename, bytestream, path)
 
-    def get_bytestream(self, filename, streamable=False, path=None, appendable=False):
+    def get_bytestream(self, filename, streamable=False, path=None, appendable=False, mmap=False):
         """
         Reads a file from a pairtree object - If streamable is set to True,
         this returns the filehandle for that file, which must be C{close()}'d
@@ -172,6 +174,9 @@ class PairtreeStorageObject(object):
         
         If appendable is set to True, then the file is opened "wb+" and can accept writes.
         Otherwise, the file is opened read-only.
+
+        If mmap is set to True, a read-only C{memoryview} of a memory map of the file
+        is returned, which can be sliced without copying (see L{get_range} too).
         
         @param path: (Optional) subdirectory path to retrieve file from
         @type path: Directory path
@@ -181,14 +186,35 @@ class PairtreeStorageObject(object):
         I{remember to C{close()} the file!} If False, reads in the file into a 
         bytestring and return that instead.
         @type streamable: True|False
-        @returns: Either L{file} or L{str}
+        @param mmap: If True, return a read-only C{memoryview} of the file, memory mapped
+        @type mmap: True|False
+        @returns: Either L{file}, L{str} or L{memoryview}
         """
         if appendable:
             return self.fs.get_appendable_stream(self.id, path=path, stream_name=filename)
         else:
-            return self.fs.get_stream(self.id, path=path, stream_name=filename, streamable=streamable)
+            return self.fs.get_stream(self.id, path=path, stream_name=filename, streamable=streamable, mmap=mmap)
 
-    def get_bytestream_by_path(self, filepath, streamable=False, appendable=False):
+    def get_range(self, filename, offset, length=None, path=None):
+        """
+        Reads C{length} bytes from a file in this object, starting at C{offset}
+        (or to the end of the file if C{length} isn't given).
+
+        >>> header = object.get_range('image001.tif', 0, 8, 'data/images')
+
+        @param filename: Name of the file to read from
+        @type filename: filename
+        @param offset: Position in the file to start reading from
+        @type offset: L{int}
+        @param length: (Optional) Number of bytes to read
+        @type length: L{int}
+        @param path: (Optional) subdirectory path to retrieve file from
+        @type path: Directory path
+        @returns: L{str}
+        """
+        return self.fs.get_range(self.id, path, filename, offset, length)
+
+    def get_bytestream_by_path(self, filepath, streamable=False, appendable=False, mmap=False):
         """
         As L{get_bytestream}, but can ask for a file via a path:
         
@@ -201,10 +227,12 @@ class PairtreeStorageObject(object):
         I{remember to C{close()} the file!} If False, reads in the file into a 
         bytestring and return that instead.
         @type streamable: True|False
-        @returns: Either L{file} or L{str}
+        @param mmap: If True, return a read-only C{memoryview} of the file, memory mapped
+        @type mmap: True|False
+        @returns: Either L{file}, L{str} or L{memoryview}
         """
         path, filename = os.path.split(filepath)
-        return self.get_bytestream(filename, streamable, path, appendable)
+        return self.get_bytestream(filename, streamable, path, appendable, mmap)
 
     def add_directory(self, from_file_location):
         """
@@ -220,9 +248,9 @@ class PairtreeStorageObject(object):
 
     def add_file(self, from_file_location, path=None, new_filename=None, buffer_size=None):
         """
-        Adds a file from a given location. Currently, the copy is due via python buffering
-        the read from one file to the other. Might be easily replaceable with a C{shutil.copy}
-        at a later date.
+        Adds a file from a given location. The copy is done by the kernel where
+        possible (see L{PairtreeStorageClient.put_stream}), falling back to python
+        buffering the read from one file to the other.
         
         If no new filename is set, it will use the original filename
         
@@ -241,11 +269,8 @@ class PairtreeStorageObject(object):
         if os.path.exists(from_file_location):
             if not new_filename:
                 _, new_filename = os.path.split(from_file_location)
-            fh = open(from_file_location, 'rb')
-            if buffer_size:
+            with open(from_file_location, 'rb') as fh:
                 return self.fs.put_stream(self.id, path, new_filename, bytestream=fh, buffer_size=buffer_size)
-            return self.fs.put_stream(self.id, path, new_filename, bytestream=fh)
-            fh.close()
         else:
             raise FileNotFoundException
 
@@ -311,6 +336,20 @@ class PairtreeStorageObject(object):
         """
         return self.fs.list_parts(self.id, path)
 
+    def walk(self, path=None):
+        """
+        Walk every part of the object, in any subdirectory - see
+        L{PairtreeStorageClient.walk_parts}
+
+        >>> for part, st in object.walk():
+        ...     print(part, st.st_size)
+
+        @param path: (Optional) Only walk the parts in C{path}'s subdirectory
+        @type path: Directory path
+        @returns: L{ObjectWalk} of C{(part path, os.stat_result)}
+        """
+        return self.fs.walk_parts(self.id, path)
+
     def isfile(self, filepath):
         """
         Returns True or False depending on whether the path is a file or not.
@@ -345,10 +384,20 @@ class PairtreeStorageObject(object):
         @type filepath: Directory path
         @returns L{posix.stat_result} or False
         """
-        if self.isfile(filepath):
-            return self.fs.stat(self.id, filepath)
-        else:
-            return False
+        return self.fs.stat(self.id, filepath)
+
+    def checksum(self, filepath, algo=None):
+        """
+        Returns the checksum of a part, from the store's checksum cache if it is
+        still valid - see L{PairtreeStorageClient.checksum}
+
+        @param filepath: Path of the part within the object
+        @type filepath: Directory path
+        @param algo: (Optional) Hashing algorithm (Default: the store's first C{hashing_type})
+        @type algo: Any supported by C{hashlib}
+        @returns: hex digest
+        """
+        return self.fs.checksum(self.id, filepath, algo)
 
     def id_to_dirpath(self):
         """
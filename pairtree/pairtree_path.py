@@ -21,28 +21,51 @@ I{http://example.org/ark:/123}
 
 """
 
-import os, sys
+# Only what the codec needs is imported here - the ppath script, which imports
+# nothing else, is run once per id by some shell scripts. (multiprocessing is
+# imported when a pool is first used.)
 
-import binascii
+import os
+
+import re
 
-import logging
+import itertools
 
-logging.basicConfig(level=logging.INFO)
+import collections
 
-logger = logging.getLogger('pairtreepath')
+import functools
 
+import binascii
 
 PASS1_MATCHES = ['"', '*', '+', ",", '<', '=', '>', '?', '\\', '^', '|']
 
-if sys.version_info.major >= 3:
-    # for Python 3
-    PASS2_MAP = str.maketrans('/:.', '=+,')
-    REV_PASS2_MAP = str.maketrans('=+,', '/:.')
-else:
-    # for Python 2
-    import string
-    PASS2_MAP = string.maketrans('/:.', '=+,')
-    REV_PASS2_MAP = string.maketrans('=+,', '/:.')
+PASS2_MAP = str.maketrans('/:.', '=+,')
+REV_PASS2_MAP = str.maketrans('=+,', '/:.')
+
+# Precomputed translation tables, indexed by octet value (0-255). The encoder
+# works on the UTF-8 octets of the id, reinterpreted as latin-1 so that a single
+# str.translate() call can do the whole of the first pass (and optionally the
+# second pass too) in C.
+HEX_TABLE = dict((octet, "^%02x" % octet) for octet in range(256))
+
+FIRST_PASS_TABLE = dict((octet, code) for octet, code in HEX_TABLE.items()
+                        if octet < 0x21 or octet > 0x7e or chr(octet) in PASS1_MATCHES)
+
+ENCODE_TABLE = dict(FIRST_PASS_TABLE)
+ENCODE_TABLE.update((ord(a), b) for a, b in zip('/:.', '=+,'))
+
+# One or more consecutive ^hh escapes - decoded together so that multi-octet
+# UTF-8 sequences come back in one go. A lone '^' is an error.
+HEX_RUN = re.compile(r"(?:\^[0-9A-Fa-f]{2})+|\^")
+
+def _hex_run2uni(match):
+    """
+    re.sub callback - turns a run of ^hh escapes back into the characters they encode
+    """
+    run = match.group()
+    if len(run) == 1:
+        raise ValueError("Invalid pairtree hex escape")
+    return binascii.unhexlify(run.replace('^', '')).decode('utf-8')
 
 def first_pass(id):
     """
@@ -54,15 +77,9 @@ def first_pass(id):
     @type id: identifier
     @returns: Partially pairtree encoded id (hex in place of unicode & special ASCII)
     """
-    clean = []
-    for char in id:
-        if char in PASS1_MATCHES or ord(char) < 33:
-            clean.append(ascii2hex(char))
-        elif ord(char) > 126:
-            clean.append(uni2hex(char))
-        else:
-            clean.append(char)
-    return "".join(clean)
+    if not id.isascii():
+        id = id.encode('utf-8').decode('latin-1')
+    return id.translate(FIRST_PASS_TABLE)
 
 def second_pass(id):
     """
@@ -94,14 +111,7 @@ def uni2hex(char):
     @type char: unicode
     @returns: a string of hex digit pairs, each prepended with caret ^
     """
-    if sys.version_info.major >= 3:
-        # for Python3
-        codes = char.encode('utf-8')
-        return str(codes)[2:-1].replace('\\x', '^')
-    else:
-        # for Python2
-        codes = ["^%02x" % ord(c) for c in char]
-        return "".join(codes)
+    return char.encode('utf-8').decode('latin-1').translate(HEX_TABLE)
 
 
 def reverse_second_pass(id):
@@ -123,35 +133,9 @@ def reverse_first_pass(id):
     @type id: identifier
     @returns: original identifier
     """
-    index = 0
-    new_id = []
-    while index < len(id):
-        if id[index] == '^':
-            # found hex pair marker
-            num_hex_pairs = 1 
-            hexcode = get_hexcode(id, index, num_hex_pairs)
-            if int(hexcode, 16) < 127:
-                # its ASCII; convert and advance index by 3; ex: "^2a"
-                new_id.append(hex2ascii(hexcode))
-                index += 3
-            else:
-                # if unicode, try to decode. If error, keep adding hex pairs until it works
-                # then advance index by number of pairs * 3; ex: "^e3^82^a6" --> advance by 9
-                while True:
-                    num_hex_pairs += 1
-                    hexcode = get_hexcode(id, index, num_hex_pairs)
-                    try:
-                        new_id.append(hex2uni(hexcode))
-                        index += num_hex_pairs*3
-                        break
-                    except UnicodeDecodeError:
-                        if num_hex_pairs == 6:
-                            raise
-        else:
-            # simple ASCII; just pass it through untouched, and advance index by 1
-            new_id.append(id[index])
-            index += 1
-    return "".join(new_id)
+    if '^' not in id:
+        return id
+    return HEX_RUN.sub(_hex_run2uni, id)
 
 def get_hexcode(id, start, numpairs):
     """
@@ -184,24 +168,12 @@ def hex2ascii(code):
 def hex2uni(codes):
     """
     Converts multiple hex value pairs to a unicode character, if possible
-    For Python3, this method decodes the values and returns unicode.
         If codes == "e382a6" the return value is "ウ"
-    For Python2, it does not return the decoded the values
-        If codes == "e382a6" the return value is "\xe3\x82\xa6"
-        However, for Python2 it still attempts to decode the values to ensure the calling
-        method (reverse_second_pass) has passed the appropriate chunk of hex values
     @param codes: a string of multiple hex value pairs
     @type codes: string
     @returns: string of unicode
     """
-    codes = binascii.unhexlify(codes)
-    uni =  codes.decode('utf-8')
-    if sys.version_info.major >= 3:
-        # for Python3
-        return uni
-    else:
-        # for Python 2
-        return codes
+    return binascii.unhexlify(codes).decode('utf-8')
 
 def id_encode(id):
     """
@@ -249,14 +221,9 @@ def id_encode(id):
     @type id: identifier
     @returns: A string of the encoded identifier
     """
-    # Unicode or bust
-    if sys.version_info.major < 3 and isinstance(id, unicode):
-        # assume utf-8
-        # TODO - not assume encoding
-        id = id.encode('utf-8')
-
-    id = first_pass(id)
-    return second_pass(id)
+    if not id.isascii():
+        id = id.encode('utf-8').decode('latin-1')
+    return id.translate(ENCODE_TABLE)
 
 def id_decode(id):
     """
@@ -266,11 +233,9 @@ def id_decode(id):
     @type id: identifier
     @returns: A string of the decoded identifier
     """
-    id = reverse_second_pass(id)
-    id = reverse_first_pass(id)
-    if sys.version_info.major < 3:
-        # TODO - not assume encoding
-        id = id.decode('utf-8')
+    id = id.translate(REV_PASS2_MAP)
+    if '^' in id:
+        id = HEX_RUN.sub(_hex_run2uni, id)
     return id
 
 def get_id_from_dirpath(dirpath, pairtree_root=""):
@@ -332,8 +297,100 @@ def id_to_dir_list(id, pairtree_root="", shorty_length=2):
     dirpath = []
     if pairtree_root:
         dirpath = [pairtree_root]
-    while enc_id:
-        dirpath.append(enc_id[:shorty_length])
-        enc_id = enc_id[shorty_length:]
+    dirpath.extend(enc_id[i:i+shorty_length] for i in range(0, len(enc_id), shorty_length))
     return dirpath
 
+def _map_chunk(func, chunk):
+    """
+    Internal - worker side of L{_pool_map}; applies C{func} to a list of items.
+    """
+    return [func(item) for item in chunk]
+
+def _pool_map(func, items, processes, chunksize):
+    """
+    Internal - an ordered, lazy map over a process pool.
+
+    Unlike C{Pool.imap}, the input iterable is only consumed a few chunks ahead
+    of the results being read, so a huge (or endless) input such as C{sys.stdin}
+    is never held in memory all at once.
+    """
+    import multiprocessing
+    items = iter(items)
+    pending = collections.deque()
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            chunk = list(itertools.islice(items, chunksize))
+            if chunk:
+                pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+            while pending and (not chunk or len(pending) > processes * 2):
+                for result in pending.popleft().get():
+                    yield result
+            if not chunk:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _map_many(func, items, processes=None, chunksize=1000):
+    """
+    Internal - lazily map C{func} over C{items}, in-process or fanned out over
+    C{processes} worker processes. Results come back in input order either way.
+    """
+    if processes:
+        return _pool_map(func, items, processes, chunksize)
+    return map(func, items)
+
+def encode_many(ids, processes=None, chunksize=1000):
+    """
+    Batch version of L{id_encode}. Accepts any iterable of identifiers and lazily
+    yields their encoded forms, in order.
+
+        -  I{encode_many(["ark:/13030/xt12t3", "foo"]) --> "ark+=13030=xt12t3", "foo"}
+
+    @param ids: Identifiers to encode
+    @type ids: iterable
+    @param processes: (Optional) Number of worker processes to fan out to. By
+    default the work is done in the calling process.
+    @type processes: integer
+    @param chunksize: (Optional) Number of ids handed to a worker at a time
+    @type chunksize: integer
+    @returns: An iterator of encoded identifiers
+    """
+    return _map_many(id_encode, ids, processes, chunksize)
+
+def decode_many(encoded, processes=None, chunksize=1000):
+    """
+    Batch version of L{id_decode}. Accepts any iterable of encoded identifiers
+    and lazily yields the decoded identifiers, in order.
+
+    @param encoded: Encoded identifiers to decode
+    @type encoded: iterable
+    @param processes: (Optional) Number of worker processes to fan out to
+    @type processes: integer
+    @param chunksize: (Optional) Number of ids handed to a worker at a time
+    @type chunksize: integer
+    @returns: An iterator of decoded identifiers
+    """
+    return _map_many(id_decode, encoded, processes, chunksize)
+
+def dirpaths_many(ids, pairtree_root="", shorty_length=2, processes=None, chunksize=1000):
+    """
+    Batch version of L{id_to_dirpath}. Accepts any iterable of identifiers and
+    lazily yields the directory path for each, in order.
+
+    @param ids: Identifiers to turn into paths
+    @type ids: iterable
+    @param pairtree_root: (Optional) Path to prepend to each directory path
+    @type pairtree_root: Directory path
+    @param shorty_length: The size of the shorties (Default: 2)
+    @type shorty_length: integer
+    @param processes: (Optional) Number of worker processes to fan out to
+    @type processes: integer
+    @param chunksize: (Optional) Number of ids handed to a worker at a time
+    @type chunksize: integer
+    @returns: An iterator of directory paths
+    """
+    func = functools.partial(id_to_dirpath, pairtree_root=pairtree_root, shorty_length=shorty_length)
+    return _map_many(func, ids, processes, chunksize)
+
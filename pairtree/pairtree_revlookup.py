@@ -9,7 +9,7 @@ Conventions used:
 
 From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
 
-This is an implementation of a reverse lookup index, using the pairtree path spec to 
+This is an implementation of a reverse lookup index, using the pairtree path spec to
 record the link between local id and the id's that it corresponds to.
 
 eg to denote issn:1234-1234 as being linked to a global id of "uuid:1e4f..."
@@ -32,6 +32,23 @@ Usage
 >>> rl["issn:1234-1234"] = ["id:1", "uuid:32fad..."]
 >>>
 
+Backends
+========
+
+The links can be kept by one of several backends, chosen with C{backend}:
+
+    - 'file' (the default) - the pairtree layout above, one small file per link
+    - 'sqlite' - a single SQLite database, ROOT_DIR/pairtree_rl.db, in WAL mode.
+      Far fewer inodes and much faster lookups once there are millions of links.
+
+>>> rl = PairtreeReverseLookup(storage_dir="ROOT", backend="sqlite")
+
+An existing index can be moved from one backend to another with L{migrate}:
+
+>>> from pairtree.pairtree_revlookup import migrate
+>>> migrate("ROOT", source="file", target="sqlite")
+2041773
+
 Notes
 =====
 
@@ -43,79 +60,352 @@ A sqllite or similar lookup would also be effective, but this one relies solely
 
 import os
 
+import sqlite3
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
 from pairtree.pairtree_path import id_encode, id_decode, id_to_dirpath
 
+from pairtree.pairtree_metrics import instrument, REVLOOKUP_OPERATIONS
+
 PAIRTREE_RL = "pairtree_rl"
 
+PAIRTREE_RL_DB = "pairtree_rl.db"
+
+class FileBackend(object):
+  """
+  Keeps each link as a file, named for the encoded linked id, in the key's
+  pairtree directory under C{rl_dir}.
+  """
+  def __init__(self, rl_dir):
+    self.rl_dir = rl_dir
+
+  def _dirpath(self, key):
+    return id_to_dirpath(key, self.rl_dir)
+
+  def _files(self, dirpath):
+    # the key's directory also holds the shorty directories of longer keys
+    try:
+      with os.scandir(dirpath) as entries:
+        return [entry.name for entry in entries if not entry.is_dir(follow_symlinks=False)]
+    except OSError:
+      return []
+
+  def get(self, key):
+    return [id_decode(f) for f in self._files(self._dirpath(key))]
+
+  def add(self, key, ids):
+    dirpath = self._dirpath(key)
+    if not os.path.isdir(dirpath):
+      os.makedirs(dirpath, exist_ok=True)
+    existing = set(self._files(dirpath))
+    for new_id in ids:
+      enc_id = id_encode(new_id)
+      if enc_id not in existing:
+        with open(os.path.join(dirpath, enc_id), "w") as f:
+          f.write(new_id)
+        existing.add(enc_id)
+
+  def _grouped(self, keys):
+    # in directory order, so that neighbouring keys' shorties are visited together
+    return sorted(keys, key=self._dirpath)
+
+  def _map(self, func, items, threads):
+    if threads:
+      with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(func, items))
+    return [func(item) for item in items]
+
+  def add_many(self, links, threads=None):
+    """
+    Add C{(key, id)} links, grouped by key so that each key's directory is made
+    and listed only once, optionally spread over C{threads} threads
+    """
+    groups = {}
+    for key, id in links:
+      groups.setdefault(key, []).append(id)
+    self._map(lambda key: self.add(key, groups[key]), self._grouped(groups), threads)
+
+  def get_many(self, keys, threads=None):
+    """
+    @returns: L{dict} of the linked ids of each of C{keys}
+    """
+    keys = self._grouped(set(keys))
+    return dict(zip(keys, self._map(self.get, keys, threads)))
+
+  def contains(self, key, id):
+    return os.path.isfile(os.path.join(self._dirpath(key), id_encode(id)))
+
+  def count(self, key):
+    return len(self._files(self._dirpath(key)))
+
+  def delete(self, key):
+    dirpath = self._dirpath(key)
+    for f in self._files(dirpath):
+      os.remove(os.path.join(dirpath, f))
+    if os.path.isdir(dirpath):
+      try:
+        os.removedirs(dirpath)
+      except OSError:
+        # still holds the shorties of other keys
+        pass
+
+  def items(self):
+    """
+    Yield C{(key, ids)} for every key with links
+    """
+    stack = [(self.rl_dir, "")]
+    while stack:
+      dirpath, encoded = stack.pop()
+      files = []
+      try:
+        with os.scandir(dirpath) as entries:
+          for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+              stack.append((entry.path, encoded + entry.name))
+            else:
+              files.append(entry.name)
+      except OSError:
+        continue
+      if files and encoded:
+        yield id_decode(encoded), [id_decode(f) for f in files]
+
+  def close(self):
+    pass
+
+class SQLiteBackend(object):
+  """
+  Keeps the links in a single SQLite table, opened in WAL mode and shared
+  between threads.
+  """
+  def __init__(self, db_path):
+    self.db_path = db_path
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.execute("""CREATE TABLE IF NOT EXISTS links (
+                          key TEXT NOT NULL,
+                          id TEXT NOT NULL,
+                          PRIMARY KEY (key, id)
+                        ) WITHOUT ROWID""")
+
+  def _execute(self, sql, params=()):
+    with self._lock:
+      return self._db.execute(sql, params).fetchall()
+
+  def get(self, key):
+    return [row[0] for row in self._execute("SELECT id FROM links WHERE key = ?", (key,))]
+
+  def add(self, key, ids):
+    self.add_many((key, id) for id in ids)
+
+  def add_many(self, links, threads=None):
+    """
+    Add C{(key, id)} links in a single transaction. (SQLite has a single writer,
+    so C{threads} is ignored.)
+    """
+    with self._lock:
+      self._db.execute("BEGIN")
+      try:
+        self._db.executemany("INSERT OR IGNORE INTO links (key, id) VALUES (?, ?)", links)
+      except:
+        self._db.execute("ROLLBACK")
+        raise
+      self._db.execute("COMMIT")
+
+  def get_many(self, keys, threads=None, batch_size=500):
+    """
+    @returns: L{dict} of the linked ids of each of C{keys}, looked up C{batch_size} keys a query
+    """
+    result = dict((key, []) for key in keys)
+    keys = sorted(result)
+    for i in range(0, len(keys), batch_size):
+      chunk = keys[i:i + batch_size]
+      rows = self._execute("SELECT key, id FROM links WHERE key IN (%s)" % ",".join("?" * len(chunk)), chunk)
+      for key, id in rows:
+        result[key].append(id)
+    return result
+
+  def contains(self, key, id):
+    return bool(self._execute("SELECT 1 FROM links WHERE key = ? AND id = ?", (key, id)))
+
+  def count(self, key):
+    return self._execute("SELECT COUNT(*) FROM links WHERE key = ?", (key,))[0][0]
+
+  def delete(self, key):
+    self._execute("DELETE FROM links WHERE key = ?", (key,))
+
+  def items(self, batch_size=1000):
+    """
+    Yield C{(key, ids)} for every key with links, in key order
+    """
+    last = None
+    while True:
+      if last is None:
+        rows = self._execute("SELECT DISTINCT key FROM links ORDER BY key LIMIT ?", (batch_size,))
+      else:
+        rows = self._execute("SELECT DISTINCT key FROM links WHERE key > ? ORDER BY key LIMIT ?", (last, batch_size))
+      for row in rows:
+        yield row[0], self.get(row[0])
+      if len(rows) < batch_size:
+        return
+      last = rows[-1][0]
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+BACKENDS = ("file", "sqlite")
+
+def open_backend(storage_dir, backend="file"):
+  """
+  Open one of the L{BACKENDS} for the reverse lookup kept in C{storage_dir}
+
+  @param storage_dir: The directory the reverse lookup is kept in
+  @param backend: Name of the backend
+  @type backend: 'file'|'sqlite'
+  """
+  if backend == "file":
+    return FileBackend(os.path.join(storage_dir, PAIRTREE_RL))
+  elif backend == "sqlite":
+    return SQLiteBackend(os.path.join(storage_dir, PAIRTREE_RL_DB))
+  raise ValueError("backend must be one of %s" % (BACKENDS,))
+
+def migrate(storage_dir, source="file", target="sqlite", batch_size=1000):
+  """
+  Copy every link in the reverse lookup in C{storage_dir} from one backend to
+  another. The source is left as it was - remove it once the copy is checked.
+
+  @param storage_dir: The directory the reverse lookup is kept in
+  @param source: Backend (or name of one) to copy from
+  @param target: Backend (or name of one) to copy to
+  @param batch_size: Most links to add in one go
+  @returns: Number of links copied
+  """
+  if isinstance(source, str):
+    source = open_backend(storage_dir, source)
+  if isinstance(target, str):
+    target = open_backend(storage_dir, target)
+  copied = 0
+  batch = []
+  for key, ids in source.items():
+    copied += len(ids)
+    batch.extend((key, id) for id in ids)
+    if len(batch) >= batch_size:
+      target.add_many(batch)
+      batch = []
+  if batch:
+    target.add_many(batch)
+  return copied
+
 class PairtreeReverseLookup_list(object):
-  def __init__(self, rl_dir, id):
-    self._rl_dir = rl_dir
+  def __init__(self, backend, id):
+    if isinstance(backend, str):
+      # a pairtree_rl directory, as before backends were pluggable
+      backend = FileBackend(backend)
+    self._backend = backend
     self._id = id
-    self._dirpath = id_to_dirpath(self._id, self._rl_dir)
-  
+
   def _get_ids(self):
-    if os.path.isdir(self._dirpath):
-      ids = []
-      for f in os.listdir(self._dirpath):
-        ids.append(id_decode(f))
-      return ids
-    else:
-      return []
-  
+    return self._backend.get(self._id)
+
   def _add_id(self, new_id):
-    if not os.path.exists(self._dirpath):
-      os.makedirs(self._dirpath)
-    enc_id = id_encode(new_id)
-    if not os.path.isfile(enc_id):
-      with open(os.path.join(self._dirpath, enc_id), "w") as f:
-        f.write(new_id)
-  
+    self._backend.add(self._id, [new_id])
+
   def _exists(self, id):
-    if os.path.exists(self._dirpath):
-      return id_encode(id) in os.listdir(self._dirpath)
-    else:
-      return False
-  
+    return self._backend.contains(self._id, id)
+
   def append(self, *args):
-    [self._add_id(x) for x in args if not self._exists(x)]
-  
+    self._backend.add(self._id, args)
+
   def __len__(self):
-    return len(os.listdir(self._dirpath))
-  
+    return self._backend.count(self._id)
+
   def __repr__(self):
     return "ID:'%s' -> ['%s']" % (self._id, "','".join(self._get_ids()))
-  
+
   def __str__(self):
     return self.__repr__()
-  
+
   def __iter__(self):
-    for f in self._get_ids():
-      yield id_decode(f)
-    
+    return iter(self._get_ids())
+
+  def __contains__(self, id):
+    return self._exists(id)
+
 class PairtreeReverseLookup(object):
-  def __init__(self, storage_dir="data"):
+  def __init__(self, storage_dir="data", backend="file", observer=None):
+    """
+    @param storage_dir: The directory to keep the reverse lookup in
+    @param backend: (Optional) Name of the backend to use - 'file' or 'sqlite' - or a
+    backend object
+    @param observer: (Optional) Report the backend's operations to this observer, as
+    C{revlookup.get}, C{revlookup.add} and so on - see L{pairtree_metrics}
+    """
     self._storage_dir = storage_dir
     self._rl_dir = os.path.join(storage_dir, PAIRTREE_RL)
     self._init_store()
-  
+    if isinstance(backend, str):
+      backend = open_backend(storage_dir, backend)
+    self.backend = backend
+    if observer is not None:
+      instrument(backend, observer, REVLOOKUP_OPERATIONS, "revlookup.")
+
   def _init_store(self):
     if not os.path.isdir(self._storage_dir):
       os.makedirs(self._storage_dir)
-  
+
   def __getitem__(self, id):
-    return PairtreeReverseLookup_list(self._rl_dir, id)
-  
+    return PairtreeReverseLookup_list(self.backend, id)
+
   def __setitem__(self, id, value):
-    id_c = PairtreeReverseLookup_list(self._rl_dir, id)
-    if isinstance(list, value):
-      id_c.append(*value)
+    if isinstance(value, (list, tuple, set)):
+      self.backend.add(id, value)
     else:
-      id_c.append(value)
+      self.backend.add(id, [value])
+
+  def update(self, mapping, threads=None):
+    """
+    Add many links at once - like C{dict.update}, C{mapping} is either a mapping or an
+    iterable of C{(key, value)} pairs, and each value is an id or a list of ids. The
+    links are added in batches grouped by key.
+
+    >>> rl.update({"issn:1234-1234":["uuid:1e4f...", "id:1"], "doi:10.1000/182":"uuid:32fad..."})
+
+    @param mapping: links to add
+    @param threads: (Optional) Number of threads to spread the work over (file backend)
+    @type threads: integer
+    """
+    if hasattr(mapping, "items"):
+      mapping = mapping.items()
+    links = []
+    for key, value in mapping:
+      if isinstance(value, (list, tuple, set)):
+        links.extend((key, id) for id in value)
+      else:
+        links.append((key, value))
+    self.backend.add_many(links, threads)
+
+  def get_many(self, keys, threads=None):
+    """
+    Look up many keys at once
+
+    >>> rl.get_many(["issn:1234-1234", "doi:10.1000/182"])
+    {'issn:1234-1234': ['uuid:1e4f...', 'id:1'], 'doi:10.1000/182': ['uuid:32fad...']}
+
+    @param keys: iterable of keys
+    @param threads: (Optional) Number of threads to spread the work over (file backend)
+    @type threads: integer
+    @returns: L{dict} of the list of linked ids of each key (empty if it has none)
+    """
+    return self.backend.get_many(keys, threads)
 
   def __delitem__(self, id):
-    dirpath = id_to_dirpath(id, self._rl_dir)
-    if os.path.isdir(dirpath):
-      for f in os.listdir(dirpath):
-        os.remove(os.path.join(dirpath, f))
-      os.removedirs(dirpath)  # will throw OSError if the dir cannot be removed.
-      self._init_store() # just in case
+    self.backend.delete(id)
+    self._init_store() # just in case
+
+  def close(self):
+    self.backend.close()
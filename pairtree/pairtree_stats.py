@@ -0,0 +1,432 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Store statistics
+======================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+L{PairtreeStorageClient.stats} sizes up a whole store in one pass: every shorty
+directory and every object's directories are listed once with C{os.scandir},
+on a pool of threads, and the parts' sizes come from the same listing. The
+result, a L{StoreStats}, has the number of objects, parts and bytes, histograms
+of the bytes per object and of the depth of the objects in the tree (their number
+of shorties), and the largest objects seen.
+
+>>> report = store.stats(threads=16)
+>>> report.objects, report.bytes
+(1204332, 88210038211072)
+>>> report.as_dict()["size_histogram"]
+{'0': 12, '1024': 301, ..., '1073741824': 5120}
+
+Two options make it cheaper on very large stores:
+
+ - With C{sample=0.01}, only about 1% of the subtrees a couple of levels down
+   (see C{sample_depth}) are walked, chosen at random, and the counts are scaled
+   up to estimates for the whole store. C{largest} then only lists the largest
+   objects among those walked.
+
+ - With C{incremental=True}, what each directory held is kept in a SQLite
+   database next to the pairtree_prefix file. On the next run, a directory whose
+   modification time hasn't changed isn't listed again - its last listing is
+   used, so the pass costs one C{stat} per directory instead of a C{scandir} and
+   a C{stat} per part. Rewriting a part in place doesn't change its directory's
+   modification time, so a part whose size has changed that way is only noticed
+   once something is added to, or removed from, its directory. A directory
+   modified within C{RACY_WINDOW_NS} of the start of the scan is always listed
+   again next time, as a change made straight after it was listed could leave
+   its modification time as it was.
+"""
+
+import os
+
+import heapq
+
+import random
+
+import sqlite3
+
+import threading
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pairtree import myutils
+
+from pairtree.myutils import RACY_WINDOW_NS
+
+from pairtree import pairtree_path as ppath
+
+from pairtree.pairtree_index import prefix_upper_bound
+
+PAIRTREE_STATS = "pairtree_stats.db"
+
+def size_bucket(size):
+    """
+    The histogram bucket for an object of C{size} bytes - the smallest power of
+    two no smaller than it (0 for an empty object)
+    """
+    if not size:
+        return 0
+    return 1 << (size - 1).bit_length()
+
+class StoreStats(object):
+    """
+    The statistics of a store, or of part of one - see the module docs.
+    """
+    def __init__(self, top=10):
+        """
+        @param top: (Optional) Number of largest objects to keep
+        @type top: integer
+        """
+        self.top = top
+        self.objects = 0
+        self.parts = 0
+        self.bytes = 0
+        self.directories = 0
+        # bytes per object, bucketed by size_bucket -> number of objects
+        self.size_histogram = {}
+        # number of shorties -> number of objects
+        self.depth_histogram = {}
+        # heap of (size, encoded id)
+        self._largest = []
+        # fraction of the store's subtrees walked
+        self.sample = 1.0
+        # directories listed, and directories whose previous listing was reused
+        self.listed = 0
+        self.reused = 0
+        self.seconds = 0.0
+
+    def add_object(self, encoded, depth, parts, size):
+        self.objects += 1
+        self.parts += parts
+        self.bytes += size
+        bucket = size_bucket(size)
+        self.size_histogram[bucket] = self.size_histogram.get(bucket, 0) + 1
+        self.depth_histogram[depth] = self.depth_histogram.get(depth, 0) + 1
+        if len(self._largest) < self.top:
+            heapq.heappush(self._largest, (size, encoded))
+        elif self.top and (size, encoded) > self._largest[0]:
+            heapq.heapreplace(self._largest, (size, encoded))
+
+    def merge(self, other, weight=1.0):
+        """
+        Add the statistics of C{other} - a disjoint part of the store - to these,
+        scaling its counts up by C{weight} if it is a sample.
+        """
+        def scaled(n):
+            return int(round(n * weight))
+        self.objects += scaled(other.objects)
+        self.parts += scaled(other.parts)
+        self.bytes += scaled(other.bytes)
+        self.directories += scaled(other.directories)
+        for mine, theirs in ((self.size_histogram, other.size_histogram),
+                             (self.depth_histogram, other.depth_histogram)):
+            for key, n in theirs.items():
+                mine[key] = mine.get(key, 0) + scaled(n)
+        for item in other._largest:
+            if len(self._largest) < self.top:
+                heapq.heappush(self._largest, item)
+            elif self.top and item > self._largest[0]:
+                heapq.heapreplace(self._largest, item)
+        self.listed += other.listed
+        self.reused += other.reused
+
+    @property
+    def largest(self):
+        """
+        @returns: L{list} of C{(id, size)}, largest first
+        """
+        return [(ppath.id_decode(encoded), size) for size, encoded in sorted(self._largest, reverse=True)]
+
+    def as_dict(self):
+        """
+        @returns: The statistics as a L{dict} which can be dumped as JSON
+        """
+        return {"objects":self.objects,
+                "parts":self.parts,
+                "bytes":self.bytes,
+                "directories":self.directories,
+                "size_histogram":dict((str(k), v) for k, v in sorted(self.size_histogram.items())),
+                "depth_histogram":dict((str(k), v) for k, v in sorted(self.depth_histogram.items())),
+                "largest":[{"id":id, "bytes":size} for id, size in self.largest],
+                "sample":self.sample,
+                "listed":self.listed,
+                "reused":self.reused,
+                "seconds":round(self.seconds, 3)}
+
+class StatsState(object):
+    """
+    What each directory of a store held when it was last listed, for incremental
+    L{StatsScan}s - a SQLite database, shared between threads like L{PairtreeIndex}.
+    Writes are buffered, and committed a batch at a time.
+    """
+    def __init__(self, db_path, batch_size=1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                              path TEXT PRIMARY KEY,
+                              mtime_ns INTEGER NOT NULL,
+                              shorties TEXT NOT NULL,
+                              files INTEGER NOT NULL,
+                              bytes INTEGER NOT NULL,
+                              subdirs TEXT NOT NULL
+                            ) WITHOUT ROWID""")
+
+    def get(self, path):
+        """
+        @returns: C{(mtime_ns, shorties, files, bytes, subdirs)} from the last listing of
+        the directory at C{path} (relative to the pairtree_root), or None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT mtime_ns, shorties, files, bytes, subdirs FROM dirs WHERE path = ?",
+                                   (path,)).fetchone()
+        if row is None:
+            return None
+        return row[0], _split(row[1]), row[2], row[3], _split(row[4])
+
+    def put(self, path, mtime_ns, shorties, files, nbytes, subdirs):
+        with self._lock:
+            self._pending.append((path, mtime_ns, "/".join(shorties), files, nbytes, "/".join(subdirs)))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def forget(self, path):
+        """
+        Drop the directory at C{path}, and everything below it
+        """
+        below = path + os.sep
+        upper = prefix_upper_bound(below)
+        with self._lock:
+            self._flush()
+            self._db.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, below, upper))
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)", self._pending)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._pending = []
+
+    def close(self):
+        with self._lock:
+            self._flush()
+        self._db.close()
+
+def _split(names):
+    return names.split("/") if names else []
+
+class StatsScan(object):
+    """
+    One pass over a store, gathering its L{StoreStats} - see the module docs and
+    L{PairtreeStorageClient.stats}.
+    """
+    def __init__(self, store, threads=None, sample=None, incremental=False, top=10,
+                 sample_depth=2, seed=None):
+        """
+        @param store: The store to scan
+        @type store: L{PairtreeStorageClient}
+        @param threads: (Optional) Number of threads to scan with
+        @param sample: (Optional) Fraction (0-1] of the subtrees to walk
+        @param incremental: (Optional) Reuse the listings of directories which haven't changed
+        @param top: (Optional) Number of largest objects to report
+        @param sample_depth: (Optional) Depth of the subtrees sampled
+        @param seed: (Optional) Random seed for choosing the sample
+        """
+        if sample is not None and not 0 < sample <= 1:
+            raise ValueError("sample must be a fraction between 0 and 1")
+        self.store = store
+        self.threads = threads
+        self.sample = sample
+        self.incremental = incremental
+        self.top = top
+        self.sample_depth = sample_depth
+        self.seed = seed
+        self.state = None
+
+    def run(self):
+        """
+        @returns: L{StoreStats}
+        """
+        started = time.time()
+        self._started_ns = time.time_ns()
+        if self.incremental:
+            self.state = StatsState(os.path.join(self.store.store_dir, PAIRTREE_STATS))
+        try:
+            report = StoreStats(self.top)
+            if self.sample and self.sample < 1:
+                exact, units = self._sample_units()
+                chosen = [x for x in units if self._rng.random() < self.sample]
+                if units and not chosen:
+                    chosen = [self._rng.choice(units)]
+                report.merge(self._scan_all(exact))
+                if chosen:
+                    report.merge(self._scan_all(chosen), float(len(units)) / len(chosen))
+                    report.sample = float(len(chosen)) / len(units)
+            else:
+                if self.threads:
+                    units = [x for partition in self.store.partitions(self.threads) for x in partition]
+                else:
+                    units = [(x, True) for x in self.store._list_shorties(self.store.pairtree_root)]
+                report.merge(self._scan_all(units))
+        finally:
+            if self.state is not None:
+                self.state.close()
+                self.state = None
+        report.seconds = time.time() - started
+        return report
+
+    @property
+    def _rng(self):
+        if not hasattr(self, "_random"):
+            self._random = random.Random(self.seed)
+        return self._random
+
+    def _sample_units(self):
+        """
+        Internal - the work units for a sample: the shorty directories above
+        C{sample_depth}, to be scanned on their own (and counted exactly), and the
+        subtrees at C{sample_depth}, to sample from.
+        """
+        exact = []
+        level = [""]
+        for depth in range(self.sample_depth):
+            below = []
+            for relpath in level:
+                for name in self.store._list_shorties(os.path.join(self.store.pairtree_root, relpath)):
+                    below.append(os.path.join(relpath, name) if relpath else name)
+            if depth < self.sample_depth - 1:
+                exact.extend((x, False) for x in below)
+            level = below
+        return exact, [(x, True) for x in level]
+
+    def _scan_all(self, units):
+        report = StoreStats(self.top)
+        if self.threads and len(units) > 1:
+            with ThreadPoolExecutor(self.threads) as executor:
+                for partial in executor.map(self._scan_unit, units):
+                    report.merge(partial)
+        else:
+            for unit in units:
+                report.merge(self._scan_unit(unit))
+        return report
+
+    def _scan_unit(self, unit):
+        """
+        Internal - the statistics of one work unit, C{(shorty_path, recursive)}
+        as from L{PairtreeStorageClient.partitions}
+        """
+        shorty_path, recursive = unit
+        stats = StoreStats(self.top)
+        encoded = shorty_path.replace(os.sep, "")
+        depth = shorty_path.count(os.sep) + 1
+        stack = [(shorty_path, encoded, depth)]
+        while stack:
+            relpath, encoded, depth = stack.pop()
+            listing = self._listing(relpath, stats, True)
+            if listing is None:
+                # removed while we were walking
+                continue
+            shorties, files, nbytes, subdirs = listing
+            stats.directories += 1
+            if files or subdirs:
+                for subdir in subdirs:
+                    more_files, more_bytes = self._content(os.path.join(relpath, subdir), stats)
+                    files += more_files
+                    nbytes += more_bytes
+                stats.add_object(encoded, depth, files, nbytes)
+            if recursive:
+                stack.extend((os.path.join(relpath, name), encoded + name, depth + 1) for name in shorties)
+        return stats
+
+    def _content(self, relpath, stats):
+        """
+        Internal - the number of parts, and their total size, in the object
+        subdirectory at C{relpath} and below
+        """
+        files = nbytes = 0
+        stack = [relpath]
+        while stack:
+            current = stack.pop()
+            listing = self._listing(current, stats, False)
+            if listing is None:
+                continue
+            _, more_files, more_bytes, subdirs = listing
+            files += more_files
+            nbytes += more_bytes
+            stack.extend(os.path.join(current, name) for name in subdirs)
+        return files, nbytes
+
+    def _listing(self, relpath, stats, shorty_dir):
+        """
+        Internal - what the directory at C{relpath} (relative to the pairtree_root)
+        holds: C{(shorties, files, bytes, subdirs)}, where C{files} and C{bytes}
+        count the parts directly inside it. In a shorty directory, the short names
+        are other objects' shorties; in an object's subdirectory, every name is
+        part of the object. With an incremental scan, the last listing is reused
+        if the directory hasn't changed since.
+
+        @returns: L{tuple}, or None if the directory has gone
+        """
+        dirpath = os.path.join(self.store.pairtree_root, relpath)
+        state = self.state
+        mtime_ns = cached = None
+        if state is not None:
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                return None
+            cached = state.get(relpath)
+            if cached is not None and cached[0] == mtime_ns:
+                stats.reused += 1
+                return cached[1:]
+        shorty_length = self.store.shorty_length
+        shorties = []
+        subdirs = []
+        files = nbytes = 0
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if shorty_dir and len(name) <= shorty_length:
+                        if entry.is_dir():
+                            shorties.append(name)
+                        continue
+                    if name.startswith(myutils.TEMP_PREFIX):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(name)
+                    else:
+                        try:
+                            nbytes += entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            continue
+                        files += 1
+        except OSError:
+            return None
+        stats.listed += 1
+        if state is not None:
+            if cached is not None:
+                # whatever has gone from the directory has gone from the state too
+                for name in set(cached[1] + cached[4]) - set(shorties + subdirs):
+                    state.forget(os.path.join(relpath, name))
+            if mtime_ns >= self._started_ns - RACY_WINDOW_NS:
+                # too recent to trust - kept, so the next run can tell what has
+                # gone, but with an mtime that will never match
+                mtime_ns = -1
+            state.put(relpath, mtime_ns, shorties, files, nbytes, subdirs)
+        return shorties, files, nbytes, subdirs
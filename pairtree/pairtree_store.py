@@ -26,15 +26,21 @@ I{http://example.org/ark:/123}
 
 from pairtree.pairtree_client import PairtreeStorageClient
 
+from pairtree import myutils
+
 class PairtreeStorageFactory(object):
 
-    def get_store(self, store_dir="data", uri_base=None, shorty_length=2, hashing_type = None):
+    def get_store(self, store_dir="data", uri_base=None, shorty_length=2, hashing_type = None, cache_size=1024, index=False,
+                  atomic_writes=False, fsync=None, fixity=False, checksum_cache=0,
+                  hash_thread=False, manifest_cache=0, fast_delete=False, reaper_threads=2,
+                  observer=None):
         """
         Get a store - if the store does not exist, one will be instanciated
         
         If hashing_type is set to one of the hashing algorithms supported by
-        hashlib - ['md5', 'sha1', 'sha224','sha256','sha384','sha512'] then
+        hashlib (eg 'md5', 'sha256', 'sha3_256', 'blake2b'), or a list of them, then
         all bytestreams will be checksummed when added or updated and their sums returned.
+        Several algorithms are computed in a single pass over the data.
         
         @param store_dir: The file directory where the pairtree store is
         @type store_dir: A path to a directory, relative or absolute
@@ -42,10 +48,37 @@ class PairtreeStorageFactory(object):
         @type uri_base: A URI fragment, like "http://example.org/"
         @param shorty_length: The size of the shorties in the pairtree implementation (Default: 2)
         @type shorty_length: integer
-        @param hashing_type: The name of the algorithm to use when hashing files, if left as None, this is disabled.
-        @type hashing_type: Any supported by C{hashlib}
+        @param hashing_type: The name of the algorithm to use when hashing files, or a list of
+        them. If left as None, this is disabled.
+        @type hashing_type: Any supported by C{hashlib}, or a list of them
+        @param cache_size: (Optional) Number of id to directory path resolutions to memoise
+        @type cache_size: integer
+        @param index: (Optional) Keep an index of the objects in the store (see L{PairtreeIndex})
+        @type index: bool
+        @param atomic_writes: (Optional) Write parts to a temporary file and rename them into place
+        @type atomic_writes: bool
+        @param fsync: (Optional) Durability policy for writes: None, 'always' or 'batch'
+        @type fsync: None|'always'|'batch'
+        @param fixity: (Optional) Record part checksums so the store can be audited (see L{FixityDB})
+        @type fixity: bool
+        @param checksum_cache: (Optional) Number of part checksums to cache on disc (see L{ChecksumCache})
+        @type checksum_cache: integer
+        @param hash_thread: (Optional) Hash on helper threads, alongside the writes
+        @type hash_thread: bool
+        @param manifest_cache: (Optional) Number of object manifests to keep in memory (see L{ObjectManifest})
+        @type manifest_cache: integer
+        @param fast_delete: (Optional) Delete objects by renaming them into the store's trash,
+        to be removed in the background (see L{Reaper})
+        @type fast_delete: bool
+        @param reaper_threads: (Optional) Number of threads to empty the trash with
+        @type reaper_threads: integer
+        @param observer: (Optional) Report the store's operations to this observer (see L{MetricsCollector})
+        @type observer: L{Observer}
         @returns: L{PairtreeStorageClient}
         """
-        if hashing_type and hashing_type not in ['md5', 'sha1', 'sha224','sha256','sha384','sha512']:
-            raise Exception("hashing type must be on of the supported hashlib types: md5, sha1, sha224, sha256, sha384, sha512")
-        return PairtreeStorageClient(uri_base, store_dir, shorty_length, hashing_type)
+        myutils.check_hashing_types(hashing_type)
+        return PairtreeStorageClient(uri_base, store_dir, shorty_length, hashing_type, cache_size, index,
+                                     atomic_writes=atomic_writes, fsync=fsync, fixity=fixity,
+                                     checksum_cache=checksum_cache, hash_thread=hash_thread,
+                                     manifest_cache=manifest_cache, fast_delete=fast_delete,
+                                     reaper_threads=reaper_threads, observer=observer)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+FS Pairtree storage - Deferred deletion
+=======================================
+
+Conventions used:
+
+From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html version 0.1
+
+Deleting an object part by part takes as long as the object is big. A fast
+delete (see the C{fast_delete} option of L{PairtreeStorageClient}) instead
+renames the object's directory into the store's trash directory,
+I{pairtree_trash/}, next to I{pairtree_root/} - on the same filesystem, so the
+rename is atomic and the object is gone from the tree at once. (If other
+objects' shorty directories live inside it, its own parts are renamed across
+one by one instead, and the directory is left for them.)
+
+A L{Reaper} then removes what is in the trash on a small pool of background
+threads. Anything left behind by a crash is picked up by the next
+L{Reaper.reap_all}, which a store opened with C{fast_delete} runs when it starts.
+"""
+
+import os
+
+import tempfile
+
+import threading
+
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+PAIRTREE_TRASH = "pairtree_trash"
+
+logger = logging.getLogger('pairtreetrash')
+
+def remove_tree(path):
+    """
+    Remove C{path} and everything under it, one C{scandir} per directory -
+    files as they are listed, then each directory once it is empty. Symbolic
+    links are removed, never followed.
+
+    @param path: Directory (or file) to remove
+    @raise OSError: If something can't be removed
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.remove(path)
+        return
+    # (path, listed) - a directory is removed the second time it comes off the stack
+    stack = [(path, False)]
+    while stack:
+        current, listed = stack.pop()
+        if listed:
+            os.rmdir(current)
+            continue
+        stack.append((current, True))
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, False))
+                else:
+                    os.remove(entry.path)
+
+class Reaper(object):
+    """
+    Removes the contents of a trash directory on a bounded pool of background
+    threads. The threads are started on first use.
+    """
+    def __init__(self, trash_dir, threads=2):
+        """
+        @param trash_dir: The trash directory, created if need be
+        @type trash_dir: Directory path
+        @param threads: (Optional) Most directories to remove at once
+        @type threads: integer
+        """
+        self.trash_dir = trash_dir
+        self.threads = threads
+        self.reaped = 0
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(trash_dir):
+            os.makedirs(trash_dir, exist_ok=True)
+
+    def bin(self):
+        """
+        A new, empty, directory in the trash to rename things into. Nothing in
+        it is removed until it is handed to L{reap}.
+
+        @returns: Directory path
+        """
+        return tempfile.mkdtemp(dir=self.trash_dir)
+
+    def reap(self, path):
+        """
+        Remove C{path}, a directory in the trash, in the background
+
+        @param path: Directory path, as returned by L{bin}
+        """
+        with self._lock:
+            if path in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            self._pending[path] = self._executor.submit(self._remove, path)
+
+    def _remove(self, path):
+        try:
+            remove_tree(path)
+            with self._lock:
+                self.reaped += 1
+        except OSError as e:
+            # left in the trash for the next reap_all
+            logger.info("could not empty %s from the trash: %s" % (path, e))
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+
+    def reap_all(self):
+        """
+        Remove everything in the trash in the background, including anything left
+        there by an earlier process.
+        """
+        try:
+            names = os.listdir(self.trash_dir)
+        except OSError:
+            return
+        for name in names:
+            self.reap(os.path.join(self.trash_dir, name))
+
+    def pending(self):
+        """
+        @returns: Number of directories still waiting to be removed
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def wait(self):
+        """
+        Block until everything handed to L{reap} so far has been removed
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        Wait for the removals in hand, and stop the threads
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
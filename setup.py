@@ -9,7 +9,7 @@ From http://www.cdlib.org/inside/diglib/pairtree/pairtreespec.html : Pairtree, a
       author="Ben O'Steen",
       author_email="bosteen@gmail.com",
       url="http://packages.python.org/Pairtree/",
-      scripts = ['bin/ppath'],
+      scripts = ['bin/ppath', 'bin/pairtree'],
       license="http://www.apache.org/licenses/LICENSE-2.0",
       packages=find_packages(),
       test_suite = "tests.test.TestPairtree",
@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+import unittest, tempfile, os, shutil, asyncio
+from pairtree import AsyncPairtreeStorageClient, PartNotFoundException
+
+
+class TestAsyncPairtree(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.base_dir, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_concurrent_puts_and_reads(self):
+        async def run():
+            async with AsyncPairtreeStorageClient("http://dummy", self.data_dir, max_workers=4) as store:
+                ids = [u'ark:/13030/%d' % i for i in range(50)]
+                await asyncio.gather(*[store.put_stream(id, None, 'part', id.encode('utf-8')) for id in ids])
+                self.assertTrue(await store.exists(ids[0]))
+                self.assertEqual(await store.list_parts(ids[0]), ['part'])
+                contents = await asyncio.gather(*[store.get_stream(id, None, 'part') for id in ids])
+                self.assertEqual(contents, [id.encode('utf-8') for id in ids])
+                listed = [id async for id in store.list_ids(batch_size=7)]
+                self.assertEqual(sorted(listed), sorted(ids))
+                await store.delete_object(ids[0])
+                self.assertFalse(await store.exists(ids[0]))
+        asyncio.run(run())
+
+    def test_async_iterable_upload_and_chunked_read(self):
+        chunks = [os.urandom(1000) for i in range(20)]
+
+        async def produce():
+            for chunk in chunks:
+                await asyncio.sleep(0)
+                yield chunk
+
+        async def run():
+            async with AsyncPairtreeStorageClient("http://dummy", self.data_dir, hashing_type='md5') as store:
+                obj = await store.get_object('foo')
+                result = await obj.add_bytestream('upload.bin', produce())
+                self.assertEqual(result['type'], 'md5')
+                self.assertEqual(await obj.get_bytestream('upload.bin'), b"".join(chunks))
+                read = [chunk async for chunk in obj.iter_bytestream('upload.bin', chunk_size=4096)]
+                self.assertEqual(b"".join(read), b"".join(chunks))
+                self.assertTrue(all(len(chunk) <= 4096 for chunk in read))
+                self.assertEqual(await obj.get_range('upload.bin', 10, 5), b"".join(chunks)[10:15])
+                with self.assertRaises(PartNotFoundException):
+                    await obj.get_range('missing.bin', 0)
+        asyncio.run(run())
+
+    def test_store_to_store_copies_beyond_max_concurrency(self):
+        parts = dict(('part%d' % i, os.urandom(200000)) for i in range(8))
+
+        async def copy(source, target, name):
+            chunks = source.iter_stream('src', None, name, chunk_size=4096)
+            await target.put_stream('dst', None, name, chunks, buffer_size=8192)
+
+        async def run():
+            async with AsyncPairtreeStorageClient("http://dummy", self.data_dir, max_workers=2) as source, \
+                       AsyncPairtreeStorageClient("http://dummy", os.path.join(self.base_dir, 'other'),
+                                                  max_workers=2, hashing_type='md5') as other:
+                for name, data in parts.items():
+                    await source.put_stream('src', None, name, data)
+                # more copies than either store lets run at once, within a store and between two
+                await asyncio.wait_for(asyncio.gather(*[copy(source, source, name) for name in parts]), 30)
+                await asyncio.wait_for(asyncio.gather(*[copy(source, other, name) for name in parts]), 30)
+                for name, data in parts.items():
+                    self.assertEqual(await source.get_stream('dst', None, name), data)
+                    self.assertEqual(await other.get_stream('dst', None, name), data)
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
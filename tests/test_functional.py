@@ -1,6 +1,6 @@
 # -*- coding: UTF-8 -*-
-import unittest, tempfile, os, shutil, hashlib
-from pairtree import PairtreeStorageFactory
+import unittest, tempfile, os, shutil, hashlib, sqlite3, time
+from pairtree import PairtreeStorageFactory, PairtreeStorageClient, PartNotFoundException, ObjectNotFoundException
 from io import BytesIO
 
 
@@ -102,9 +102,573 @@ class TestPairtree(unittest.TestCase):
 
         self.assertFalse(os.path.exists(object.location))
 
+    def test_dirpath_cache_counts_hits_and_is_invalidated_by_delete(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy", cache_size=2)
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'foo')
+        self.assertTrue(store.stat('test', 'foo.txt'))
+        self.assertFalse(store.stat('test', 'missing.txt'))
+        info = store.cache_info()
+        self.assertEqual(info['dirpath']['misses'], 1)
+        self.assertTrue(info['dirpath']['hits'] >= 3)
+        self.assertEqual(store._get_id_from_dirpath(object.location), 'test')
+        self.assertEqual(store.cache_info()['id']['hits'], 1)
 
+        store.delete_object('test')
+        self.assertEqual(store.cache_info()['dirpath']['size'], 0)
+        self.assertEqual(store.cache_info()['id']['size'], 0)
 
+        for id in ['a', 'b', 'c']:
+            store._id_to_dirpath(id)
+        self.assertEqual(store.cache_info()['dirpath']['size'], 2)
 
+    def test_list_ids_split_ends(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        ids = ['abcdef', 'abcde', 'abcdefgh', 'x', u'owërdœ.file']
+        for id in ids:
+            store.create_object(id).add_bytestream('foo.txt', b'foo')
+        store.create_object('empty')
+        self.assertEqual(sorted(store.list_ids()), sorted(ids))
+        self.assertEqual(sorted(store.list_ids(threads=3)), sorted(ids))
+
+    def test_list_ids_shards_are_disjoint_and_complete(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        ids = ['ab', 'abcd', 'abcdef', 'x'] + ['id:%d' % x for x in range(200)]
+        for id in ids:
+            store.get_object(id).add_bytestream('foo.txt', b'foo')
+        for n in (1, 3, 7):
+            shards = [list(store.list_ids(shard=i, num_shards=n)) for i in range(n)]
+            found = [id for shard in shards for id in shard]
+            self.assertEqual(sorted(found), sorted(ids))
+            self.assertEqual(store.partitions(n), store.partitions(n))
+        for shard, num_shards in ((None, 3), (1, None), (3, 3), (-1, 3), (0, 0)):
+            self.assertRaises(ValueError, list, store.list_ids(shard=shard, num_shards=num_shards))
+
+    def test_index_tracks_objects_and_sizes(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy", index=True)
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'hello')
+        object.add_bytestream('foo.txt', b'hi')
+        object.add_bytestream('bar.txt', b'123', path='data')
+        store.create_object('empty')
+        self.assertEqual(store.index.get('test')['size'], 5)
+        self.assertEqual(list(store.list_ids()), ['test'])
+        self.assertEqual(store.count_objects(), 1)
+        store.get_object('empty').add_bytestream('foo.txt', b'')
+        self.assertEqual(list(store.list_ids()), ['empty', 'test'])
+
+        object.del_file('foo.txt')
+        self.assertEqual(store.index.get('test')['size'], 3)
+        with store.get_appendable_stream('test', 'data', 'bar.txt') as stream:
+            stream.write(b'45')
+        self.assertEqual(store.index.get('test')['size'], 5)
+        store.delete_object('empty')
+        self.assertFalse('empty' in store.index)
+        self.assertEqual(store.count_objects(), 1)
+
+    def test_index_and_walk_agree(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy", index=True)
+        store.create_object('empty')
+        store.create_object('emptied').add_bytestream('foo.txt', b'foo')
+        store.del_stream('emptied', 'foo.txt')
+        store.create_object('pruned').add_bytestream('a.txt', b'a', path='data')
+        store.del_path('pruned', 'data', recursive=True)
+        store.create_object('kept').add_bytestream('b.txt', b'b', path='data')
+        store.create_object('appended')
+        store.get_appendable_stream('appended', None, 'log.txt').close()
+        # with threads, list_ids walks the tree even though there is an index
+        walked = sorted(store.list_ids(threads=2))
+        self.assertEqual(walked, ['appended', 'kept'])
+        self.assertEqual(list(store.list_ids()), walked)
+        store.rebuild_index()
+        self.assertEqual(list(store.list_ids()), walked)
+
+    def test_rebuild_index(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        for id in ['a', 'abcd', 'b']:
+            store.create_object(id).add_bytestream('foo.txt', b'foo')
+        store.rebuild_index()
+        self.assertEqual(list(store.index.ids()), ['a', 'abcd', 'b'])
+        self.assertEqual(list(store.index.ids(prefix='ab')), ['abcd'])
+        self.assertEqual(store.index.total_size(), 9)
+
+    def test_index_schema_is_migrated(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        store.create_object('ark:/1').add_bytestream('foo.txt', b'foo')
+        db = sqlite3.connect(os.path.join(self.data_dir, 'pairtree_index.db'))
+        db.execute("CREATE TABLE objects (id TEXT PRIMARY KEY, created REAL NOT NULL, "
+                   "size INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+        db.execute("INSERT INTO objects VALUES ('ark:/1', 0, 3)")
+        db.commit()
+        db.close()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy", index=True)
+        self.assertEqual(list(store.list_ids(prefix='ark:')), ['ark:/1'])
+        self.assertEqual(store.index.get('ark:/1')['size'], 3)
+        store.create_object('ark:/2').add_bytestream('foo.txt', b'foo')
+        self.assertEqual(store.count_objects(), 2)
+
+    def test_list_ids_prefix_and_range(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        ids = ['ark:/13030/xt12t3', 'ark:/13030/xt12t4', 'ark:/13030/xt2', 'ark:/13031/a', 'ab', 'abc']
+        for id in ids:
+            store.get_object(id).add_bytestream('foo.txt', b'foo')
+        self.assertEqual(list(store.list_ids(prefix='ark:/13030/xt')),
+                         ['ark:/13030/xt12t3', 'ark:/13030/xt12t4', 'ark:/13030/xt2'])
+        self.assertEqual(list(store.list_ids(prefix='ab')), ['ab', 'abc'])
+        self.assertEqual(list(store.list_ids(prefix='nothing')), [])
+        self.assertEqual(list(store.list_ids(start='ark:/13030/xt12t4', stop='ark:/13031')),
+                         ['ark:/13030/xt12t4', 'ark:/13030/xt2'])
+        self.assertEqual(list(store.list_ids(prefix='ark:/1303', stop='ark:/13030/xt2')),
+                         ['ark:/13030/xt12t3', 'ark:/13030/xt12t4'])
+        self.assertRaises(ValueError, list, store.list_ids(prefix='ab', threads=2))
+
+        bounds = [dict(prefix='ab', stop='a'), dict(prefix='abcd', stop='abc'), dict(prefix='abc', stop='abc'),
+                  dict(prefix='ab', stop='abc'), dict(start='abc', stop='ab'), dict(prefix='ark:/13030/xt1', stop='ark')]
+        walked = [list(store.list_ids(**kw)) for kw in bounds]
+        self.assertEqual(walked[:2], [[], []])
+        store.rebuild_index()
+        self.assertEqual([list(store.list_ids(**kw)) for kw in bounds], walked)
+        self.assertEqual(list(store.list_ids(prefix='ark:/13030/xt')),
+                         ['ark:/13030/xt12t3', 'ark:/13030/xt12t4', 'ark:/13030/xt2'])
+        self.assertEqual(list(store.list_ids(start='ark:/13030/xt12t4', stop='ark:/13031')),
+                         ['ark:/13030/xt12t4', 'ark:/13030/xt2'])
+
+    def test_add_file_zero_copy_and_hashed_paths_are_identical(self):
+        storage_factory = PairtreeStorageFactory()
+        source = os.path.join(self.base_dir, 'source.bin')
+        data = os.urandom(1024 * 1024 + 123)
+        with open(source, 'wb') as f:
+            f.write(data)
+        for hashing_type in (None, 'sha256'):
+            store = storage_factory.get_store(store_dir=os.path.join(self.base_dir, str(hashing_type)),
+                                              uri_base="http://dummy", hashing_type=hashing_type)
+            object = store.create_object('test')
+            result = object.add_file(source)
+            self.assertEqual(object.get_bytestream('source.bin'), data)
+            if hashing_type:
+                self.assertEqual(result['checksum'], hashlib.sha256(data).hexdigest())
+            with open(source, 'rb') as stream:
+                stream.read(10)
+                object.add_bytestream('again.bin', stream, buffer_size=4096)
+            self.assertEqual(object.get_bytestream('again.bin'), data)
+
+    def test_get_bytestream_mmap_and_range(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        object = store.create_object('test')
+        object.add_file(self.test_file_path, path='data')
+        object.add_bytestream('empty', b'')
+        with open(self.test_file_path, 'rb') as f:
+            data = f.read()
+
+        with object.get_bytestream('dummy_image.jpg', path='data', mmap=True) as view:
+            self.assertTrue(view.readonly)
+            self.assertEqual(bytes(view[10:100]), data[10:100])
+            self.assertEqual(len(view), len(data))
+        self.assertEqual(bytes(object.get_bytestream_by_path('empty', mmap=True)), b'')
+
+        self.assertEqual(object.get_range('dummy_image.jpg', 10, 90, path='data'), data[10:100])
+        self.assertEqual(object.get_range('dummy_image.jpg', len(data) - 5, path='data'), data[-5:])
+        self.assertEqual(object.get_range('dummy_image.jpg', len(data) - 5, 100, path='data'), data[-5:])
+        self.assertRaises(PartNotFoundException, object.get_range, 'missing', 0, 1)
+
+    def test_atomic_write_failure_keeps_old_part(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          atomic_writes=True, fsync='always')
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'old')
+
+        class Broken:
+            def read(self, size=-1):
+                raise IOError("source went away")
+
+        self.assertRaises(IOError, object.add_bytestream, 'foo.txt', Broken())
+        self.assertEqual(object.get_bytestream('foo.txt'), b'old')
+        self.assertEqual(object.list_parts(), ['foo.txt'])
+        object.add_bytestream('foo.txt', b'new')
+        self.assertEqual(object.get_bytestream('foo.txt'), b'new')
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(os.path.join(object.location, 'foo.txt')).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_batched_fsync_commits_together(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          atomic_writes=True, fsync='batch')
+        object = store.create_object('test')
+        for x in range(3):
+            object.add_bytestream('part%d' % x, b'data')
+        self.assertEqual(object.list_parts(), [])
+        store.sync()
+        self.assertEqual(sorted(object.list_parts()), ['part0', 'part1', 'part2'])
+
+    def test_batched_fsync_commits_after_a_delay(self):
+        store = PairtreeStorageClient("http://dummy", self.data_dir, atomic_writes=True,
+                                      fsync='batch', fsync_batch_delay=0.05)
+        store.create_object('test').add_bytestream('part', b'data')
+        store.create_object('other').add_bytestream('part', b'data')
+        # a directory holding nothing but a pending write isn't an object yet
+        self.assertEqual(list(store.list_ids()), [])
+        for _ in range(100):
+            if store.isfile('test', 'part'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(store.list_ids()), ['other', 'test'])
+
+        store = PairtreeStorageClient("http://dummy", self.data_dir, atomic_writes=True,
+                                      fsync='batch', fsync_batch_delay=60)
+        store.get_object('test').add_bytestream('late', b'data')
+        self.assertFalse(store.isfile('test', 'late'))
+        store.close()
+        self.assertTrue(store.isfile('test', 'late'))
+
+    def test_ingest_streams_results_in_order(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          hashing_type='md5', index=True)
+        missing = os.path.join(self.base_dir, 'missing.jpg')
+        items = [(u'ark:/13030/%d' % x, 'images/%d.jpg' % x, self.test_file_path) for x in range(20)]
+        items.append(('foo', '', self.test_file_path))
+        items.append(('foo', 'bytes.txt', b'some bytes'))
+        items.append(('bar', 'gone.jpg', missing))
+        results = list(store.ingest(items, workers=4, batch_size=5))
 
+        with open(self.test_file_path, 'rb') as test_file:
+            orig_hash = hashlib.md5(test_file.read()).hexdigest()
+        self.assertEqual([(r.id, r.path) for r in results],
+                         [(id, path or 'dummy_image.jpg') for id, path, source in items])
+        self.assertTrue(all(r.checksum['checksum'] == orig_hash for r in results[:21]))
+        self.assertEqual(results[21].size, 10)
+        self.assertTrue(isinstance(results[-1].error, IOError))
+        self.assertFalse(store.exists('bar', 'gone.jpg'))
+        self.assertEqual(store.get_stream('ark:/13030/7', 'images', '7.jpg'),
+                         store.get_stream('foo', None, 'dummy_image.jpg'))
+        self.assertEqual(store.index.get('foo')['size'], results[20].size + 10)
+
+        # malformed items are reported in their place, and the rest carry on
+        items = [('a', 'a.txt', b'a'), ('b', '', None), ('c',), None, ('d', 'd.txt', b'd')]
+        results = list(store.ingest(items, workers=2, batch_size=2))
+        self.assertEqual([(r.id, r.path) for r in results],
+                         [('a', 'a.txt'), ('b', ''), ('c', None), (None, None), ('d', 'd.txt')])
+        self.assertEqual([r.error is None for r in results], [True, False, False, False, True])
+        self.assertTrue(isinstance(results[1].error, ValueError))
+        self.assertEqual(store.get_stream('d', None, 'd.txt'), b'd')
+
+    def test_ingest_with_processes(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        items = [('obj%d' % x, 'part', b'%d' % x) for x in range(10)]
+        results = list(store.ingest(items, workers=2, processes=True))
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(sorted(store.list_ids()), sorted(id for id, path, source in items))
+        self.assertEqual(store.get_stream('obj3', None, 'part'), b'3')
 
-
+    def test_fixity_audit(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          hashing_type='sha256', fixity=True)
+        for x in range(5):
+            object = store.create_object('obj%d' % x)
+            object.add_bytestream('a.txt', b'aaa')
+            object.add_bytestream('b.txt', b'bbb', path='sub')
+        self.assertEqual(list(store.audit(full=True)), [])
+        audit = store.audit()
+        self.assertEqual(list(audit), [])
+        self.assertEqual((audit.objects, audit.hashed, audit.skipped), (5, 0, 10))
+
+        with open(os.path.join(store._id_to_dirpath('obj1'), 'a.txt'), 'wb') as f:
+            f.write(b'rot')
+        os.remove(os.path.join(store._id_to_dirpath('obj2'), 'sub', 'b.txt'))
+        store.get_object('obj3').add_bytestream('c.txt', b'ccc')
+        with open(os.path.join(store._id_to_dirpath('obj4'), 'new.txt'), 'wb') as f:
+            f.write(b'new')
+        shutil.rmtree(store._id_to_dirpath('obj0'))
+        problems = sorted((p.kind, p.id, p.part) for p in store.audit(processes=2, max_rate=1024 * 1024))
+        self.assertEqual(problems, [('extra', 'obj4', 'new.txt'),
+                                    ('mismatch', 'obj1', 'a.txt'),
+                                    ('missing', 'obj0', 'a.txt'),
+                                    ('missing', 'obj0', os.path.join('sub', 'b.txt')),
+                                    ('missing', 'obj2', os.path.join('sub', 'b.txt'))])
+        list(store.audit(record_extra=True))
+        self.assertFalse(any(p.id == 'obj4' for p in store.audit()))
+        store.del_stream('obj3', 'c.txt')
+        self.assertEqual(sorted(store.fixity.parts('obj3', 'sha256')), ['a.txt', os.path.join('sub', 'b.txt')])
+        store.del_path('obj3', 'sub', recursive=True)
+        self.assertEqual(sorted(store.fixity.parts('obj3', 'sha256')), ['a.txt'])
+
+    def test_fixity_audit_resumes(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          hashing_type='md5', fixity=True)
+        for x in range(10):
+            store.put_stream('obj%d' % x, None, 'part', b'%d' % x)
+        with open(os.path.join(store._id_to_dirpath('obj4'), 'part'), 'wb') as f:
+            f.write(b'rot')
+        interrupted = store.audit(full=True)
+        interrupted.checkpoint_every = 3
+        run = iter(interrupted)
+        self.assertEqual(next(run).id, 'obj4')
+        run.close()
+        self.assertEqual(store.fixity.checkpoint('audit'), 'obj2')
+
+        # the objects the first run found aren't reported missing, but one gone since is
+        shutil.rmtree(store._id_to_dirpath('obj9'))
+        resumed = store.audit(full=True, resume=True)
+        self.assertEqual([(p.kind, p.id) for p in resumed], [('mismatch', 'obj4'), ('missing', 'obj9')])
+        self.assertEqual(resumed.objects, 6)
+        self.assertEqual(store.fixity.checkpoint('audit'), None)
+
+    def test_checksum_cache(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          hashing_type='md5', checksum_cache=10)
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'foo')
+        path = os.path.join(store._id_to_dirpath('test'), 'foo.txt')
+
+        # freshly written, so not cached: rewritten within the same mtime tick
+        self.assertEqual(object.checksum('foo.txt'), hashlib.md5(b'foo').hexdigest())
+        st = os.stat(path)
+        with open(path, 'wb') as f:
+            f.write(b'fuu')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(object.checksum('foo.txt'), hashlib.md5(b'fuu').hexdigest())
+        self.assertEqual(store.checksums.info()['hits'], 0)
+
+        # cached once it has aged
+        an_hour_ago = time.time() - 3600
+        os.utime(path, (an_hour_ago, an_hour_ago))
+        self.assertEqual(object.checksum('foo.txt'), hashlib.md5(b'fuu').hexdigest())
+        self.assertEqual(object.checksum('foo.txt'), hashlib.md5(b'fuu').hexdigest())
+        self.assertEqual(store.checksums.info()['hits'], 1)
+        self.assertEqual(object.checksum('foo.txt', 'sha1'), hashlib.sha1(b'fuu').hexdigest())
+        self.assertEqual(object.checksum('foo.txt', 'sha1'), hashlib.sha1(b'fuu').hexdigest())
+        self.assertEqual(store.checksums.info()['hits'], 2)
+
+        # rewritten in place, with a new mtime
+        with open(path, 'wb') as f:
+            f.write(b'bar')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertEqual(object.checksum('foo.txt', 'sha1'), hashlib.sha1(b'bar').hexdigest())
+        self.assertRaises(PartNotFoundException, object.checksum, 'missing.txt')
+
+        for x in range(20):
+            object.add_bytestream('part%d' % x, b'%d' % x)
+        self.assertTrue(len(store.checksums) <= 10)
+        os.utime(os.path.join(store._id_to_dirpath('test'), 'part19'), (an_hour_ago, an_hour_ago))
+        store.checksum('test', 'part19', 'md5')
+        reopened = storage_factory.get_store(store_dir=self.data_dir, checksum_cache=10)
+        self.assertEqual(reopened.checksum('test', 'part19', 'md5'), hashlib.md5(b'19').hexdigest())
+        self.assertEqual(reopened.checksums.info()['hits'], 1)
+
+    def test_manifest_cache(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          manifest_cache=10)
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'foo')
+        object.add_bytestream_by_path('data/images/a.tif', b'aaaa')
+        store.create_object('test2')
+        self.assertEqual(sorted(object.list_parts()), ['data', 'foo.txt'])
+        self.assertEqual(object.list_parts('data/images'), ['a.tif'])
+        self.assertTrue(object.isfile('foo.txt'))
+        self.assertTrue(object.isdir('data/images'))
+        self.assertFalse(object.isfile('data'))
+        self.assertEqual(object.stat('data/images/a.tif').st_size, 4)
+        self.assertFalse(object.stat('data'))
+        self.assertEqual(store.cache_info()['manifest']['misses'], 1)
+
+        # writes through the client drop the manifest
+        object.add_bytestream_by_path('data/images/b.tif', b'bb')
+        self.assertEqual(sorted(object.list_parts('data/images')), ['a.tif', 'b.tif'])
+        object.del_file('foo.txt')
+        self.assertFalse(object.isfile('foo.txt'))
+
+        # appends are seen once the stream is closed, even if a stat came in between
+        with store.get_appendable_stream('test', 'data/images', 'b.tif') as stream:
+            self.assertEqual(object.stat('data/images/b.tif').st_size, 2)
+            stream.write(b'bbb')
+        self.assertEqual(object.stat('data/images/b.tif').st_size, 5)
+
+        # changes made behind the client's back are noticed by the directory mtimes
+        path = os.path.join(store._id_to_dirpath('test'), 'data', 'images')
+        with open(os.path.join(path, 'c.tif'), 'wb') as f:
+            f.write(b'c')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertTrue(object.isfile('data/images/c.tif'))
+        self.assertRaises(ObjectNotFoundException, store.list_parts, 'missing')
+
+        # even when they leave the mtime as it was, if it was too recent to trust
+        obj1 = store.create_object('obj1')
+        obj1.add_bytestream('a.txt', b'a')
+        self.assertEqual(store.list_parts('obj1'), ['a.txt'])
+        st = os.stat(obj1.location)
+        with open(os.path.join(obj1.location, 'b.txt'), 'wb') as f:
+            f.write(b'b')
+        os.utime(obj1.location, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(sorted(store.list_parts('obj1')), ['a.txt', 'b.txt'])
+        self.assertTrue(store.isfile('obj1', 'b.txt'))
+        # older directories are trusted
+        an_hour_ago = time.time() - 3600
+        os.utime(obj1.location, (an_hour_ago, an_hour_ago))
+        self.assertTrue(store._manifest('obj1').is_current())
+
+    def test_walk_parts(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'foo')
+        object.add_bytestream_by_path('data/images/a.tif', b'aaaa')
+        object.add_bytestream_by_path('data/b.txt', b'bb')
+        store.create_object('test2').add_bytestream('other.txt', b'other')
+        walk = object.walk()
+        found = dict((part, st.st_size) for part, st in walk)
+        self.assertEqual(found, {'foo.txt': 3, os.path.join('data', 'images', 'a.tif'): 4,
+                                 os.path.join('data', 'b.txt'): 2})
+        self.assertEqual((walk.parts, walk.size), (3, 9))
+        self.assertEqual(sorted(part for part, st in store.walk_parts('test', 'data/images')),
+                         [os.path.join('data', 'images', 'a.tif')])
+        self.assertEqual(store.walk_parts('test').total(), 9)
+        self.assertRaises(ObjectNotFoundException, store.walk_parts, 'missing')
+        # '2' is the shorty directory of 'test2', not part of 'test'
+        self.assertRaises(ObjectNotFoundException, store.walk_parts, 'test', '2')
+        self.assertRaises(ObjectNotFoundException, store.walk_parts, 'test', '../st')
+
+    def test_fast_delete(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          fast_delete=True, index=True)
+        for id in ('test', 'test2', 'other'):
+            object = store.create_object(id)
+            object.add_bytestream('foo.txt', b'foo')
+            object.add_bytestream_by_path('data/images/a.tif', b'aaaa')
+        # 'test2' lives in a shorty directory inside 'test'
+        store.delete_object('test')
+        self.assertFalse(store.isfile('test', 'foo.txt'))
+        self.assertEqual(sorted(store.list_parts('test2')), ['data', 'foo.txt'])
+        self.assertTrue(store.isfile('test2', 'data/images/a.tif'))
+        store.delete_object('test2')
+        self.assertFalse(store.exists('test'))
+        self.assertFalse(os.path.exists(os.path.join(store.pairtree_root, 'te')))
+        store.delete_object('other', fast=False)
+        self.assertEqual(os.listdir(store.pairtree_root), [])
+        self.assertEqual(sorted(store.list_ids()), [])
+
+        # trash left behind by another process is emptied
+        leftover = os.path.join(store.trash_dir, 'leftover', 'object')
+        os.makedirs(leftover)
+        with open(os.path.join(leftover, 'part'), 'wb') as f:
+            f.write(b'part')
+        store.empty_trash()
+        self.assertEqual(os.listdir(store.trash_dir), [])
+        self.assertRaises(ObjectNotFoundException, store.delete_object, 'test')
+
+    def test_metrics(self):
+        from pairtree import MetricsCollector, PrometheusExporter, PairtreeReverseLookup
+        metrics = MetricsCollector()
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                          observer=metrics)
+        object = store.create_object('test')
+        object.add_bytestream('foo.txt', b'foo')
+        with open(self.test_file_path, 'rb') as f:
+            store.put_stream('test', None, 'image.jpg', f)
+        self.assertEqual(object.get_bytestream('foo.txt'), b'foo')
+        self.assertEqual(list(store.list_ids()), ['test'])
+        self.assertRaises(PartNotFoundException, store.get_stream, 'test', None, 'missing.txt')
+        rl = PairtreeReverseLookup(os.path.join(self.base_dir, 'rl'), backend='sqlite', observer=metrics)
+        rl['doi:1'] = 'test'
+        self.assertEqual(list(rl['doi:1']), ['test'])
+        rl.close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['object.add_bytestream']['bytes_written'], 3)
+        self.assertEqual(snapshot['put_stream']['count'], 2)
+        self.assertEqual(snapshot['put_stream']['bytes_written'], 3 + os.path.getsize(self.test_file_path))
+        self.assertEqual(snapshot['get_stream']['count'], 2)
+        self.assertEqual(snapshot['get_stream']['errors'], 1)
+        self.assertEqual(snapshot['get_stream']['bytes_read'], 3)
+        self.assertEqual(snapshot['list_ids']['count'], 1)
+        self.assertEqual(snapshot['revlookup.add']['count'], 1)
+        self.assertEqual(snapshot['put_stream']['buckets'][-1], (float('inf'), 2))
+
+        path = os.path.join(self.base_dir, 'pairtree.prom')
+        PrometheusExporter(metrics, path).write()
+        with open(path) as f:
+            text = f.read()
+        self.assertTrue('pairtree_operation_seconds_count{operation="put_stream"} 2' in text)
+        self.assertTrue('pairtree_operation_seconds_bucket{operation="put_stream",le="+Inf"} 2' in text)
+        self.assertTrue('pairtree_operation_errors_total{operation="get_stream"} 1' in text)
+
+    def test_stats(self):
+        storage_factory = PairtreeStorageFactory()
+        store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy")
+        test = store.create_object('test')
+        test.add_bytestream('foo.txt', b'foo')
+        test.add_bytestream_by_path('data/images/a.tif', b'aaaa')
+        store.create_object('test2').add_bytestream('foo.txt', b'foo')
+        store.create_object('other:1').add_bytestream('big.bin', b'x' * 1000)
+        report = store.stats(top=2)
+        self.assertEqual((report.objects, report.parts, report.bytes), (3, 4, 1010))
+        self.assertEqual(report.size_histogram, {4:1, 8:1, 1024:1})
+        self.assertEqual(report.depth_histogram, {2:1, 3:1, 4:1})
+        self.assertEqual(report.largest, [('other:1', 1000), ('test', 7)])
+        self.assertEqual(store.stats(threads=4).as_dict()["bytes"], 1010)
+        sampled = store.stats(sample=0.5, seed=1)
+        self.assertTrue(0 < sampled.sample <= 1)
+
+        # directories modified just before a scan aren't trusted by the next one
+        an_hour_ago = time.time() - 3600
+        for dirpath, dirnames, filenames in os.walk(store.pairtree_root):
+            os.utime(dirpath, (an_hour_ago, an_hour_ago))
+        first = store.stats(incremental=True)
+        self.assertEqual(first.reused, 0)
+        again = store.stats(incremental=True)
+        self.assertEqual((again.listed, again.reused), (0, first.listed))
+        self.assertEqual(again.as_dict()["size_histogram"], first.as_dict()["size_histogram"])
+        test.add_bytestream('bar.txt', b'barbar')
+        store.delete_object('other:1')
+        changed = store.stats(incremental=True)
+        self.assertEqual((changed.objects, changed.parts, changed.bytes), (2, 4, 16))
+        self.assertTrue(0 < changed.listed < first.listed)
+
+        # a change within the same mtime tick as the last listing is still picked up
+        st = os.stat(test.location)
+        test.add_bytestream('baz.txt', b'baz')
+        os.utime(test.location, ns=(st.st_atime_ns, st.st_mtime_ns))
+        racy = store.stats(incremental=True)
+        self.assertEqual((racy.parts, racy.bytes), (5, 19))
+
+    def test_multiple_hashing_types_in_one_pass(self):
+        storage_factory = PairtreeStorageFactory()
+        self.assertRaises(ValueError, storage_factory.get_store, store_dir=self.data_dir,
+                          uri_base="http://dummy", hashing_type=['md5', 'nosuchhash'])
+        with open(self.test_file_path, 'rb') as test_file:
+            data = test_file.read()
+        expected = dict((name, hashlib.new(name, data).hexdigest()) for name in ('md5', 'sha256', 'blake2b', 'sha3_256'))
+        for hash_thread in (False, True):
+            store = storage_factory.get_store(store_dir=self.data_dir, uri_base="http://dummy",
+                                              hashing_type=['md5', 'sha256', 'blake2b', 'sha3_256'],
+                                              hash_thread=hash_thread, fixity=True)
+            object = store.get_object('test')
+            result = object.add_file(self.test_file_path, buffer_size=1000)
+            self.assertEqual(result['checksums'], expected)
+            self.assertEqual((result['type'], result['checksum']), ('md5', expected['md5']))
+            self.assertEqual(object.add_bytestream('bytes', data)['checksums'], expected)
+            self.assertEqual(store.fixity.get('test', 'bytes', 'sha3_256')['checksum'], expected['sha3_256'])
+
+        store = storage_factory.get_store(store_dir=self.data_dir, hashing_type='sha1')
+        self.assertEqual(store.put_stream('test', None, 'foo', b'foo'),
+                         {'checksum':hashlib.sha1(b'foo').hexdigest(), 'type':'sha1',
+                          'checksums':{'sha1':hashlib.sha1(b'foo').hexdigest()}})
@@ -156,6 +156,43 @@ class TestPairtree(unittest.TestCase):
   14. Thai: ฉันกินกระจกได้ แต่มันไม่ทำให้ฉันเจ็บ """,
                         "hardcore unicode test - roundtrip")
 
+    def test_control_chars(self):
+        self.i2p2i('a\tb\x7fc', ['a^', '09', 'b^', '7f', 'c'], 'tab and DEL')
+
+    def test_control_chars_roundtrip(self):
+        self.roundtrip('a\tb\x7fc\x00', 'control chars - roundtrip')
+
+    def test_astral_roundtrip(self):
+        self.roundtrip(u'emoji \U0001f600 id', 'non-BMP unicode - roundtrip')
+
+    def test_decode_uppercase_hex(self):
+        self.assertEqual(ppath.id_decode('^E3^82^A6^2A'), u'ウ*')
+
+    def test_decode_bad_escape(self):
+        self.assertRaises(ValueError, ppath.id_decode, 'abc^zz')
+        self.assertRaises(UnicodeDecodeError, ppath.id_decode, '^e3^82')
+
+    def test_passes_match_id_encode(self):
+        for id in [u'ark:/13030/xt12t3', u'what-the-*@?#!^!?', u'Années de Pèlerinage']:
+            self.assertEqual(ppath.second_pass(ppath.first_pass(id)), ppath.id_encode(id))
+            self.assertEqual(ppath.reverse_first_pass(ppath.reverse_second_pass(ppath.id_encode(id))), id)
+
+    def test_encode_many(self):
+        ids = ['abc', 'ark:/13030/xt12t3', u'ウインカリッスの日本語']
+        encoded = list(ppath.encode_many(iter(ids)))
+        self.assertEqual(encoded, [ppath.id_encode(x) for x in ids])
+        self.assertEqual(list(ppath.decode_many(encoded)), ids)
+
+    def test_dirpaths_many(self):
+        ids = ['abc', 'ark:/13030/xt12t3']
+        self.assertEqual(list(ppath.dirpaths_many(ids, 'root', 3)),
+                         [ppath.id_to_dirpath(x, 'root', 3) for x in ids])
+
+    def test_encode_many_processes(self):
+        ids = ['id:%d' % x for x in range(50)]
+        self.assertEqual(list(ppath.encode_many(ids, processes=2, chunksize=7)),
+                         [ppath.id_encode(x) for x in ids])
+
     def test_french(self):
         self.i2p2i(u'Années de Pèlerinage',
                    ['An', 'n^', 'c3', '^a', '9e', 's^', '20', 'de', '^2', '0P',
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+import unittest, tempfile, os, shutil
+from pairtree import PairtreeReverseLookup
+from pairtree.pairtree_revlookup import migrate
+
+
+class TestReverseLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def check_backend(self, backend):
+        rl = PairtreeReverseLookup(storage_dir=self.base_dir, backend=backend)
+        rl["issn:1234-1234"].append("uuid:1e4f", "id:1")
+        rl["issn:1234-1234"].append("id:1")
+        rl["issn:1234-1234"] = ["id:2", u"ïd:3"]
+        rl["issn:1234"] = "ab"
+        self.assertEqual(sorted(rl["issn:1234-1234"]), sorted(["uuid:1e4f", "id:1", "id:2", u"ïd:3"]))
+        self.assertEqual(len(rl["issn:1234-1234"]), 4)
+        self.assertTrue("id:1" in rl["issn:1234-1234"])
+        self.assertFalse("id:9" in rl["issn:1234-1234"])
+        # a shorter key shares directories with the longer one
+        self.assertEqual(list(rl["issn:1234"]), ["ab"])
+        self.assertEqual(list(rl["issn:12"]), [])
+        self.assertEqual(len(rl["nothing"]), 0)
+        del rl["issn:1234"]
+        self.assertEqual(list(rl["issn:1234"]), [])
+        self.assertEqual(len(rl["issn:1234-1234"]), 4)
+        return rl
+
+    def test_file_backend(self):
+        self.check_backend("file")
+
+    def test_sqlite_backend(self):
+        self.check_backend("sqlite").close()
+
+    def test_migrate(self):
+        rl = self.check_backend("file")
+        rl["doi:10.1000/182"].append("uuid:1", "uuid:2")
+        self.assertEqual(migrate(self.base_dir, "file", "sqlite", batch_size=2), 6)
+        migrated = PairtreeReverseLookup(storage_dir=self.base_dir, backend="sqlite")
+        self.assertEqual(sorted(migrated["issn:1234-1234"]), sorted(rl["issn:1234-1234"]))
+        self.assertEqual(sorted(migrated["doi:10.1000/182"]), ["uuid:1", "uuid:2"])
+        self.assertEqual(sorted(key for key, ids in migrated.backend.items()),
+                         ["doi:10.1000/182", "issn:1234-1234"])
+        migrated.close()
+
+    def check_batches(self, backend, threads):
+        rl = PairtreeReverseLookup(storage_dir=self.base_dir, backend=backend)
+        rl["issn:1"].append("id:0")
+        mapping = dict(("issn:%d" % x, ["id:%d" % y for y in range(x % 4)]) for x in range(50))
+        mapping["doi:10.1000/182"] = "uuid:1"
+        rl.update(mapping, threads=threads)
+        rl.update([("issn:1", "id:2")], threads=threads)
+        found = rl.get_many(list(mapping) + ["nothing"], threads=threads)
+        self.assertEqual(found["nothing"], [])
+        self.assertEqual(sorted(found["issn:1"]), ["id:0", "id:2"])
+        self.assertEqual(found["doi:10.1000/182"], ["uuid:1"])
+        for x in range(2, 50):
+            self.assertEqual(sorted(found["issn:%d" % x]), mapping["issn:%d" % x])
+
+    def test_file_backend_batches(self):
+        self.check_batches("file", None)
+        self.check_batches("file", 4)
+
+    def test_sqlite_backend_batches(self):
+        self.check_batches("sqlite", None)
+
+
+if __name__ == '__main__':
+    unittest.main()